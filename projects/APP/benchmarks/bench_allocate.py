@@ -0,0 +1,42 @@
+"""
+Microbenchmark for Product.allocate on SKUs with many open batches.
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_allocate.py
+"""
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def product_with_batches(n, seed=0):
+    rng = random.Random(seed)
+    today = date.today()
+    batches = [
+        Batch(
+            f"batch-{i}",
+            "BENCH-SKU",
+            qty=rng.randint(50, 500),
+            eta=None if i % 10 == 0 else today + timedelta(days=rng.randint(1, 365)),
+        )
+        for i in range(n)
+    ]
+    return Product("BENCH-SKU", batches)
+
+
+def main():
+    allocations = 5_000
+    for n in (10, 100, 500, 1_000):
+        product = product_with_batches(n)
+        start = time.perf_counter()
+        for i in range(allocations):
+            product.allocate(OrderLine(f"order-{i}", "BENCH-SKU", 3))
+        seconds = time.perf_counter() - start
+        print(f"{n:>5} batches: {seconds / allocations * 1e6:8.1f} us per allocate")
+
+
+if __name__ == "__main__":
+    main()
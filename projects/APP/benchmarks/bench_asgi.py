@@ -0,0 +1,177 @@
+"""
+Load test the Flask app (werkzeug's server, one request at a time) against
+the ASGI app (uvicorn) on POST /allocate, at increasing numbers of concurrent
+clients, reporting throughput and p50/p99 latency. Each server gets its own
+prod-sqlite database, a catalogue added through /add_batch, and no Redis or
+email: events are published nowhere and notifications dropped.
+
+Needs uvicorn (and aiosqlite) installed. Run from projects/APP with the
+package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_asgi.py --concurrency 1 8 32 64
+
+--serve is used internally, to run one of the servers in a subprocess.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+SKUS = 50
+
+
+def serve(kind, port):
+    from allocation import bootstrap
+    from allocation.adapters.notifications import NullNotifications
+
+    def no_publish(*args):
+        pass
+
+    if kind == "flask":
+        from allocation.entrypoints import flask_app
+
+        # rebuilt without Redis or email; the routes use the module's bus
+        flask_app.bus = bootstrap.bootstrap(
+            start_orm=False,
+            notifications=NullNotifications(),
+            publish=no_publish,
+            allocations_cache=flask_app.allocations_cache,
+        )
+        # one request at a time per process: the app's unit of work isn't
+        # safe to share between threads
+        flask_app.app.run(port=port, threaded=False)
+    else:
+        import uvicorn
+        from allocation.adapters.view_cache import make_allocations_cache
+        from allocation.entrypoints import asgi_app
+        from allocation.service_layer import unit_of_work
+
+        allocations_cache = make_allocations_cache()
+        bus = bootstrap.bootstrap(
+            uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(),
+            notifications=NullNotifications(),
+            publish=no_publish,
+            allocations_cache=allocations_cache,
+        )
+        app = asgi_app.create_app(bus, allocations_cache)
+        uvicorn.run(app, port=port, log_level="warning")
+
+
+async def post(port, path, body):
+    """One request on a new connection; returns (status, seconds taken)."""
+    payload = json.dumps(body).encode()
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + payload
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1]), time.perf_counter() - started
+
+
+async def wait_until_up(port, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await post(port, "/allocate", {})
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def add_catalogue(port):
+    for i in range(SKUS):
+        for eta in (None, "2030-01-01"):
+            ref = f"b-{i}-{eta or 'stock'}"
+            body = dict(ref=ref, sku=f"SKU-{i}", qty=1_000_000, eta=eta)
+            status, _ = await post(port, "/add_batch", body)
+            assert status == 201, status
+
+
+async def load(port, concurrency, requests, label):
+    orders = iter(range(requests))
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        for i in orders:
+            body = dict(orderid=f"{label}-{i}", sku=f"SKU-{random.randrange(SKUS)}")
+            status, seconds = await post(port, "/allocate", dict(body, qty=1))
+            latencies.append(seconds)
+            errors += status != 202
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return dict(
+        rps=len(latencies) / elapsed,
+        p50=statistics.median(latencies),
+        p99=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        errors=errors,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--servers", nargs="+", default=["flask", "asgi"])
+    parser.add_argument("--serve", choices=["flask", "asgi"])
+    parser.add_argument("--port", type=int, default=5105)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    from allocation.adapters.orm import mapper_registry
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n, kind in enumerate(args.servers):
+            path = os.path.join(tmp, f"{kind}.db")
+            mapper_registry.metadata.create_all(create_engine(f"sqlite:///{path}"))
+            port = args.port + n
+            env = dict(os.environ, ENGINE_PROFILE="prod-sqlite", SQLITE_PATH=path)
+            server = subprocess.Popen(  # pylint: disable=consider-using-with
+                [sys.executable, __file__, "--serve", kind, "--port", str(port)],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                asyncio.run(wait_until_up(port))
+                asyncio.run(add_catalogue(port))
+                for c in args.concurrency:
+                    results[kind, c] = asyncio.run(
+                        load(port, c, args.requests, f"{kind}-{c}")
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+
+    print(f"{'server':<6} {'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for (kind, c), r in results.items():
+        print(
+            f"{kind:<6} {c:>7} {r['rps']:>8.1f} {r['p50'] * 1e3:>8.2f}"
+            f" {r['p99'] * 1e3:>8.2f}"
+            + (f"  ({r['errors']} errors)" * bool(r["errors"]))
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Microbenchmark for Batch availability checks.
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_availability.py
+
+The time per check should stay flat as the number of allocated lines grows.
+"""
+import timeit
+
+from allocation.domain.model import Batch, OrderLine
+
+
+def batch_with_lines(n):
+    batch = Batch("bench-batch", "BENCH-SKU", qty=n * 2, eta=None)
+    for i in range(n):
+        batch.allocate(OrderLine(f"order-{i}", "BENCH-SKU", 1))
+    return batch
+
+
+def main():
+    line = OrderLine("probe", "BENCH-SKU", 1)
+    for n in (10, 100, 1_000, 10_000):
+        batch = batch_with_lines(n)
+        number = 100_000
+        seconds = timeit.timeit(lambda: batch.can_allocate(line), number=number)
+        print(f"{n:>6} lines: {seconds / number * 1e9:8.1f} ns per can_allocate")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Allocation throughput under each engine profile from config.get_engine_profile.
+dev is memory with every statement echoed (sent to /dev/null here, so only
+the logging cost is measured); prod-sqlite is also run without its pragmas for comparison.
+prod-postgres is skipped unless its driver and database are available.
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_engine_profiles.py --skus 50 --orders 2000
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from allocation import bootstrap, config
+from allocation.adapters.engine import make_engine
+from allocation.adapters.notifications import NullNotifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+
+def workload(skus, orders):
+    setup = [
+        commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**6, None)
+        for i in range(skus)
+    ]
+    allocations = [
+        commands.Allocate(f"order-{i}", f"sku-{i % skus}", 1) for i in range(orders)
+    ]
+    return setup, allocations
+
+
+def bench(profile, setup, allocations):
+    # echo's handler writes to whatever sys.stdout is when the engine is built
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            engine = make_engine(profile)
+        mapper_registry.metadata.drop_all(engine)
+        mapper_registry.metadata.create_all(engine)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+            notifications=NullNotifications(),
+            publish=lambda *args: None,
+        )
+        try:
+            for cmd in setup:
+                bus.handle(cmd)
+            start = time.perf_counter()
+            for cmd in allocations:
+                bus.handle(cmd)
+            return time.perf_counter() - start
+        finally:
+            clear_mappers()
+            engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skus", type=int, default=50)
+    parser.add_argument("--orders", type=int, default=2000)
+    args = parser.parse_args()
+    setup, allocations = workload(args.skus, args.orders)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "allocation.db")
+        prod_sqlite = config.get_engine_profile("prod-sqlite")
+        runs = [
+            ("memory", config.get_engine_profile("memory")),
+            ("dev", config.get_engine_profile("dev")),
+            ("test", config.get_engine_profile("test")),
+            ("prod-sqlite, no pragmas", dict(prod_sqlite, sqlite_pragmas={})),
+            ("prod-sqlite", prod_sqlite),
+            ("prod-postgres", config.get_engine_profile("prod-postgres")),
+        ]
+        for label, profile in runs:
+            try:
+                seconds = bench(profile, setup, allocations)
+            except (ImportError, OperationalError):
+                print(f"{label:<24} skipped, database or driver unavailable")
+                continue
+            print(f"{label:<24} {len(allocations) / seconds:8.0f} allocations/s")
+
+
+if __name__ == "__main__":
+    main()
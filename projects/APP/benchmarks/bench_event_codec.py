@@ -0,0 +1,87 @@
+"""
+Compare the cost and size of the event wire formats: the old inline
+json.dumps(asdict(event)) path, the JSON codec and the binary codec, one
+Allocated event per publish and framed in batches.
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_event_codec.py --events 20000 --frame 100
+"""
+import argparse
+import json
+import time
+from dataclasses import asdict
+
+from allocation.adapters.event_codec import BinaryCodec, JsonCodec
+from allocation.domain import events
+
+
+def make_events(n):
+    return [
+        events.Allocated(f"order-{i}", f"sku-{i % 200}", 1 + i % 9, f"batch-{i % 50}")
+        for i in range(n)
+    ]
+
+
+def timed(fn, items):
+    start = time.perf_counter()
+    results = [fn(item) for item in items]
+    return time.perf_counter() - start, results
+
+
+def legacy_encode(event):
+    return json.dumps(asdict(event))
+
+
+def legacy_decode(data):
+    return events.Allocated(**json.loads(data))
+
+
+def frames_of(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def report(name, n, encode_seconds, decode_seconds, payloads):
+    size = sum(len(p) for p in payloads)
+    print(
+        f"{name:<16} encode {encode_seconds / n * 1e6:6.2f} us/event"
+        f"  decode {decode_seconds / n * 1e6:6.2f} us/event"
+        f"  {size / n:6.1f} bytes/event"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20_000)
+    parser.add_argument("--frame", type=int, default=100)
+    args = parser.parse_args()
+    items = make_events(args.events)
+    n = len(items)
+
+    encode_seconds, payloads = timed(legacy_encode, items)
+    decode_seconds, decoded = timed(legacy_decode, payloads)
+    assert decoded == items
+    report("asdict+json", n, encode_seconds, decode_seconds, payloads)
+
+    for codec in (JsonCodec(), BinaryCodec()):
+        encode_seconds, payloads = timed(codec.encode, items)
+        decode_seconds, decoded = timed(
+            lambda data, codec=codec: codec.decode(data, events.Allocated)[0],
+            payloads,
+        )
+        assert decoded == items
+        report(codec.name, n, encode_seconds, decode_seconds, payloads)
+
+        frames = frames_of(items, args.frame)
+        encode_seconds, payloads = timed(codec.encode_frame, frames)
+        decode_seconds, decoded = timed(
+            lambda data, codec=codec: codec.decode(data, events.Allocated), payloads
+        )
+        assert [e for frame in decoded for e in frame] == items
+        report(
+            f"{codec.name} x{args.frame}", n, encode_seconds, decode_seconds, payloads
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare allocation throughput of the single-process MessageBus against the
+SKU-sharded worker pool, on a file-backed SQLite database and a SKU-diverse
+workload.
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench_sharding.py --skus 200 --orders 5000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from allocation import bootstrap
+from allocation.adapters.notifications import NullNotifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.sharding import ShardedMessageBus
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+
+def fresh_db(directory, name):
+    db_uri = f"sqlite:///{os.path.join(directory, name)}"
+    mapper_registry.metadata.create_all(create_engine(db_uri))
+    return db_uri
+
+
+def workload(skus, orders):
+    setup = [
+        commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**6, None)
+        for i in range(skus)
+    ]
+    allocations = [
+        commands.Allocate(f"order-{i}", f"sku-{i % skus}", 1) for i in range(orders)
+    ]
+    return setup, allocations
+
+
+def bench_single_process(db_uri, setup, allocations):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=create_engine(db_uri))),
+        notifications=NullNotifications(),
+        publish=lambda *args: None,
+    )
+    try:
+        for cmd in setup:
+            bus.handle(cmd)
+        start = time.perf_counter()
+        for cmd in allocations:
+            bus.handle(cmd)
+        return time.perf_counter() - start
+    finally:
+        clear_mappers()
+
+
+def bench_sharded(db_uri, shards, setup, allocations):
+    bus = ShardedMessageBus(db_uri, num_shards=shards, side_effects=False)
+    try:
+        for future in [bus.submit(cmd) for cmd in setup]:
+            future.result()
+        start = time.perf_counter()
+        for future in [bus.submit(cmd) for cmd in allocations]:
+            future.result()
+        return time.perf_counter() - start
+    finally:
+        bus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skus", type=int, default=200)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    setup, allocations = workload(args.skus, args.orders)
+
+    with tempfile.TemporaryDirectory() as directory:
+        seconds = bench_single_process(
+            fresh_db(directory, "single.db"), setup, allocations
+        )
+        print(f"single process: {args.orders / seconds:9.0f} allocations/s")
+        for shards in args.shards:
+            db_uri = fresh_db(directory, f"sharded-{shards}.db")
+            seconds = bench_sharded(db_uri, shards, setup, allocations)
+            print(
+                f"{shards:>2} shard(s):    {args.orders / seconds:9.0f} allocations/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
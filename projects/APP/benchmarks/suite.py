@@ -0,0 +1,322 @@
+"""
+Allocation benchmark suite over a synthetic catalogue of N SKUs x M batches
+x K existing allocations per SKU, with a mix of in-stock and shipment ETAs.
+
+Measures the domain model on its own, the message bus end to end with an
+in-memory unit of work, and the message bus on file-backed SQLite (with and
+without the Product snapshot cache), for both plain allocations and
+change_batch_quantity cascades (shrinking a batch and reallocating the lines
+it releases).
+
+Run from projects/APP with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/suite.py --output before.json
+    PYTHONPATH=src python benchmarks/suite.py --baseline before.json --threshold 0.1
+
+With --baseline, any benchmark more than --threshold slower per operation than
+in the baseline is reported and the script exits with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.adapters.engine import make_engine
+from allocation.adapters.notifications import NullNotifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+
+@dataclass(frozen=True)
+class CatalogueSpec:
+    skus: int = 100
+    batches_per_sku: int = 10
+    allocations_per_sku: int = 20
+    orders: int = 2_000  # allocations to time
+    db_orders: int = 300  # fewer for the SQLite runs, which are much slower
+    seed: int = 0
+
+
+@dataclass(frozen=True)
+class Catalogue:
+    batches: List[commands.CreateBatch]
+    existing: List[commands.Allocate]
+    orders: List[commands.Allocate]
+    shrinks: List[commands.ChangeBatchQuantity]
+
+
+def make_catalogue(spec: CatalogueSpec) -> Catalogue:
+    rng = random.Random(spec.seed)
+    today = date.today()
+    batches, existing, orders = [], [], []
+    for s in range(spec.skus):
+        sku = f"sku-{s}"
+        for b in range(spec.batches_per_sku):
+            in_stock = rng.random() < 0.2
+            eta = None if in_stock else today + timedelta(days=rng.randint(1, 180))
+            batches.append(
+                commands.CreateBatch(
+                    f"{sku}-batch-{b}", sku, rng.randint(200, 1_000), eta
+                )
+            )
+        for a in range(spec.allocations_per_sku):
+            existing.append(
+                commands.Allocate(f"{sku}-seed-{a}", sku, rng.randint(1, 10))
+            )
+    for o in range(spec.orders):
+        sku = f"sku-{rng.randrange(spec.skus)}"
+        orders.append(commands.Allocate(f"order-{o}", sku, rng.randint(1, 5)))
+    # the first-choice batch of every SKU gets most of the seeded allocations,
+    # so halving it releases lines to reallocate
+    shrinks = []
+    for product in build_products(batches, existing):
+        fullest = max(product.batches, key=lambda b: b.allocated_quantity)
+        shrinks.append(
+            commands.ChangeBatchQuantity(
+                fullest.reference, fullest.allocated_quantity // 2
+            )
+        )
+    return Catalogue(batches, existing, orders, shrinks)
+
+
+def build_products(batches, existing) -> List[Product]:
+    products = {}  # type: Dict[str, Product]
+    for cmd in batches:
+        product = products.setdefault(cmd.sku, Product(cmd.sku, batches=[]))
+        product.add_batch(Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+    for cmd in existing:
+        products[cmd.sku].allocate(OrderLine(cmd.orderid, cmd.sku, cmd.qty))
+    for product in products.values():
+        product.events.clear()
+    return list(products.values())
+
+
+def no_side_effects(*args):
+    pass
+
+
+def time_it(fn: Callable, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - start
+
+
+def bench_domain_allocate(catalogue: Catalogue) -> Tuple[int, float]:
+    products = {p.sku: p for p in build_products(catalogue.batches, catalogue.existing)}
+
+    def allocate(cmd):
+        products[cmd.sku].allocate(OrderLine(cmd.orderid, cmd.sku, cmd.qty))
+
+    return len(catalogue.orders), time_it(allocate, catalogue.orders)
+
+
+def bench_domain_change_batch_quantity(catalogue: Catalogue) -> Tuple[int, float]:
+    products = build_products(catalogue.batches, catalogue.existing)
+    by_batchref = {b.reference: p for p in products for b in p.batches}
+
+    def change(cmd):
+        product = by_batchref[cmd.ref]
+        # reallocates what it releases itself
+        product.change_batch_quantity(cmd.ref, cmd.qty)
+        product.events.clear()
+
+    return len(catalogue.shrinks), time_it(change, catalogue.shrinks)
+
+
+def fake_bus(catalogue: Catalogue):
+    uow = unit_of_work.InMemoryUnitOfWork()
+    with uow:
+        for product in build_products(catalogue.batches, catalogue.existing):
+            uow.products.add(product)
+        uow.commit()
+    uow.store.rebuild_allocations_view()
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=NullNotifications(),
+        publish=no_side_effects,
+    )
+
+
+def bench_bus_fake_allocate(catalogue: Catalogue) -> Tuple[int, float]:
+    bus = fake_bus(catalogue)
+    return len(catalogue.orders), time_it(bus.handle, catalogue.orders)
+
+
+def bench_bus_fake_change_batch_quantity(catalogue: Catalogue) -> Tuple[int, float]:
+    bus = fake_bus(catalogue)
+    return len(catalogue.shrinks), time_it(bus.handle, catalogue.shrinks)
+
+
+def sqlite_bus(catalogue: Catalogue, directory, product_cache=None):
+    path = os.path.join(directory, f"bench-{time.perf_counter_ns()}.db")
+    engine = make_engine("prod-sqlite", uri=f"sqlite+pysqlite:///{path}")
+    mapper_registry.metadata.create_all(engine)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=engine), product_cache=product_cache
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=uow,
+        notifications=NullNotifications(),
+        publish=no_side_effects,
+    )
+    # built after the mappers are started, so they are persisted as is
+    with uow:
+        for product in build_products(catalogue.batches, catalogue.existing):
+            uow.products.add(product)
+        uow.commit()
+    bus.handle(commands.RebuildAllocationsView())
+    return bus, engine
+
+
+def bench_bus_sqlite(
+    catalogue: Catalogue, messages, directory, product_cache=None
+) -> Tuple[int, float]:
+    bus, engine = sqlite_bus(catalogue, directory, product_cache)
+    try:
+        return len(messages), time_it(bus.handle, messages)
+    finally:
+        clear_mappers()
+        engine.dispose()
+
+
+def run_suite(spec: CatalogueSpec, repeat: int, only=None) -> Dict[str, dict]:
+    catalogue = make_catalogue(spec)
+    directory = tempfile.mkdtemp()
+    db_orders = catalogue.orders[: spec.db_orders]
+    benchmarks = {
+        "domain.allocate": lambda: bench_domain_allocate(catalogue),
+        "domain.change_batch_quantity": lambda: bench_domain_change_batch_quantity(
+            catalogue
+        ),
+        "bus.fake.allocate": lambda: bench_bus_fake_allocate(catalogue),
+        "bus.fake.change_batch_quantity": lambda: bench_bus_fake_change_batch_quantity(
+            catalogue
+        ),
+        "bus.sqlite.allocate": lambda: bench_bus_sqlite(
+            catalogue, db_orders, directory
+        ),
+        "bus.sqlite.change_batch_quantity": lambda: bench_bus_sqlite(
+            catalogue, catalogue.shrinks, directory
+        ),
+        "bus.sqlite.cached.allocate": lambda: bench_bus_sqlite(
+            catalogue, db_orders, directory, repository.ProductCache()
+        ),
+        "bus.sqlite.cached.change_batch_quantity": lambda: bench_bus_sqlite(
+            catalogue, catalogue.shrinks, directory, repository.ProductCache()
+        ),
+    }
+    results = {}
+    try:
+        for name, bench in benchmarks.items():
+            if only and not name.startswith(only):
+                continue
+            runs = [bench() for _ in range(repeat)]
+            ops = runs[0][0]
+            seconds = min(seconds for _, seconds in runs)
+            results[name] = dict(
+                ops=ops,
+                seconds=seconds,
+                ops_per_second=ops / seconds,
+                us_per_op=seconds / ops * 1e6,
+            )
+            print(
+                f"{name:<34} {ops / seconds:10.0f} ops/s {seconds / ops * 1e6:10.1f} us/op"
+            )
+    finally:
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+    return results
+
+
+def compare(results, baseline, threshold) -> List[str]:
+    """Names of benchmarks more than threshold slower per op than baseline."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result["us_per_op"] / before["us_per_op"] - 1
+        flag = "REGRESSION" if change > threshold else ""
+        print(f"{name:<34} {change:+8.1%} per op vs baseline {flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    defaults = CatalogueSpec()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skus", type=int, default=defaults.skus)
+    parser.add_argument("--batches", type=int, default=defaults.batches_per_sku)
+    parser.add_argument("--allocations", type=int, default=defaults.allocations_per_sku)
+    parser.add_argument("--orders", type=int, default=defaults.orders)
+    parser.add_argument("--db-orders", type=int, default=defaults.db_orders)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="run benchmarks whose name starts with this")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    spec = CatalogueSpec(
+        skus=args.skus,
+        batches_per_sku=args.batches,
+        allocations_per_sku=args.allocations,
+        orders=args.orders,
+        db_orders=args.db_orders,
+        seed=args.seed,
+    )
+    results = run_suite(spec, args.repeat, args.only)
+    report = dict(
+        created=datetime.now(timezone.utc).isoformat(),
+        revision=git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        spec=asdict(spec),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["spec"] != report["spec"]:
+            print("warning: baseline was run with a different catalogue spec")
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
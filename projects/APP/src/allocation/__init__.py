@@ -0,0 +1,4 @@
+import time
+
+# read by allocation.startup to time how long the service takes to import
+IMPORT_STARTED = time.perf_counter()
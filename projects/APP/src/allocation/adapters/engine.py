@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+from allocation import config
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import (
+    AsyncAdaptedQueuePool,
+    NullPool,
+    QueuePool,
+    SingletonThreadPool,
+    StaticPool,
+)
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+POOL_CLASSES = {
+    "null": NullPool,
+    "queue": QueuePool,
+    "singleton": SingletonThreadPool,
+    "static": StaticPool,
+}
+
+# the asyncio drivers for each synchronous one the profiles use
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def make_engine(profile=None, uri=None) -> Engine:
+    """
+    Create an engine from a config.get_engine_profile() profile, given by
+    name or as the settings dict. uri overrides the profile's database.
+    """
+    if profile is None or isinstance(profile, str):
+        profile = config.get_engine_profile(profile)
+    uri = uri or profile["uri"]
+    engine = create_engine(uri, **_engine_options(profile, uri, POOL_CLASSES))
+    _listen_for_pragmas(engine, profile)
+    logger.info("created %s engine for %s", profile["name"], engine.url)
+    return engine
+
+
+def make_async_engine(profile=None, uri=None) -> AsyncEngine:
+    """
+    make_engine() for SQLAlchemy's asyncio extension, with the profile's
+    database reached through the matching asyncio driver (aiosqlite or
+    asyncpg).
+    """
+    # imported here, so the synchronous entrypoints don't pay for it
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    if profile is None or isinstance(profile, str):
+        profile = config.get_engine_profile(profile)
+    driver, sep, rest = (uri or profile["uri"]).partition("://")
+    uri = ASYNC_DRIVERS.get(driver, driver) + sep + rest
+    # an asyncio engine's connections all belong to the event loop's thread
+    pools = dict(POOL_CLASSES, queue=AsyncAdaptedQueuePool, singleton=StaticPool)
+    engine = create_async_engine(uri, **_engine_options(profile, uri, pools))
+    _listen_for_pragmas(engine.sync_engine, profile)
+    logger.info("created %s asyncio engine for %s", profile["name"], engine.url)
+    return engine
+
+
+def _engine_options(profile, uri, pools) -> dict:
+    options = dict(
+        echo=profile["echo"],
+        poolclass=pools[profile["pool"]],
+        query_cache_size=profile["query_cache_size"],
+    )
+    if profile["pool"] == "queue":
+        options.update(
+            pool_size=profile["pool_size"],
+            max_overflow=profile["max_overflow"],
+            pool_pre_ping=profile.get("pool_pre_ping", False),
+            pool_recycle=profile.get("pool_recycle", -1),
+        )
+    if uri.startswith("sqlite") and profile["pool"] in ("queue", "static"):
+        # connections are handed between threads by the pool
+        options["connect_args"] = dict(check_same_thread=False)
+    return options
+
+
+def _listen_for_pragmas(engine: Engine, profile):
+    pragmas = profile.get("sqlite_pragmas")
+    if pragmas and engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _sqlite_pragmas_setter(pragmas))
+
+
+def _sqlite_pragmas_setter(pragmas):
+    def set_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in pragmas.items():
+                cursor.execute(f"PRAGMA {pragma}={value}")
+        finally:
+            cursor.close()
+
+    return set_pragmas
@@ -0,0 +1,289 @@
+"""
+Wire formats for the messages exchanged over Redis.
+
+Every message type that crosses the wire is registered in a SchemaRegistry
+under a fixed numeric id, with its fields taken from the dataclass. Two
+codecs share the registry:
+
+* JsonCodec is the original format: one JSON object per message, keyed by
+  field name (with per-type renames, e.g. ChangeBatchQuantity.ref travels as
+  "batchref"). A frame of several messages is a JSON list.
+* BinaryCodec writes a frame as a magic byte, a version byte and a message
+  count, then per message its type id and its fields: varint (zigzag) ints,
+  length-prefixed UTF-8 strings and dates as day ordinals (0 for None).
+
+decode() recognises binary frames by their first byte, which can't start a
+JSON document, so consumers accept either format whatever the publisher is
+configured to send.
+"""
+import abc
+import dataclasses
+import functools
+import json
+import typing
+from datetime import date
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+from allocation import config
+from allocation.domain import commands, events
+
+MAGIC = 0xA7
+VERSION = 1
+
+
+class CodecError(Exception):
+    pass
+
+
+def _encode_varint(n: int) -> bytes:
+    if n < 0x80:
+        return _SMALL_VARINTS[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+_SMALL_VARINTS = [bytes((n,)) for n in range(0x80)]
+
+
+def _decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    result, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_int(value: int) -> bytes:
+    return _encode_varint((value << 1) ^ (value >> 63))  # zigzag
+
+
+def _decode_int(data, pos):
+    n, pos = _decode_varint(data, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def _encode_str(value: str) -> bytes:
+    raw = value.encode()
+    return _encode_varint(len(raw)) + raw
+
+
+def _decode_str(data, pos):
+    n, pos = _decode_varint(data, pos)
+    return data[pos : pos + n].decode(), pos + n
+
+
+def _encode_date(value: Optional[date]) -> bytes:
+    return _encode_varint(0 if value is None else value.toordinal())
+
+
+def _decode_date(data, pos):
+    n, pos = _decode_varint(data, pos)
+    return (None if n == 0 else date.fromordinal(n)), pos
+
+
+def _same(value):
+    return value
+
+
+def _date_from_json(value: Optional[str]) -> Optional[date]:
+    return None if value is None else date.fromisoformat(value)
+
+
+# per kind: binary encoder and decoder, and what turns the JSON value back
+_KINDS = {
+    int: (_encode_int, _decode_int, _same),
+    str: (_encode_str, _decode_str, _same),
+    date: (_encode_date, _decode_date, _date_from_json),
+    Optional[date]: (_encode_date, _decode_date, _date_from_json),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class Schema:
+    message_type: Type
+    type_id: int
+    fields: Tuple[str, ...]
+    wire_names: Tuple[str, ...]  # JSON keys, in field order
+    encoders: Tuple[Callable, ...]
+    decoders: Tuple[Callable, ...]
+    from_json: Tuple[Callable, ...]
+
+
+class SchemaRegistry:
+    def __init__(self):
+        self._by_type = {}  # type: Dict[Type, Schema]
+        self._by_id = {}  # type: Dict[int, Schema]
+
+    def register(
+        self, message_type: Type, type_id: int, wire_names: Dict[str, str] = None
+    ) -> Schema:
+        if type_id in self._by_id:
+            raise ValueError(f"type id {type_id} is already taken")
+        hints = typing.get_type_hints(message_type)
+        names = tuple(f.name for f in dataclasses.fields(message_type))
+        unsupported = [name for name in names if hints[name] not in _KINDS]
+        if unsupported:
+            raise TypeError(f"can't encode {message_type.__name__}.{unsupported[0]}")
+        wire_names = wire_names or {}
+        schema = Schema(
+            message_type=message_type,
+            type_id=type_id,
+            fields=names,
+            wire_names=tuple(wire_names.get(name, name) for name in names),
+            encoders=tuple(_KINDS[hints[name]][0] for name in names),
+            decoders=tuple(_KINDS[hints[name]][1] for name in names),
+            from_json=tuple(_KINDS[hints[name]][2] for name in names),
+        )
+        self._by_type[message_type] = schema
+        self._by_id[type_id] = schema
+        return schema
+
+    def for_type(self, message_type: Type) -> Schema:
+        try:
+            return self._by_type[message_type]
+        except KeyError:
+            raise CodecError(f"{message_type.__name__} is not registered") from None
+
+    def for_id(self, type_id: int) -> Schema:
+        try:
+            return self._by_id[type_id]
+        except KeyError:
+            raise CodecError(f"unknown message type id {type_id}") from None
+
+
+# ids are part of the wire format: never reuse or renumber them
+registry = SchemaRegistry()
+registry.register(events.Allocated, 1)
+registry.register(events.Deallocated, 2)
+registry.register(events.OutOfStock, 3)
+registry.register(commands.Allocate, 32)
+registry.register(commands.CreateBatch, 33)
+registry.register(commands.ChangeBatchQuantity, 34, wire_names={"ref": "batchref"})
+
+
+class AbstractCodec(abc.ABC):
+    name = None  # type: str
+
+    def __init__(self, schemas: SchemaRegistry = registry):
+        self.schemas = schemas
+
+    def encode(self, message) -> bytes:
+        return self.encode_frame([message])
+
+    @abc.abstractmethod
+    def encode_frame(self, messages: Sequence) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def decode(self, data, message_type: Type = None) -> List:
+        """
+        The messages in a frame. Formats that don't carry the type on the
+        wire need message_type.
+        """
+        raise NotImplementedError
+
+
+class JsonCodec(AbstractCodec):
+    name = "json"
+
+    def encode_frame(self, messages):
+        objects = [self._to_wire(message) for message in messages]
+        return json.dumps(objects[0] if len(objects) == 1 else objects).encode()
+
+    def _to_wire(self, message) -> dict:
+        schema = self.schemas.for_type(type(message))
+        wire = {}
+        for name, wire_name in zip(schema.fields, schema.wire_names):
+            value = getattr(message, name)
+            wire[wire_name] = value.isoformat() if isinstance(value, date) else value
+        return wire
+
+    def decode(self, data, message_type=None):
+        if message_type is None:
+            raise CodecError("JSON messages don't say what type they are")
+        schema = self.schemas.for_type(message_type)
+        try:
+            decoded = json.loads(data)
+        except (ValueError, TypeError) as e:
+            # JSONDecodeError and UnicodeDecodeError are both ValueErrors
+            raise CodecError(f"not JSON: {e}") from e
+        objects = decoded if isinstance(decoded, list) else [decoded]
+        try:
+            return [
+                message_type(
+                    *(
+                        from_json(obj[wire_name])
+                        for wire_name, from_json in zip(
+                            schema.wire_names, schema.from_json
+                        )
+                    )
+                )
+                for obj in objects
+            ]
+        except (KeyError, TypeError, ValueError) as e:
+            raise CodecError(f"bad {message_type.__name__} message: {e}") from e
+
+
+class BinaryCodec(AbstractCodec):
+    name = "binary"
+
+    def encode_frame(self, messages):
+        parts = [bytes((MAGIC, VERSION)), _encode_varint(len(messages))]
+        for message in messages:
+            schema = self.schemas.for_type(type(message))
+            parts.append(_encode_varint(schema.type_id))
+            for name, encode in zip(schema.fields, schema.encoders):
+                parts.append(encode(getattr(message, name)))
+        return b"".join(parts)
+
+    def decode(self, data, message_type=None):
+        if len(data) < 2 or data[0] != MAGIC or data[1] != VERSION:
+            raise CodecError("not a binary frame of a known version")
+        try:
+            count, pos = _decode_varint(data, 2)
+            messages = []
+            for _ in range(count):
+                type_id, pos = _decode_varint(data, pos)
+                schema = self.schemas.for_id(type_id)
+                values = []
+                for decode in schema.decoders:
+                    value, pos = decode(data, pos)
+                    values.append(value)
+                messages.append(schema.message_type(*values))
+        except (IndexError, UnicodeDecodeError) as e:
+            raise CodecError(f"truncated or corrupt frame: {e}") from e
+        if message_type is not None and any(
+            type(m) is not message_type for m in messages
+        ):
+            raise CodecError(f"expected only {message_type.__name__} messages")
+        return messages
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, BinaryCodec)}
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name: str = None) -> AbstractCodec:
+    name = name or config.get_event_codec_settings()["codec"]
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown event codec {name!r}, expected one of {list(CODECS)}"
+        )
+    return CODECS[name]()
+
+
+def decode(data, message_type: Type = None) -> List:
+    """Decode a frame in whichever format it was published in."""
+    if isinstance(data, (bytes, bytearray)) and data[:1] == bytes((MAGIC,)):
+        return get_codec(BinaryCodec.name).decode(data, message_type)
+    return get_codec(JsonCodec.name).decode(data, message_type)
@@ -0,0 +1,323 @@
+"""
+Committed state for the in-memory backend: Products by sku with a batchref
+index, and the allocations read model.
+
+Given a directory, the store persists itself as a snapshot of the Products
+plus an append-only journal of the commands handled since. Recovery loads
+the snapshot and replays the journal through the command handlers. This
+works because the domain is deterministic: the same commands applied to the
+same Products give the same result. The read model is not persisted; it is
+rebuilt from the Products.
+
+Committed batches keep their lines in frozensets, which working copies share
+until they write to them, so loading and committing a Product doesn't copy
+the lines of batches a command leaves alone.
+"""
+import collections.abc
+import logging
+import os
+import pickle
+import struct
+import threading
+from collections import defaultdict
+from typing import (
+    AbstractSet,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from allocation.domain import commands, model
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "snapshot.pickle"
+JOURNAL_FILE = "journal.log"
+_LENGTH = struct.Struct(">I")
+
+
+class VersionConflict(Exception):
+    pass
+
+
+class SharedLines(collections.abc.Set):
+    """
+    A working copy's view of a committed batch's lines, which are a
+    frozenset shared with the store and every other working copy. The first
+    write copies them, so a unit of work only pays for the batches it
+    changes. Besides reading, it supports the writes Batch makes.
+    """
+
+    __slots__ = ("_lines", "_owned")
+
+    def __init__(self, lines: FrozenSet[model.OrderLine]):
+        self._lines = lines  # type: AbstractSet[model.OrderLine]
+        self._owned = False
+
+    def _writable(self) -> Set[model.OrderLine]:
+        if not self._owned:
+            self._lines = set(self._lines)
+            self._owned = True
+        return self._lines
+
+    def add(self, line: model.OrderLine):
+        self._writable().add(line)
+
+    def discard(self, line: model.OrderLine):
+        self._writable().discard(line)
+
+    def pop(self) -> model.OrderLine:
+        return self._writable().pop()
+
+    def difference_update(self, lines: Iterable[model.OrderLine]):
+        self._writable().difference_update(lines)
+
+    def frozen(self) -> FrozenSet[model.OrderLine]:
+        return frozenset(self._lines) if self._owned else self._lines
+
+    def __contains__(self, line):
+        return line in self._lines
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __eq__(self, other):
+        return self._lines == (
+            other._lines if isinstance(other, SharedLines) else other
+        )
+
+    __hash__ = None
+
+
+def working_copy(product: model.Product) -> model.Product:
+    """A copy of a committed Product whose batches share their lines with it."""
+    batches = []
+    for batch in product.batches:
+        copy = model.Batch(
+            batch.reference, batch.sku, batch._purchased_quantity, batch.eta
+        )
+        copy._allocations = SharedLines(batch._allocations)
+        copy._allocated_quantity = batch._allocated_quantity
+        batches.append(copy)
+    return model.Product(product.sku, batches, product.version_number)
+
+
+def committed_copy(product: model.Product) -> model.Product:
+    """
+    A copy to store, with each batch's lines frozen. Lines a unit of work
+    hasn't written are still the committed frozenset, and are kept as is.
+    """
+    batches = []
+    for batch in product.batches:
+        copy = model.Batch(
+            batch.reference, batch.sku, batch._purchased_quantity, batch.eta
+        )
+        lines = batch._allocations
+        copy._allocations = (
+            lines.frozen() if isinstance(lines, SharedLines) else frozenset(lines)
+        )
+        copy._allocated_quantity = batch._allocated_quantity
+        batches.append(copy)
+    return model.Product(product.sku, batches, product.version_number)
+
+
+class Journal:
+    """
+    Length-prefixed pickled (sequence, command) records. A record cut short
+    by a crash is dropped when the journal is reopened.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+
+    def records(self) -> Iterator[Tuple[int, commands.Command]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _LENGTH.size <= len(data):
+            (length,) = _LENGTH.unpack_from(data, pos)
+            end = pos + _LENGTH.size + length
+            if end > len(data):
+                break
+            yield pickle.loads(data[pos + _LENGTH.size : end])
+            pos = end
+        if pos != len(data):
+            logger.warning("dropping a torn record at the end of %s", self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(pos)
+
+    def append(self, sequence: int, command: commands.Command):
+        if self._file is None:
+            self._file = open(self.path, "ab")  # pylint: disable=consider-using-with
+        payload = pickle.dumps((sequence, command), pickle.HIGHEST_PROTOCOL)
+        self._file.write(_LENGTH.pack(len(payload)) + payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def truncate(self):
+        self.close()
+        with open(self.path, "wb"):
+            pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class InMemoryStore:
+    def __init__(self, directory: str = None, snapshot_every=1_000, fsync=False):
+        self.products = {}  # type: Dict[str, model.Product]
+        self.skus_by_batchref = {}  # type: Dict[str, str]
+        # orderid -> {sku: batchref}
+        self.allocations_view = defaultdict(dict)  # type: Dict[str, Dict[str, str]]
+        # held while a command runs, so the journal order is the commit order
+        self.lock = threading.RLock()
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.sequence = 0  # commands journaled so far
+        self._since_snapshot = 0
+        self.journal = None  # type: Optional[Journal]
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.journal = Journal(os.path.join(directory, JOURNAL_FILE), fsync)
+
+    def get(self, sku) -> Optional[model.Product]:
+        """A private working copy of the committed Product."""
+        product = self.products.get(sku)
+        return None if product is None else working_copy(product)
+
+    def sku_for_batchref(self, batchref) -> Optional[str]:
+        return self.skus_by_batchref.get(batchref)
+
+    def commit(self, changes: Iterable[Tuple[model.Product, Optional[int]]]):
+        """
+        Store copies of the changed Products, each given with the version it
+        was loaded at (None if new), unless one has been committed since.
+        """
+        changes = list(changes)
+        with self.lock:
+            for product, loaded_version in changes:
+                current = self.products.get(product.sku)
+                version = None if current is None else current.version_number
+                if version != loaded_version:
+                    raise VersionConflict(
+                        f"{product.sku} is at version {version}, not {loaded_version}"
+                    )
+            for product, _ in changes:
+                self.products[product.sku] = committed_copy(product)
+                for batch in product.batches:
+                    self.skus_by_batchref[batch.reference] = product.sku
+
+    def allocations_for(self, orderid) -> List[Tuple[str, str]]:
+        return list(self.allocations_view.get(orderid, {}).items())
+
+    def rebuild_allocations_view(self):
+        view = defaultdict(dict)  # type: Dict[str, Dict[str, str]]
+        for product in self.products.values():
+            for batch in product.batches:
+                for line in batch._allocations:
+                    view[line.orderid][line.sku] = batch.reference
+        self.allocations_view = view
+
+    def record(self, command: commands.Command):
+        if self.journal is None:
+            return
+        self.sequence += 1
+        self.journal.append(self.sequence, command)
+        self._since_snapshot += 1
+
+    def snapshot_if_due(self):
+        if self.journal is not None and self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Write every Product to a new snapshot and empty the journal. The
+        snapshot records its sequence number, so a crash before the journal
+        is emptied only means replaying commands it already includes, which
+        are skipped.
+        """
+        with self.lock:
+            state = dict(
+                sequence=self.sequence,
+                products=[_dump(product) for product in self.products.values()],
+            )
+            path = os.path.join(self.directory, SNAPSHOT_FILE)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            self.journal.truncate()
+            self._since_snapshot = 0
+        logger.info("snapshot of %d products written", len(state["products"]))
+
+    def load(self) -> List[commands.Command]:
+        """
+        Load the snapshot, if there is one, and return the commands journaled
+        after it, for the caller to replay.
+        """
+        if self.directory is None:
+            return []
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            self.products = {}
+            self.commit((_load(dumped), None) for dumped in state["products"])
+            self.sequence = state["sequence"]
+        pending = []
+        for sequence, command in self.journal.records():
+            if sequence > self.sequence:
+                pending.append(command)
+                self.sequence = sequence
+        return pending
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+# plain tuples, so snapshots don't depend on how the classes are instrumented
+
+
+def _dump(product: model.Product) -> tuple:
+    return (
+        product.sku,
+        product.version_number,
+        [
+            (
+                batch.reference,
+                batch._purchased_quantity,
+                batch.eta,
+                [(line.orderid, line.sku, line.qty) for line in batch._allocations],
+            )
+            for batch in product.batches
+        ],
+    )
+
+
+def _load(dumped: tuple) -> model.Product:
+    sku, version_number, batches = dumped
+    product = model.Product(sku, [], version_number)
+    for ref, qty, eta, lines in batches:
+        batch = model.Batch(ref, sku, qty, eta)
+        for line in lines:
+            batch._allocations.add(model.OrderLine(*line))
+        batch._allocated_quantity = None  # recomputed from the lines
+        product.batches.append(batch)
+    return product
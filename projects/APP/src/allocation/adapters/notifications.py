@@ -1,9 +1,18 @@
 # pylint: disable=too-few-public-methods
 import abc
+import asyncio
+import atexit
+import logging
 import smtplib
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Optional
 
 from allocation import config
 
+logger = logging.getLogger(__name__)
+
 
 class AbstractNotifications(abc.ABC):
     @abc.abstractmethod
@@ -11,19 +20,177 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
+class NullNotifications(AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def _email_host_and_port(smtp_host, port):
+    if smtp_host is None or port is None:
+        settings = config.get_email_host_and_port()
+        smtp_host = settings["host"] if smtp_host is None else smtp_host
+        port = settings["port"] if port is None else port
+    return smtp_host, port
 
 
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    """
+    Connects to the SMTP server on the first send rather than on construction,
+    so bootstrapping doesn't need the mail server to be reachable. The
+    connection is reused across sends and reopened once if the server has
+    dropped it.
+    """
+
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host, self.port = _email_host_and_port(smtp_host, port)
+        self.server = None  # type: smtplib.SMTP
+
+    def _connect(self):
+        self.server = smtplib.SMTP(self.smtp_host, port=self.port)
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
+        if self.server is None:
+            self._connect()
+        try:
+            self._sendmail(destination, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            logger.info("SMTP connection lost, reconnecting")
+            self._connect()
+            self._sendmail(destination, msg)
+
+    def _sendmail(self, destination, msg):
         self.server.sendmail(
             from_addr="allocations@example.com",
             to_addrs=[destination],
             msg=msg,
         )
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, ConnectionError):
+                pass
+            self.server = None
+
+
+class DigestingEmailNotifications(EmailNotifications):
+    """
+    Collects messages per destination and sends one summary email per window,
+    so a SKU that keeps failing to allocate is reported once, with a count,
+    instead of once per order. Identical messages (e.g. "Out of stock for X")
+    are deduplicated.
+
+    A timer sends the digest when its window ends, so a message waits at
+    most `window` seconds even if nothing else happens. The window is also
+    checked on each send and by flush_if_due(), which bootstrap registers as
+    a message bus flusher; close() sends whatever is left. A digest that
+    fails to send is kept, and tried again a window later.
+    """
+
+    def __init__(
+        self,
+        smtp_host=None,
+        port=None,
+        window: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(smtp_host, port)
+        self.window = window
+        self.clock = clock
+        self._pending = OrderedDict()  # type: Dict[str, Counter]
+        self._window_started = None  # type: float
+        self._timer = None  # type: Optional[threading.Timer]
+        self._lock = threading.Lock()
+        # one send at a time on the shared connection, timer or not
+        self._send_lock = threading.Lock()
+        self._closes_at_exit = False
+
+    def send(self, destination, message):
+        with self._lock:
+            if self._window_started is None:
+                self._start_window()
+            self._pending.setdefault(destination, Counter())[message] += 1
+        self.flush_if_due()
+
+    def _start_window(self):
+        self._window_started = self.clock()
+        self._timer = threading.Timer(self.window, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Exception sending notification digest")
+
+    def flush_if_due(self):
+        started = self._window_started
+        if started is not None and self.clock() - started >= self.window:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            self._window_started = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        try:
+            with self._send_lock:
+                for destination in list(pending):
+                    super().send(destination, self._digest(pending[destination]))
+                    del pending[destination]
+        finally:
+            if pending:
+                self._keep(pending)
+
+    def _keep(self, unsent: Dict[str, Counter]):
+        # ahead of anything collected meanwhile, in a new window
+        with self._lock:
+            for destination, messages in self._pending.items():
+                unsent.setdefault(destination, Counter()).update(messages)
+            self._pending = unsent
+            if self._window_started is None:
+                self._start_window()
+
+    @staticmethod
+    def _digest(messages: Counter) -> str:
+        return "\n".join(
+            message if count == 1 else f"{message} ({count} times)"
+            for message, count in messages.items()
+        )
+
+    def close_at_exit(self):
+        """Have close() called at interpreter exit, once however often asked."""
+        if not self._closes_at_exit:
+            atexit.register(self.close)
+            self._closes_at_exit = True
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class AsyncEmailNotifications(AbstractNotifications):
+    """
+    Sends each message on its own short-lived SMTP connection in a worker
+    thread, so several notifications can be in flight on an AsyncMessageBus.
+    """
+
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host, self.port = _email_host_and_port(smtp_host, port)
+
+    async def send(self, destination, message):
+        await asyncio.to_thread(self._send, destination, message)
+
+    def _send(self, destination, message):
+        msg = f"Subject: allocation service notification\n{message}"
+        with smtplib.SMTP(self.smtp_host, port=self.port) as server:
+            server.sendmail(
+                from_addr="allocations@example.com",
+                to_addrs=[destination],
+                msg=msg,
+            )
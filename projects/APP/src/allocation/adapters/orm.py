@@ -1,7 +1,20 @@
 import logging
+from typing import Set
 
 from allocation.domain import model
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table, event
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    event,
+    func,
+)
 from sqlalchemy.orm import registry, relationship
 
 logger = logging.getLogger(__name__)
@@ -16,7 +29,8 @@ order_lines = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
-    Column("orderid", String(255)),
+    # looked up by (orderid, sku) to keep allocation idempotent
+    Column("orderid", String(255), index=True),
 )
 
 products = Table(
@@ -30,9 +44,12 @@ batches = Table(
     "batches",
     mapper_registry.metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
+    Column("reference", String(255), index=True),
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
+    # denormalized sum of the batch's allocated lines, kept up to date by the
+    # domain; see handlers.verify_allocated_quantities for fixing drift
+    Column("allocated_quantity", Integer, nullable=False, server_default="0"),
     Column("eta", Date, nullable=True),
 )
 
@@ -52,6 +69,15 @@ allocations_view = Table(
     Column("batchref", String(255)),
 )
 
+outbox = Table(
+    "outbox",
+    mapper_registry.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+)
+
 
 def start_mappers():
     logger.info("Starting mappers")
@@ -64,16 +90,49 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-            )
+            ),
+            "_allocated_quantity": batches.c.allocated_quantity,
         },
     )
     mapper_registry.map_imperatively(
         model.Product,
         products,
         properties={"batches": relationship(batches_mapper)},
+        # the domain bumps version_number itself; UPDATEs are checked against
+        # the version that was loaded, so concurrent writers can't both win
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
+def skus_without_lines(session) -> Set[str]:
+    """
+    The skus whose batches session has loaded without their lines (allocating
+    doesn't need them), so their _allocations only hold lines added since.
+    """
+    return session.info.setdefault("skus_without_lines", set())
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, context):
+    batch._lines_loaded = batch.sku not in skus_without_lines(context.session)
+
+
+@event.listens_for(model.Batch, "refresh")
+def receive_batch_refresh(batch, context, _):
+    batch._lines_loaded = batch.sku not in skus_without_lines(context.session)
+
+
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._batch_index = None
+    product._batches_by_ref = None
+
+
+@event.listens_for(model.Product, "refresh")
+@event.listens_for(model.Product, "expire")
+def reset_batch_index(product, *_):
+    if product is not None:
+        product._batch_index = None
+        product._batches_by_ref = None
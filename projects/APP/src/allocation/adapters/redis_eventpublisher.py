@@ -1,16 +1,85 @@
-import json
+import functools
 import logging
-from dataclasses import asdict
+import threading
+from typing import Dict, List
 
 import redis
 from allocation import config
+from allocation.adapters import event_codec
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> redis.Redis:
+    return redis.Redis(**config.get_redis_host_and_port())
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_client():
+    import redis.asyncio  # pylint: disable=import-outside-toplevel
+
+    return redis.asyncio.Redis(**config.get_redis_host_and_port())
+
+
+class FramingPublisher:
+    """
+    Encodes events with a codec and publishes up to frame_size of them per
+    channel as one frame. With a frame_size above 1, events wait in a buffer
+    until it fills or flush() is called (the message bus does so after each
+    message it handles).
+    """
+
+    def __init__(
+        self, client: redis.Redis, codec: event_codec.AbstractCodec, frame_size=1
+    ):
+        self.client = client
+        self.codec = codec
+        self.frame_size = frame_size
+        self._pending = {}  # type: Dict[str, List[events.Event]]
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event: events.Event):
+        if self.frame_size <= 1:
+            self.client.publish(channel, self.codec.encode(event))
+            return
+        with self._lock:
+            pending = self._pending.setdefault(channel, [])
+            pending.append(event)
+            if len(pending) < self.frame_size:
+                return
+            del self._pending[channel]
+        self.client.publish(channel, self.codec.encode_frame(pending))
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for channel, frame in pending.items():
+            pipe.publish(channel, self.codec.encode_frame(frame))
+        pipe.execute()
+
+
+@functools.lru_cache(maxsize=None)
+def get_publisher() -> FramingPublisher:
+    settings = config.get_event_codec_settings()
+    return FramingPublisher(
+        get_client(), event_codec.get_codec(settings["codec"]), settings["frame_size"]
+    )
 
 
 def publish(channel, event: events.Event):
     logging.info("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_publisher().publish(channel, event)
+
+
+def flush():
+    get_publisher().flush()
+
+
+async def publish_async(channel, event: events.Event):
+    logging.info("publishing: channel=%s, event=%s", channel, event)
+    await get_async_client().publish(channel, event_codec.get_codec().encode(event))
@@ -0,0 +1,155 @@
+"""
+Redis Streams transport. Unlike pub/sub, entries stay in the stream until
+trimmed, so nothing is lost while consumers are down. A consumer group
+shares a stream's entries between any number of consumers, across processes
+and hosts. An entry stays pending until it is acked, and entries a dead
+consumer left pending are claimed by another one after claim_idle seconds.
+An entry that has failed max_deliveries times is moved to the stream's
+dead-letter stream, "<stream>:dead", and acked.
+
+Every entry has one field, "data", holding a frame from event_codec.
+"""
+import functools
+import logging
+from typing import List, Tuple
+
+import redis
+from allocation import config
+from allocation.adapters import event_codec
+from allocation.adapters.redis_eventpublisher import get_client
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+Entry = Tuple[str, bytes]  # (entry id, data)
+
+
+def add(client, stream, data, maxlen):
+    """XADD one frame, trimming the stream to roughly maxlen entries."""
+    return client.xadd(stream, {"data": data}, maxlen=maxlen, approximate=True)
+
+
+class StreamPublisher:
+    def __init__(self, client: redis.Redis, codec: event_codec.AbstractCodec, maxlen):
+        self.client = client
+        self.codec = codec
+        self.maxlen = maxlen
+
+    def publish(self, stream, event: events.Event):
+        add(self.client, stream, self.codec.encode(event), self.maxlen)
+
+
+@functools.lru_cache(maxsize=None)
+def get_publisher() -> StreamPublisher:
+    return StreamPublisher(
+        get_client(),
+        event_codec.get_codec(),
+        config.get_redis_streams_settings()["maxlen"],
+    )
+
+
+def publish(stream, event: events.Event):
+    logging.info("publishing: stream=%s, event=%s", stream, event)
+    get_publisher().publish(stream, event)
+
+
+class StreamConsumer:
+    """
+    One consumer in a consumer group. read() hands out entries nobody has
+    seen, reclaim() takes over entries another consumer has held for longer
+    than claim_idle without acking, and ack() marks entries as done. failed()
+    dead-letters an entry once it has been delivered max_deliveries times.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        stream,
+        group,
+        name,
+        count=100,
+        claim_idle=30.0,
+        max_deliveries=5,
+    ):
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.name = name
+        self.count = count
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.dead_letter_stream = f"{stream}:dead"
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, block: float = 1.0) -> List[Entry]:
+        response = self.client.xreadgroup(
+            self.group,
+            self.name,
+            {self.stream: ">"},
+            count=self.count,
+            block=int(block * 1000),
+        )
+        if not response:
+            return []
+        _, entries = response[0]
+        return _data(entries)
+
+    def reclaim(self) -> List[Entry]:
+        response = self.client.xautoclaim(
+            self.stream,
+            self.group,
+            self.name,
+            min_idle_time=int(self.claim_idle * 1000),
+            start_id="0-0",
+            count=self.count,
+        )
+        entries = response[1]
+        if entries:
+            logger.warning(
+                "%s reclaimed %d pending entries from %s",
+                self.name,
+                len(entries),
+                self.stream,
+            )
+        return _data(entries)
+
+    def ack(self, entry_ids):
+        if entry_ids:
+            self.client.xack(self.stream, self.group, *entry_ids)
+
+    def deliveries(self, entry_id) -> int:
+        """How many times the entry has been delivered, from XPENDING."""
+        pending = self.client.xpending_range(
+            self.stream, self.group, min=entry_id, max=entry_id, count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    def failed(self, entry: Entry) -> bool:
+        """
+        Leave an entry that failed pending to be retried, or dead-letter it if
+        it has had max_deliveries tries. Returns whether it was dead-lettered.
+        """
+        entry_id, data = entry
+        deliveries = self.deliveries(entry_id)
+        if deliveries < self.max_deliveries:
+            return False
+        logger.error(
+            "moving %s to %s after %d deliveries",
+            entry_id,
+            self.dead_letter_stream,
+            deliveries,
+        )
+        self.client.xadd(self.dead_letter_stream, {"data": data, "id": entry_id})
+        self.ack([entry_id])
+        return True
+
+
+def _data(entries) -> List[Entry]:
+    # entries the stream has since trimmed come back as (id, None)
+    return [(entry_id, fields[b"data"]) for entry_id, fields in entries if fields]
@@ -1,8 +1,25 @@
 import abc
-from typing import Set
+import functools
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, Iterable, Optional, Set, Tuple
 
-from allocation.adapters import orm
+from allocation import config
+from allocation.adapters import memory_store, orm
 from allocation.domain import model
+from sqlalchemy import select
+from sqlalchemy.orm import (
+    defaultload,
+    joinedload,
+    lazyload,
+    make_transient_to_detached,
+    raiseload,
+    selectinload,
+)
+from sqlalchemy.orm.util import identity_key
 
 
 class AbstractRepository(abc.ABC):
@@ -25,6 +42,12 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def get_many(self, skus: Iterable[str]) -> Dict[str, model.Product]:
+        """The Products that exist for skus, keyed by sku."""
+        products = self._get_many(set(skus))
+        self.seen.update(products.values())
+        return products
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -37,24 +60,524 @@ class AbstractRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    def _get_many(self, skus: Set[str]) -> Dict[str, model.Product]:
+        # one lookup per sku; repositories backed by a database override this
+        products = {sku: self._get(sku) for sku in skus}
+        return {sku: product for sku, product in products.items() if product}
+
+    def allocated_batchrefs(
+        self, lines: Iterable[model.OrderLine]
+    ) -> Dict[model.OrderLine, str]:
+        """The batch each of lines is already allocated to, for those that are."""
+        lines = set(lines)
+        products = self._get_many({line.sku for line in lines})
+        return {
+            line: batch.reference
+            for product in products.values()
+            for batch in product.batches
+            for line in lines & batch._allocations
+        }
+
+
+LOADING_STRATEGIES = ("lazy", "selectin", "joined")
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    """
+    `loading` picks how a Product's batches (and their allocations) are
+    fetched: "lazy" (one query per relationship touched), "selectin" (one
+    extra IN query per relationship) or "joined" (a single LEFT OUTER JOIN).
+    With raise_on_lazy, touching anything the use case didn't plan to load
+    raises instead of quietly issuing another query.
+    """
+
+    def __init__(self, session, loading="selectin", raise_on_lazy=False):
         super().__init__()
+        if loading not in LOADING_STRATEGIES:
+            raise ValueError(f"Unknown loading strategy {loading}")
         self.session = session
+        self.loading = loading
+        self.raise_on_lazy = raise_on_lazy
+
+    def _loader_options(self, with_lines):
+        # where a line fits only depends on each batch's persisted
+        # allocated_quantity, so allocating doesn't load the batches' lines
+        # (noload: new lines are still INSERTed). Changing a batch quantity
+        # can release lines and move them to any batch, so it loads them all.
+        loader = {"lazy": lazyload, "selectin": selectinload, "joined": joinedload}[
+            self.loading
+        ]
+        batches = loader(model.Product.batches)
+        if with_lines:
+            batches = getattr(batches, loader.__name__)(model.Batch._allocations)
+        else:
+            batches = batches.noload(model.Batch._allocations)
+        options = [batches]
+        if self.raise_on_lazy:
+            # the paths named above win over the wildcards, which only catch
+            # what was left unplanned on the product and its batches
+            options.append(raiseload("*"))
+            options.append(defaultload(model.Product.batches).raiseload("*"))
+        return options
 
     def _add(self, product):
         self.session.add(product)
 
+    def _without_lines(self, skus):
+        # before the query, so the batches' load events see it
+        orm.skus_without_lines(self.session).update(skus)
+
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        self._without_lines([sku])
+        return (
+            self.session.query(model.Product)
+            .options(*self._loader_options(with_lines=False))
+            .filter_by(sku=sku)
+            .first()
+        )
+
+    def _get_many(self, skus):
+        if not skus:
+            return {}
+        self._without_lines(skus)
+        products = (
+            self.session.query(model.Product)
+            .options(*self._loader_options(with_lines=False))
+            .filter(orm.products.c.sku.in_(skus))
+            .all()
+        )
+        return {product.sku: product for product in products}
 
     def _get_by_batchref(self, batchref):
-        return (
+        query = (
             self.session.query(model.Product)
+            .options(*self._loader_options(with_lines=True))
             .join(model.Batch)
             .filter(
                 orm.batches.c.reference == batchref,
             )
-            .first()
         )
+        product = query.first()
+        without_lines = orm.skus_without_lines(self.session)
+        if product is not None and product.sku in without_lines:
+            # the identity map handed back the instance loaded earlier without
+            # its lines, as it was; load it again, lines and all
+            without_lines.discard(product.sku)
+            product = query.populate_existing().first()
+        return product
+
+    def allocated_batchrefs(self, lines):
+        lines = set(lines)
+        if not lines:
+            return {}
+        rows = self.session.execute(
+            select(
+                orm.order_lines.c.orderid,
+                orm.order_lines.c.sku,
+                orm.order_lines.c.qty,
+                orm.batches.c.reference,
+            )
+            .join(
+                orm.allocations,
+                orm.allocations.c.orderline_id == orm.order_lines.c.id,
+            )
+            .join(orm.batches, orm.batches.c.id == orm.allocations.c.batch_id)
+            .where(
+                orm.order_lines.c.orderid.in_({line.orderid for line in lines}),
+                orm.order_lines.c.sku.in_({line.sku for line in lines}),
+            )
+        )
+        found = {(orderid, sku, qty): ref for orderid, sku, qty, ref in rows}
+        return {
+            line: found[line.orderid, line.sku, line.qty]
+            for line in lines
+            if (line.orderid, line.sku, line.qty) in found
+        }
+
+
+class ResidentSqlAlchemyRepository(SqlAlchemyRepository):
+    """
+    Keeps every Product it has loaded (and a batchref index over them) in
+    memory, for a long-lived session that owns its SKUs exclusively.
+    """
+
+    def __init__(self, session, **kwargs):
+        super().__init__(session, **kwargs)
+        self._by_sku = {}  # type: Dict[str, model.Product]
+        self._by_batchref = {}  # type: Dict[str, model.Product]
+
+    def _loader_options(self, with_lines):
+        # a cached Product may be asked to deallocate later, so load it whole
+        return super()._loader_options(with_lines=True)
+
+    def _without_lines(self, skus):
+        pass
+
+    # the lines are all here, and may not have been flushed yet
+    allocated_batchrefs = AbstractRepository.allocated_batchrefs
+
+    def remember(self, product):
+        if product is not None:
+            self._by_sku[product.sku] = product
+            for batch in product.batches:
+                self._by_batchref[batch.reference] = product
+        return product
+
+    def forget(self, product):
+        self._by_sku.pop(product.sku, None)
+        for batchref in [r for r, p in self._by_batchref.items() if p is product]:
+            del self._by_batchref[batchref]
+
+    def forget_all(self):
+        self._by_sku.clear()
+        self._by_batchref.clear()
+
+    def _add(self, product):
+        super()._add(product)
+        self.remember(product)
+
+    def _get(self, sku):
+        if sku in self._by_sku:
+            return self._by_sku[sku]
+        return self.remember(super()._get(sku))
+
+    def _get_many(self, skus):
+        products = {sku: self._by_sku[sku] for sku in skus if sku in self._by_sku}
+        missing = skus - products.keys()
+        if missing:
+            for product in super()._get_many(missing).values():
+                products[self.remember(product).sku] = product
+        return products
+
+    def _get_by_batchref(self, batchref):
+        if batchref in self._by_batchref:
+            return self._by_batchref[batchref]
+        return self.remember(super()._get_by_batchref(batchref))
+
+
+class InMemoryRepository(AbstractRepository):
+    """
+    Private copies of the Products in an InMemoryStore, found through its
+    sku and batchref indexes, remembering the version each was loaded at.
+    """
+
+    def __init__(self, store: memory_store.InMemoryStore):
+        super().__init__()
+        self.store = store
+        self._working = {}  # type: Dict[str, model.Product]
+        self._loaded_versions = {}  # type: Dict[str, Optional[int]]
+
+    def _add(self, product):
+        self._working[product.sku] = product
+        self._loaded_versions[product.sku] = None
+
+    def _get(self, sku):
+        if sku not in self._working:
+            product = self.store.get(sku)
+            if product is None:
+                return None
+            self._working[sku] = product
+            self._loaded_versions[sku] = product.version_number
+        return self._working[sku]
+
+    def _get_by_batchref(self, batchref):
+        sku = self.store.sku_for_batchref(batchref)
+        if sku is None:
+            # a batch added by this unit of work and not yet committed
+            return next(
+                (
+                    p
+                    for p in self._working.values()
+                    for b in p.batches
+                    if b.reference == batchref
+                ),
+                None,
+            )
+        return self._get(sku)
+
+    def changes(self):
+        """The changed Products, with the version each was loaded at."""
+        return [
+            (product, self._loaded_versions[sku])
+            for sku, product in self._working.items()
+            if product.version_number != self._loaded_versions[sku]
+        ]
+
+    def committed(self):
+        for sku, product in self._working.items():
+            self._loaded_versions[sku] = product.version_number
+
+
+# (id, orderid, sku, qty)
+LineRow = Tuple[int, str, str, int]
+# (id, reference, purchased quantity, allocated quantity, eta, lines); lines
+# is None when the Product was loaded without them
+BatchRow = Tuple[int, str, int, int, Optional[date], Optional[Tuple[LineRow, ...]]]
+
+
+@dataclass(frozen=True)
+class ProductSnapshot:
+    sku: str
+    version_number: int
+    with_lines: bool
+    batches: Tuple[BatchRow, ...]
+
+
+def take_snapshot(product: model.Product, with_lines: bool) -> ProductSnapshot:
+    """Plain data copy of a persistent Product, primary keys included."""
+    return ProductSnapshot(
+        sku=product.sku,
+        version_number=product.version_number,
+        with_lines=with_lines,
+        batches=tuple(
+            (
+                batch.id,
+                batch.reference,
+                batch._purchased_quantity,
+                batch._allocated_quantity,
+                batch.eta,
+                tuple(
+                    (line.id, line.orderid, line.sku, line.qty)
+                    for line in batch._allocations
+                )
+                if with_lines
+                else None,
+            )
+            for batch in product.batches
+        ),
+    )
+
+
+def restore(snapshot: ProductSnapshot, session, with_lines: bool) -> model.Product:
+    """
+    Rebuild the Product and attach it to session as if it had just been
+    loaded, without any SQL: every object gets its identity key and clean
+    attribute history, so only what the domain changes afterwards is flushed.
+    Without lines, the batches' lines are left out as the noload option
+    would.
+    """
+    batches = []
+    for batch_id, ref, qty, allocated, eta, lines in snapshot.batches:
+        batch = model.Batch(ref, snapshot.sku, qty, eta)
+        batch.id = batch_id
+        batch._allocated_quantity = allocated
+        batch._lines_loaded = with_lines
+        for line_id, orderid, sku, line_qty in lines if with_lines else ():
+            line = model.OrderLine(orderid, sku, line_qty)
+            line.id = line_id
+            make_transient_to_detached(line)
+            batch._allocations.add(line)
+        make_transient_to_detached(batch)
+        batches.append(batch)
+    product = model.Product(snapshot.sku, batches, snapshot.version_number)
+    make_transient_to_detached(product)
+    session.add(product)
+    return product
+
+
+class ProductCache:
+    """
+    Process-wide snapshots of Product aggregates, shared by every unit of
+    work. An entry is only used while its version_number is still the one in
+    the database, so one snapshot is kept per sku, the latest seen. Units of
+    work replace the snapshots of the Products they commit.
+
+    Keeps the average ORM load time of misses, with and without lines, to
+    estimate how much hydration time each hit saved.
+    """
+
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # type: OrderedDict[str, ProductSnapshot]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hydration_seconds_saved = 0.0
+        # keyed by with_lines: [misses, seconds spent loading them]
+        self._loads = {False: [0, 0.0], True: [0, 0.0]}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sku, version_number, with_lines) -> Optional[ProductSnapshot]:
+        with self._lock:
+            snapshot = self._entries.get(sku)
+            if (
+                snapshot is None
+                or snapshot.version_number != version_number
+                or (with_lines and not snapshot.with_lines)
+            ):
+                return None
+            self._entries.move_to_end(sku)
+            return snapshot
+
+    def put(self, snapshot: ProductSnapshot):
+        with self._lock:
+            current = self._entries.get(snapshot.sku)
+            # keep the one with lines when both describe the same version
+            if (
+                current is not None
+                and current.version_number == snapshot.version_number
+                and current.with_lines
+                and not snapshot.with_lines
+            ):
+                return
+            self._entries[snapshot.sku] = snapshot
+            self._entries.move_to_end(snapshot.sku)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, skus: Iterable[str]):
+        with self._lock:
+            for sku in skus:
+                self._entries.pop(sku, None)
+
+    def record_hit(self, seconds, with_lines):
+        with self._lock:
+            self.hits += 1
+            misses, load_seconds = self._loads[with_lines]
+            if misses:
+                self.hydration_seconds_saved += load_seconds / misses - seconds
+
+    def record_miss(self, seconds, with_lines):
+        with self._lock:
+            self.misses += 1
+            self._loads[with_lines][0] += 1
+            self._loads[with_lines][1] += seconds
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_ratio=self.hits / lookups if lookups else 0.0,
+                size=len(self._entries),
+                hydration_seconds_saved=self.hydration_seconds_saved,
+            )
+
+
+def make_product_cache() -> Optional[ProductCache]:
+    settings = config.get_product_cache_settings()
+    if not settings["enabled"]:
+        return None
+    return ProductCache(max_size=settings["max_size"])
+
+
+class CachingSqlAlchemyRepository(SqlAlchemyRepository):
+    """
+    Looks up the current version_number of a Product with one indexed query
+    and restores it from the ProductCache when the cached snapshot has that
+    version, instead of loading its batches (and lines) through the ORM.
+    """
+
+    def __init__(self, session, cache: ProductCache, **kwargs):
+        super().__init__(session, **kwargs)
+        self.cache = cache
+        self._with_lines = {}  # type: Dict[str, bool]
+
+    def _add(self, product):
+        super()._add(product)
+        self._with_lines[product.sku] = True  # new, so all its lines are here
+
+    def snapshots(self):
+        """Snapshots of the seen Products, once their changes are flushed."""
+        return [take_snapshot(p, self._with_lines[p.sku]) for p in self.seen]
+
+    def invalidate_snapshots(self):
+        """Drop the cached snapshots of every Product this repository loaded."""
+        # by sku, as the Products themselves are expired after a failed flush
+        self.cache.invalidate(list(self._with_lines))
+
+    def _in_session(self, sku) -> Optional[model.Product]:
+        return self.session.identity_map.get(identity_key(model.Product, sku))
+
+    def _restore(self, sku, version_number, with_lines) -> Optional[model.Product]:
+        started = time.perf_counter()
+        snapshot = self.cache.get(sku, version_number, with_lines)
+        if snapshot is None:
+            return None
+        if not with_lines:
+            self._without_lines([sku])
+        product = restore(snapshot, self.session, with_lines)
+        self.cache.record_hit(time.perf_counter() - started, with_lines)
+        self._with_lines[sku] = with_lines
+        return product
+
+    def _load(self, load, with_lines) -> Dict[str, model.Product]:
+        started = time.perf_counter()
+        products = load()
+        if products:
+            seconds = (time.perf_counter() - started) / len(products)
+            for product in products.values():
+                self.cache.record_miss(seconds, with_lines)
+                self.cache.put(take_snapshot(product, with_lines))
+                self._with_lines[product.sku] = with_lines
+        return products
+
+    def _get(self, sku):
+        product = self._in_session(sku)
+        if product is not None:
+            return product
+        version_number = self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
+        if version_number is None:
+            return None
+        return self._restore(sku, version_number, False) or self._load(
+            functools.partial(self._get_many_uncached, {sku}), False
+        ).get(sku)
+
+    def _get_many(self, skus):
+        products = {}
+        for sku in skus:
+            product = self._in_session(sku)
+            if product is not None:
+                products[sku] = product
+        unknown = skus - products.keys()
+        if not unknown:
+            return products
+        versions = self.session.execute(
+            select(orm.products.c.sku, orm.products.c.version_number).where(
+                orm.products.c.sku.in_(unknown)
+            )
+        ).all()
+        missing = set()
+        for sku, version_number in versions:
+            product = self._restore(sku, version_number, False)
+            if product is None:
+                missing.add(sku)
+            else:
+                products[sku] = product
+        if missing:
+            products.update(
+                self._load(functools.partial(self._get_many_uncached, missing), False)
+            )
+        return products
+
+    def _get_many_uncached(self, skus):
+        return super()._get_many(skus)
+
+    def _get_by_batchref(self, batchref):
+        row = self.session.execute(
+            select(orm.products.c.sku, orm.products.c.version_number)
+            .join(orm.batches, orm.batches.c.sku == orm.products.c.sku)
+            .where(orm.batches.c.reference == batchref)
+        ).first()
+        if row is None:
+            return None
+        product = self._in_session(row.sku)
+        if product is None:
+            product = self._restore(row.sku, row.version_number, True)
+        elif row.sku not in orm.skus_without_lines(self.session):
+            return product
+        else:
+            # restored or loaded without its lines; the load fills them in
+            product = None
+        return product or self._load(
+            functools.partial(self._get_by_batchref_uncached, batchref), True
+        ).get(row.sku)
+
+    def _get_by_batchref_uncached(self, batchref):
+        product = super()._get_by_batchref(batchref)
+        return {product.sku: product} if product else {}
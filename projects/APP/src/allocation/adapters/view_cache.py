@@ -0,0 +1,180 @@
+# pylint: disable=too-few-public-methods
+import abc
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from allocation import config
+
+
+class AbstractCacheStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[list]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+
+class InMemoryLRUStore(AbstractCacheStore):
+    def __init__(self, max_size=10_000, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, list]]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCacheStore(AbstractCacheStore):
+    """Shares cached views between processes through a local Redis."""
+
+    def __init__(self, client, ttl=30.0, prefix="allocations_view:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+
+class AllocationsCache:
+    """
+    Read-through cache of views.allocations results, keyed by orderid.
+
+    Entries are dropped when an Allocated/Deallocated event for the order is
+    handled, and dropped again once the read model has been flushed. A load
+    that either of those overtakes may have read the old view, so its result
+    is returned but not stored. That only covers invalidations made in this
+    process; with a shared store, another process's stale load can still be
+    cached until the ttl.
+    """
+
+    def __init__(self, store: AbstractCacheStore):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._pending = set()  # type: Set[str]
+        # orderid -> [loads in flight, invalidations since the first began]
+        self._loading = {}  # type: Dict[str, List[int]]
+        self._lock = threading.Lock()
+
+    def get_or_load(self, orderid: str, load: Callable[[], list]) -> list:
+        value = self.store.get(orderid)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        with self._lock:
+            loading = self._loading.setdefault(orderid, [0, 0])
+            loading[0] += 1
+            invalidated = loading[1]
+        try:
+            value = load()
+        except BaseException:
+            with self._lock:
+                self._loaded(orderid, loading)
+            raise
+        # checked and stored under the lock that invalidations delete under
+        with self._lock:
+            self._loaded(orderid, loading)
+            if loading[1] == invalidated:
+                self.store.set(orderid, value)
+        return value
+
+    def _loaded(self, orderid: str, loading: List[int]):
+        loading[0] -= 1
+        if loading[0] == 0:
+            del self._loading[orderid]
+
+    def invalidate(self, orderid: str):
+        self.invalidations += 1
+        self._drop(orderid)
+        self._pending.add(orderid)
+
+    def _drop(self, orderid: str):
+        with self._lock:
+            loading = self._loading.get(orderid)
+            if loading is not None:
+                loading[1] += 1
+            self.store.delete(orderid)
+
+    def clear(self):
+        self.store.clear()
+
+    def flush(self):
+        pending, self._pending = self._pending, set()
+        for orderid in pending:
+            self._drop(orderid)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+            hit_ratio=self.hits / lookups if lookups else 0.0,
+        )
+
+
+def make_allocations_cache() -> AllocationsCache:
+    settings = config.get_allocations_cache_settings()
+    if settings["backend"] == "redis":
+        import redis  # pylint: disable=import-outside-toplevel
+
+        client = redis.Redis(**config.get_redis_host_and_port())
+        return AllocationsCache(RedisCacheStore(client, ttl=settings["ttl"]))
+    return AllocationsCache(
+        InMemoryLRUStore(max_size=settings["max_size"], ttl=settings["ttl"])
+    )
@@ -1,24 +1,91 @@
 import inspect
-from typing import Callable
+import time
+from typing import Callable, Dict, Type, Union
 
-from allocation.adapters import orm, redis_eventpublisher
-from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
+from allocation import config
+from allocation import startup as startup_timing
+from allocation.adapters import (
+    memory_store,
+    orm,
+    redis_eventpublisher,
+    redis_streams,
+    repository,
+)
+from allocation.adapters.notifications import (
+    AbstractNotifications,
+    AsyncEmailNotifications,
+    DigestingEmailNotifications,
+)
+from allocation.adapters.view_cache import AllocationsCache, make_allocations_cache
+from allocation.domain import events
 from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer.instrumentation import AbstractBusInstrumentation
+from allocation.service_layer.projector import (
+    AllocationsViewProjector,
+    InMemoryAllocationsViewProjector,
+)
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
-) -> messagebus.MessageBus:
+    publish: Callable = None,
+    use_async: bool = False,
+    event_concurrency: Dict[Type[events.Event], int] = None,
+    use_outbox: bool = None,
+    allocations_cache: AllocationsCache = None,
+    startup: startup_timing.StartupTimer = None,
+    instrumentation: AbstractBusInstrumentation = None,
+) -> Union[messagebus.MessageBus, messagebus.AsyncMessageBus]:
+    if startup is None:
+        startup = startup_timing.StartupTimer(started=time.perf_counter())
+    if uow is None:
+        uow = _default_unit_of_work()
+    in_memory = isinstance(uow, unit_of_work.InMemoryUnitOfWork)
     if notifications is None:
-        notifications = EmailNotifications()
+        if use_async:
+            notifications = AsyncEmailNotifications()
+        else:
+            settings = config.get_notification_settings()
+            notifications = DigestingEmailNotifications(
+                window=settings["digest_window"]
+            )
+    if allocations_cache is None:
+        allocations_cache = make_allocations_cache()
+    if use_outbox is None:
+        # only the SQLAlchemy units of work have an outbox table to write to
+        use_outbox = config.get_outbox_relay_settings()["enabled"] and hasattr(
+            uow, "outbox_channels"
+        )
+    if use_outbox:
+        # events are published by the outbox relay, not inline
+        uow.outbox_channels = handlers.OUTBOX_CHANNELS
+        publish = _published_by_outbox_relay
+    if publish is None:
+        if use_async:
+            publish = redis_eventpublisher.publish_async
+        elif config.get_redis_streams_settings()["transport"] == "streams":
+            publish = redis_streams.publish
+        else:
+            publish = redis_eventpublisher.publish
+    startup.mark("bootstrap.adapters")
 
-    if start_orm:
+    if start_orm and not in_memory:
         orm.start_mappers()
+    startup.mark("bootstrap.orm")
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    if in_memory:
+        projector = InMemoryAllocationsViewProjector(uow)
+    else:
+        projector = AllocationsViewProjector(uow)
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "publish": publish,
+        "projector": projector,
+        "allocations_cache": allocations_cache,
+    }
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies) for handler in event_handlers
@@ -29,11 +96,38 @@ def bootstrap(
         command_type: inject_dependencies(handler, dependencies)
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
+    if in_memory:
+        # command handlers only touch the unit of work, so they can replay
+        uow.recover(injected_command_handlers)
+        injected_command_handlers = {
+            command_type: uow.journaled(handler)
+            for command_type, handler in injected_command_handlers.items()
+        }
+    startup.mark("bootstrap.handlers")
+
+    flushers = [projector.flush, allocations_cache.flush]
+    framing = config.get_event_codec_settings()["frame_size"] > 1
+    if publish is redis_eventpublisher.publish and framing:
+        flushers.append(redis_eventpublisher.flush)
+    if isinstance(notifications, DigestingEmailNotifications):
+        flushers.append(notifications.flush_if_due)
+        notifications.close_at_exit()
 
+    if use_async:
+        return messagebus.AsyncMessageBus(
+            uow=uow,
+            event_handlers=injected_event_handlers,
+            command_handlers=injected_command_handlers,
+            event_concurrency=event_concurrency,
+            flushers=flushers,
+            instrumentation=instrumentation,
+        )
     return messagebus.MessageBus(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        flushers=flushers,
+        instrumentation=instrumentation,
     )
 
 
@@ -42,4 +136,29 @@ def inject_dependencies(handler, dependencies):
     deps = {
         name: dependency for name, dependency in dependencies.items() if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    def injected(message):
+        return handler(message, **deps)
+
+    # keeps the handler's name for logs and instrumentation
+    injected.__name__ = injected.__qualname__ = handler.__name__
+    return injected
+
+
+def _default_unit_of_work() -> unit_of_work.AbstractUnitOfWork:
+    settings = config.get_unit_of_work_settings()
+    if settings["backend"] == "memory":
+        return unit_of_work.InMemoryUnitOfWork(
+            memory_store.InMemoryStore(
+                settings["directory"],
+                snapshot_every=settings["snapshot_every"],
+                fsync=settings["fsync"],
+            )
+        )
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        product_cache=repository.make_product_cache()
+    )
+
+
+def _published_by_outbox_relay(*args):
+    pass
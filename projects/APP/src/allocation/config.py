@@ -26,3 +26,147 @@ def get_email_host_and_port():
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+
+def get_outbox_relay_settings():
+    # write events to the outbox for the relay instead of publishing inline
+    enabled = os.environ.get("OUTBOX_ENABLED", "0").lower() not in ("0", "false", "off")
+    batch_size = int(os.environ.get("OUTBOX_BATCH_SIZE", 500))
+    flush_interval = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", 0.5))
+    return dict(enabled=enabled, batch_size=batch_size, flush_interval=flush_interval)
+
+
+def get_redis_consumer_batch_settings():
+    max_size = int(os.environ.get("CONSUMER_BATCH_SIZE", 100))
+    max_wait = float(os.environ.get("CONSUMER_BATCH_WINDOW", 0.05))
+    return dict(max_size=max_size, max_wait=max_wait)
+
+
+def get_allocations_cache_settings():
+    backend = os.environ.get("ALLOCATIONS_CACHE_BACKEND", "memory")
+    max_size = int(os.environ.get("ALLOCATIONS_CACHE_SIZE", 10_000))
+    ttl = float(os.environ.get("ALLOCATIONS_CACHE_TTL", 30))
+    return dict(backend=backend, max_size=max_size, ttl=ttl)
+
+
+def get_conflict_retry_settings():
+    max_attempts = int(os.environ.get("CONFLICT_RETRY_ATTEMPTS", 5))
+    base_delay = float(os.environ.get("CONFLICT_RETRY_BASE_DELAY", 0.01))
+    max_delay = float(os.environ.get("CONFLICT_RETRY_MAX_DELAY", 0.5))
+    return dict(max_attempts=max_attempts, base_delay=base_delay, max_delay=max_delay)
+
+
+def get_notification_settings():
+    digest_window = float(os.environ.get("NOTIFICATIONS_DIGEST_WINDOW", 60))
+    return dict(digest_window=digest_window)
+
+
+def get_bus_metrics_settings():
+    enabled = os.environ.get("BUS_METRICS", "1").lower() not in ("0", "false", "off")
+    return dict(enabled=enabled)
+
+
+def get_event_codec_settings():
+    codec = os.environ.get("EVENT_CODEC", "json")
+    frame_size = int(os.environ.get("EVENT_FRAME_SIZE", 1))
+    return dict(codec=codec, frame_size=frame_size)
+
+
+def get_redis_streams_settings():
+    # "pubsub" or "streams", for both events out and commands in
+    transport = os.environ.get("EVENT_TRANSPORT", "pubsub")
+    group = os.environ.get("STREAMS_GROUP", "allocation")
+    workers = int(os.environ.get("STREAMS_WORKERS", 1))
+    claim_idle = float(os.environ.get("STREAMS_CLAIM_IDLE", 30))
+    maxlen = int(os.environ.get("STREAMS_MAXLEN", 100_000))
+    # deliveries after which an entry that keeps failing is dead-lettered
+    max_deliveries = int(os.environ.get("STREAMS_MAX_DELIVERIES", 5))
+    return dict(
+        transport=transport,
+        group=group,
+        workers=workers,
+        claim_idle=claim_idle,
+        maxlen=maxlen,
+        max_deliveries=max_deliveries,
+    )
+
+
+def get_product_cache_settings():
+    enabled = os.environ.get("PRODUCT_CACHE", "0").lower() not in ("0", "false", "off")
+    max_size = int(os.environ.get("PRODUCT_CACHE_SIZE", 10_000))
+    return dict(enabled=enabled, max_size=max_size)
+
+
+def get_unit_of_work_settings():
+    # "sqlalchemy", or "memory" to run without a database
+    backend = os.environ.get("UOW_BACKEND", "sqlalchemy")
+    # where the in-memory backend keeps its snapshot and journal, if anywhere
+    directory = os.environ.get("IN_MEMORY_DIR") or None
+    snapshot_every = int(os.environ.get("IN_MEMORY_SNAPSHOT_EVERY", 1_000))
+    fsync = os.environ.get("IN_MEMORY_FSYNC", "0").lower() not in ("0", "false", "off")
+    return dict(
+        backend=backend,
+        directory=directory,
+        snapshot_every=snapshot_every,
+        fsync=fsync,
+    )
+
+
+def get_engine_profile(name=None):
+    """
+    Named create_engine settings, picked by ENGINE_PROFILE unless given.
+    memory, the default, is in-memory SQLite; dev is the same with every
+    statement echoed, for debugging only. test is quiet in-memory SQLite
+    shared between threads, prod-sqlite is a pooled WAL-mode file database
+    and prod-postgres a pre-pinged, recycled Postgres pool.
+    """
+    name = name or os.environ.get("ENGINE_PROFILE", "memory")
+    sqlite_path = os.environ.get("SQLITE_PATH", "allocation.db")
+    memory = dict(
+        uri="sqlite+pysqlite:///:memory:",
+        echo=False,
+        pool="singleton",
+        query_cache_size=500,
+        sqlite_pragmas={},
+    )
+    profiles = {
+        "memory": memory,
+        "dev": dict(memory, echo=True),
+        "test": dict(
+            uri="sqlite+pysqlite:///:memory:",
+            echo=False,
+            pool="static",
+            query_cache_size=500,
+            sqlite_pragmas=dict(synchronous="OFF"),
+        ),
+        "prod-sqlite": dict(
+            uri=f"sqlite+pysqlite:///{sqlite_path}",
+            echo=False,
+            pool="queue",
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            query_cache_size=1_200,
+            sqlite_pragmas=dict(
+                journal_mode="WAL",
+                synchronous="NORMAL",
+                mmap_size=268_435_456,
+                cache_size=-64_000,  # negative means KiB, so 64MB
+                busy_timeout=5_000,
+            ),
+        ),
+        "prod-postgres": dict(
+            uri=get_postgres_uri(),
+            echo=False,
+            pool="queue",
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 10)),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+            pool_pre_ping=True,
+            pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1_800)),
+            query_cache_size=1_200,
+        ),
+    }
+    if name not in profiles:
+        raise ValueError(
+            f"Unknown engine profile {name!r}, expected one of {list(profiles)}"
+        )
+    return dict(profiles[name], name=name)
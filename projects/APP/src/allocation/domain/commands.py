@@ -1,7 +1,7 @@
 # pylint: disable=too-few-public-methods
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class Command:
@@ -27,3 +27,29 @@ class CreateBatch(Command):
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+
+
+@dataclass
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
+@dataclass
+class AllocateOrder(Command):
+    orderid: str
+    lines: Dict[str, int]  # qty by sku
+
+
+@dataclass
+class ChangeBatchQuantities(Command):
+    changes: List[ChangeBatchQuantity]
+
+
+@dataclass
+class RebuildAllocationsView(Command):
+    pass
+
+
+@dataclass
+class VerifyAllocatedQuantities(Command):
+    pass
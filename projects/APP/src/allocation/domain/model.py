@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+from bisect import bisect_left
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set
+from typing import Dict, List, Optional, Set
 
 from . import commands, events
 
@@ -13,31 +14,126 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._batch_index = None  # type: Optional[BatchIndex]
+        self._batches_by_ref = None  # type: Optional[Dict[str, Batch]]
+
+    def _get_batch(self, ref: str) -> Batch:
+        # a plain map, so looking up one batch doesn't touch the others' lines
+        if self._batches_by_ref is None or len(self._batches_by_ref) != len(
+            self.batches
+        ):
+            self._batches_by_ref = {b.reference: b for b in self.batches}
+        return self._batches_by_ref[ref]
+
+    def _get_batch_index(self) -> BatchIndex:
+        # rebuilt lazily after ORM hydration, or if batches were appended directly
+        if self._batch_index is None or len(self._batch_index) != len(self.batches):
+            self._batch_index = BatchIndex(self.batches)
+        return self._batch_index
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._batches_by_ref is not None:
+            self._batches_by_ref[batch.reference] = batch
+        if self._batch_index is not None:
+            self._batch_index.add(batch)
+        self.version_number += 1
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        index = self._get_batch_index()
+        batch = index.first_fit(line.qty)
+        if batch is None or not batch.can_allocate(line):
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        index.update(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self._get_batch(ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        self.version_number += 1
+        released = batch.release_excess()
+        if self._batch_index is not None:
+            self._batch_index.update(batch)
+        self.events.extend(
+            events.Deallocated(line.orderid, line.sku, line.qty) for line in released
+        )
+        # released lines are reallocated here, in the same unit of work, rather
+        # than by a handler per Deallocated event; any that don't fit anywhere
+        # stay deallocated and raise OutOfStock
+        for line in released:
+            self.allocate(line)
+
+
+class BatchIndex:
+    """
+    A Product's batches in allocation preference order (warehouse stock first,
+    then earliest ETA), with a max-segment tree over their available
+    quantities so the first batch that can take a line is found in O(log n).
+    """
+
+    def __init__(self, batches: List[Batch]):
+        self._ordered = sorted(batches)
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._ordered)
+
+    def __iter__(self):
+        return iter(self._ordered)
+
+    def _rebuild(self):
+        self._positions = {b.reference: i for i, b in enumerate(self._ordered)}
+        self._size = 1
+        while self._size < len(self._ordered):
+            self._size *= 2
+        self._tree = [float("-inf")] * (2 * self._size)
+        for i, batch in enumerate(self._ordered):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def add(self, batch: Batch):
+        # insert after every batch that sorts at or before it, like sorted() would
+        lo, hi = 0, len(self._ordered)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ordered[mid] > batch:
+                hi = mid
+            else:
+                lo = mid + 1
+        self._ordered.insert(lo, batch)
+        self._rebuild()
+
+    def update(self, batch: Batch):
+        node = self._size + self._positions[batch.reference]
+        self._tree[node] = batch.available_quantity
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_fit(self, qty: int) -> Optional[Batch]:
+        if not self._ordered or self._tree[1] < qty:
+            return None
+        node = 1
+        while node < self._size:
+            node = 2 * node if self._tree[2 * node] >= qty else 2 * node + 1
+        return self._ordered[node - self._size]
+
+
+class AllocatedQuantityMismatch(Exception):
+    pass
 
 
 @dataclass(unsafe_hash=True)
@@ -48,12 +144,21 @@ class OrderLine:
 
 
 class Batch:
+    # debug mode: compare the running total against the real sum on every read
+    check_allocated_quantity = False
+    # False when the batch was loaded without its lines, as it is to allocate,
+    # so that _allocations only holds the lines added since
+    _lines_loaded = True
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        # running total of _allocations, persisted so a loaded batch can be
+        # allocated to without its lines; None means "recompute on next read"
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -74,15 +179,52 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity += line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        line = self._allocations.pop()
+        if self._allocated_quantity is not None:
+            self._allocated_quantity -= line.qty
+        return line
+
+    def release_excess(self) -> List[OrderLine]:
+        """
+        Deallocate the fewest lines needed to bring the available quantity back
+        to zero: take the largest lines until one line alone covers what is
+        left of the deficit, then take the smallest such line. If all the
+        lines together don't cover it (a negative quantity), release them all.
+        """
+        deficit = -self.available_quantity
+        if deficit <= 0:
+            return []
+        lines = sorted(self._allocations, key=lambda line: line.qty)
+        qtys = [line.qty for line in lines]
+        released = []
+        while deficit > 0 and lines:
+            i = min(bisect_left(qtys, deficit), len(lines) - 1)
+            qtys.pop(i)
+            line = lines.pop(i)
+            released.append(line)
+            deficit -= line.qty
+        self._allocations.difference_update(released)
+        if self._allocated_quantity is not None:
+            self._allocated_quantity -= sum(line.qty for line in released)
+        return released
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        elif self.check_allocated_quantity and self._lines_loaded:
+            actual = sum(line.qty for line in self._allocations)
+            if actual != self._allocated_quantity:
+                raise AllocatedQuantityMismatch(
+                    f"{self!r} running total {self._allocated_quantity} != {actual}"
+                )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -0,0 +1,141 @@
+"""
+The Flask app's /add_batch, /allocate and /allocations/<orderid> endpoints as
+a plain ASGI application over an AsyncSqlAlchemyUnitOfWork, so a request
+waiting on the database gives the event loop back instead of holding a worker
+thread. Serve it with any ASGI server, e.g.
+
+    uvicorn --factory allocation.entrypoints.asgi_app:create_app --port 5005
+
+ENGINE_PROFILE picks the database as for the Flask app, reached through
+aiosqlite or asyncpg. The events a command raises are handled in its request,
+as in the Flask app; handlers that talk to Redis or SMTP still block the event
+loop while they do.
+"""
+import json
+from datetime import datetime
+from typing import Optional, Tuple, Union
+
+from allocation import bootstrap, views
+from allocation.adapters.view_cache import AllocationsCache, make_allocations_cache
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.handlers import InvalidSku
+from allocation.startup import StartupTimer
+
+Response = Tuple[int, Union[str, dict, list]]
+
+
+def create_app(
+    bus: messagebus.MessageBus = None, allocations_cache: AllocationsCache = None
+):
+    if bus is None:
+        startup = StartupTimer()
+        startup.mark("import")
+        allocations_cache = allocations_cache or make_allocations_cache()
+        bus = bootstrap.bootstrap(
+            uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(),
+            allocations_cache=allocations_cache,
+            startup=startup,
+        )
+        startup.log()
+    return AllocationApp(bus, allocations_cache)
+
+
+class AllocationApp:
+    def __init__(
+        self,
+        bus: messagebus.MessageBus,
+        allocations_cache: Optional[AllocationsCache] = None,
+    ):
+        self.bus = bus
+        self.uow = bus.uow  # type: unit_of_work.AsyncSqlAlchemyUnitOfWork
+        self.allocations_cache = allocations_cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await _lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        try:
+            status, body = await self.dispatch(scope["method"], scope["path"], receive)
+        except (ValueError, KeyError) as e:
+            status, body = 400, {"message": f"Bad request: {e!r}"}
+        await _respond(send, status, body)
+
+    async def dispatch(self, method, path, receive) -> Response:
+        if path == "/add_batch" and method == "POST":
+            return await self.add_batch(await _json(receive))
+        if path == "/allocate" and method == "POST":
+            return await self.allocate(await _json(receive))
+        if path.startswith("/allocations/") and method == "GET":
+            return await self.allocations_view(path[len("/allocations/") :])
+        return 404, "not found"
+
+    async def handle(self, message: messagebus.Message):
+        # a bus of its own, since another request may be mid-way through one
+        return await self.uow.run(self.bus.fork().handle, message)
+
+    async def add_batch(self, body) -> Response:
+        eta = body["eta"]
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        await self.handle(
+            commands.CreateBatch(body["ref"], body["sku"], body["qty"], eta)
+        )
+        return 201, "OK"
+
+    async def allocate(self, body) -> Response:
+        try:
+            await self.handle(
+                commands.Allocate(body["orderid"], body["sku"], body["qty"])
+            )
+        except InvalidSku as e:
+            return 400, {"message": str(e)}
+        return 202, "OK"
+
+    async def allocations_view(self, orderid) -> Response:
+        result = await self.uow.run(
+            views.allocations, orderid, self.uow, self.allocations_cache
+        )
+        if not result:
+            return 404, "not found"
+        return 200, result
+
+
+async def _json(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return json.loads(body)
+
+
+async def _respond(send, status, body):
+    if isinstance(body, str):
+        content, content_type = body.encode(), b"text/plain; charset=utf-8"
+    else:
+        content, content_type = json.dumps(body).encode(), b"application/json"
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(content)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": content})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -1,12 +1,23 @@
 from datetime import datetime
 
-from allocation import bootstrap, views
+from allocation import bootstrap, config, views
+from allocation.adapters.view_cache import make_allocations_cache
 from allocation.domain import commands
+from allocation.service_layer import handlers
 from allocation.service_layer.handlers import InvalidSku
-from flask import Flask, jsonify, request
+from allocation.service_layer.instrumentation import BusMetrics, prometheus_metric
+from allocation.startup import StartupTimer
+from flask import Flask, Response, jsonify, request
 
+startup = StartupTimer()
+startup.mark("import")
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+allocations_cache = make_allocations_cache()
+bus_metrics = BusMetrics() if config.get_bus_metrics_settings()["enabled"] else None
+bus = bootstrap.bootstrap(
+    allocations_cache=allocations_cache, startup=startup, instrumentation=bus_metrics
+)
+startup.log()
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -34,9 +45,105 @@ def allocate_endpoint():
     return "OK", 202
 
 
+@app.route("/allocate/bulk", methods=["POST"])
+def allocate_bulk_endpoint():
+    lines = [
+        commands.Allocate(line["orderid"], line["sku"], line["qty"])
+        for line in request.json["lines"]
+    ]
+    try:
+        [batchrefs] = bus.handle(commands.AllocateMany(lines))
+    except InvalidSku as e:
+        return {"message": str(e)}, 400
+
+    return (
+        jsonify(
+            [
+                {
+                    "orderid": line.orderid,
+                    "sku": line.sku,
+                    "qty": line.qty,
+                    "batchref": batchref,
+                }
+                for line, batchref in zip(lines, batchrefs)
+            ]
+        ),
+        202,
+    )
+
+
+@app.route("/orders/<orderid>/allocate", methods=["POST"])
+def allocate_order_endpoint(orderid):
+    lines = {}
+    for line in request.json["lines"]:
+        lines[line["sku"]] = lines.get(line["sku"], 0) + line["qty"]
+    try:
+        [batchrefs] = bus.handle(commands.AllocateOrder(orderid, lines))
+    except InvalidSku as e:
+        return {"message": str(e)}, 400
+
+    return jsonify({"orderid": orderid, "batchrefs": batchrefs}), 202
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, bus.uow, allocations_cache)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/allocations_cache/stats", methods=["GET"])
+def allocations_cache_stats_endpoint():
+    return jsonify(allocations_cache.stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    cache = allocations_cache.stats()
+    conflicts = handlers.conflict_stats.snapshot()
+    body = "".join(
+        [
+            bus_metrics.to_prometheus() if bus_metrics is not None else "",
+            prometheus_metric(
+                "allocation_view_cache_requests_total",
+                "counter",
+                "Allocations view cache lookups by result",
+                {
+                    (("result", "hit"),): cache["hits"],
+                    (("result", "miss"),): cache["misses"],
+                },
+            ),
+            prometheus_metric(
+                "allocation_handler_attempts_total",
+                "counter",
+                "Handler attempts, counting retries after a conflict",
+                {(("handler", n),): s["attempts"] for n, s in conflicts.items()},
+            ),
+            prometheus_metric(
+                "allocation_handler_conflicts_total",
+                "counter",
+                "Commits that lost an optimistic-concurrency race",
+                {(("handler", n),): s["conflicts"] for n, s in conflicts.items()},
+            ),
+        ]
+    )
+    product_cache = getattr(bus.uow, "product_cache", None)
+    if product_cache is not None:
+        stats = product_cache.stats()
+        body += prometheus_metric(
+            "allocation_product_cache_requests_total",
+            "counter",
+            "Product snapshot cache lookups by result",
+            {
+                (("result", "hit"),): stats["hits"],
+                (("result", "miss"),): stats["misses"],
+            },
+        )
+        body += prometheus_metric(
+            "allocation_product_cache_hydration_seconds_saved_total",
+            "counter",
+            "ORM load time the snapshot cache hits avoided, estimated",
+            {(): stats["hydration_seconds_saved"]},
+        )
+    return Response(body, mimetype="text/plain; version=0.0.4")
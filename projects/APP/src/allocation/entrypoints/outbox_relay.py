@@ -0,0 +1,59 @@
+import logging
+import time
+
+import redis
+from allocation import config
+from allocation.adapters import orm, redis_streams
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info("Outbox relay starting")
+    settings = config.get_outbox_relay_settings()
+    streams = config.get_redis_streams_settings()
+    maxlen = streams["maxlen"] if streams["transport"] == "streams" else None
+    session_factory = unit_of_work.default_session_factory()
+    redis_client = redis.Redis(**config.get_redis_host_and_port())
+    while True:
+        relayed = relay_batch(
+            session_factory, redis_client, settings["batch_size"], maxlen
+        )
+        if relayed < settings["batch_size"]:
+            time.sleep(settings["flush_interval"])
+
+
+def relay_batch(session_factory, redis_client, batch_size, stream_maxlen=None) -> int:
+    """
+    Publish up to batch_size outbox rows, oldest first, in one Redis pipeline,
+    then delete them. A crash between the two steps republishes the batch, so
+    delivery is at-least-once. With a stream_maxlen, rows are added to
+    streams (trimmed to about that length) instead of published.
+    """
+    session = session_factory()
+    try:
+        rows = session.execute(
+            orm.outbox.select().order_by(orm.outbox.c.id).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        pipe = redis_client.pipeline(transaction=False)
+        for row in rows:
+            if stream_maxlen:
+                redis_streams.add(pipe, row.channel, row.payload, stream_maxlen)
+            else:
+                pipe.publish(row.channel, row.payload)
+        pipe.execute()
+        session.execute(
+            orm.outbox.delete().where(orm.outbox.c.id.in_([row.id for row in rows]))
+        )
+        session.commit()
+        logger.debug("relayed %d outbox messages", len(rows))
+        return len(rows)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,105 @@
-import json
 import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
 
 import redis
 from allocation import bootstrap, config
+from allocation.adapters import event_codec
 from allocation.domain import commands
+from allocation.startup import StartupTimer
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+
+@dataclass
+class BatchMetrics:
+    messages_in: int
+    commands_executed: int
+    lag: float  # seconds from receiving the oldest message to having applied it
 
 
 def main():
     logger.info("Redis pubsub starting")
-    bus = bootstrap.bootstrap()
+    startup = StartupTimer()
+    startup.mark("import")
+    bus = bootstrap.bootstrap(startup=startup)
+    startup.log()
+    r = redis.Redis(**config.get_redis_host_and_port())
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
+    settings = config.get_redis_consumer_batch_settings()
+
+    while True:
+        received = collect_batch(pubsub, **settings)
+        if not received:
+            continue
+        try:
+            handle_change_batch_quantities(received, bus)
+        except Exception:  # pylint: disable=broad-except
+            # the batch is lost either way; keep consuming the next ones
+            logger.exception("failed to apply a batch of %d messages", len(received))
+
+
+def collect_batch(pubsub, max_size, max_wait) -> List[Tuple[float, dict]]:
+    """
+    Block until a message arrives, then keep collecting until max_size
+    messages or max_wait seconds after the first one, whichever comes first.
+    """
+    received = []  # type: List[Tuple[float, dict]]
+    deadline = None
+    while len(received) < max_size:
+        timeout = 1.0 if deadline is None else deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        m = pubsub.get_message(timeout=timeout)
+        if m is None:
+            continue
+        received.append((time.monotonic(), m))
+        if deadline is None:
+            deadline = time.monotonic() + max_wait
+    return received
+
+
+def handle_change_batch_quantities(received, bus) -> BatchMetrics:
+    changes = []  # type: List[commands.ChangeBatchQuantity]
+    for _, m in received:
+        try:
+            # JSON or binary, one change or a frame of them
+            changes += event_codec.decode(m["data"], commands.ChangeBatchQuantity)
+        except Exception:  # pylint: disable=broad-except
+            # one bad message shouldn't cost the rest of the batch
+            logger.exception("dropping undecodable message %r", m["data"])
+    cmd = coalesce(changes)
+    if cmd.changes:
+        bus.handle(cmd)
+    metrics = BatchMetrics(
+        messages_in=len(received),
+        commands_executed=len(cmd.changes),
+        lag=time.monotonic() - received[0][0],
+    )
+    logger.info(
+        "applied batch: messages_in=%d commands_executed=%d lag=%.3fs",
+        metrics.messages_in,
+        metrics.commands_executed,
+        metrics.lag,
+    )
+    return metrics
+
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+def coalesce(changes) -> commands.ChangeBatchQuantities:
+    latest = {}  # type: Dict[str, int]
+    for change in changes:
+        latest[change.ref] = change.qty  # last write wins
+    return commands.ChangeBatchQuantities(
+        [commands.ChangeBatchQuantity(ref=ref, qty=qty) for ref, qty in latest.items()]
+    )
 
 
 def handle_change_batch_quantity(m, bus):
     logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+    for cmd in event_codec.decode(m["data"], commands.ChangeBatchQuantity):
+        bus.handle(cmd)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+"""
+Applies batch quantity changes from the change_batch_quantity stream, as a
+member of a consumer group, so any number of these processes (each running
+STREAMS_WORKERS worker threads) share the work. Entries are acked once the
+changes they carry are committed; a worker that dies leaves its entries
+pending for another one to reclaim. When a batch fails, its entries are
+retried one by one, so one bad entry doesn't hold up the others; an entry
+that fails STREAMS_MAX_DELIVERIES times is dead-lettered.
+
+Ordering across workers isn't guaranteed, so two changes to the same batch
+handled by different workers at about the same time may apply in either
+order. Run one worker in total where that matters.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from typing import List, Tuple
+
+import redis
+from allocation import bootstrap, config
+from allocation.adapters import event_codec
+from allocation.adapters.redis_streams import Entry, StreamConsumer
+from allocation.domain import commands
+from allocation.entrypoints.redis_eventconsumer import coalesce
+from allocation.startup import StartupTimer
+
+logger = logging.getLogger(__name__)
+
+STREAM = "change_batch_quantity"
+
+
+def main():
+    logger.info("Redis streams consumer starting")
+    startup = StartupTimer()
+    startup.mark("import")
+    settings = config.get_redis_streams_settings()
+    batch_settings = config.get_redis_consumer_batch_settings()
+    client = redis.Redis(**config.get_redis_host_and_port())
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    workers = []
+    for i in range(settings["workers"]):
+        # a bus, and so a unit of work, per thread; the mappers only once
+        bus = bootstrap.bootstrap(start_orm=i == 0, startup=startup)
+        consumer = StreamConsumer(
+            client,
+            STREAM,
+            settings["group"],
+            f"{prefix}-{i}",
+            count=batch_settings["max_size"],
+            claim_idle=settings["claim_idle"],
+            max_deliveries=settings["max_deliveries"],
+        )
+        workers.append(Worker(consumer, bus))
+    startup.log()
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=worker.run, args=(stop,), name=worker.consumer.name)
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+class Worker:
+    def __init__(self, consumer: StreamConsumer, bus, block=1.0):
+        self.consumer = consumer
+        self.bus = bus
+        self.block = block
+        self._next_reclaim = 0.0
+
+    def run(self, stop: threading.Event):
+        self.consumer.ensure_group()
+        while not stop.is_set():
+            try:
+                self.poll()
+            except redis.ConnectionError:
+                logger.exception("lost connection to Redis, retrying")
+                time.sleep(self.block)
+            except Exception:  # pylint: disable=broad-except
+                # whatever one batch did, the worker keeps going
+                logger.exception("%s failed to poll, retrying", self.consumer.name)
+                time.sleep(self.block)
+
+    def poll(self) -> int:
+        """
+        Handle one batch, taking over stale pending entries first when it is
+        time to look for them. Returns how many entries were handled.
+        """
+        entries = []  # type: List[Entry]
+        now = time.monotonic()
+        if now >= self._next_reclaim:
+            entries = self.consumer.reclaim()
+            self._next_reclaim = now + self.consumer.claim_idle / 2
+        if not entries:
+            entries = self.consumer.read(self.block)
+        if entries:
+            handle_entries(self.consumer, entries, self.bus)
+        return len(entries)
+
+
+def handle_entries(consumer: StreamConsumer, entries: List[Entry], bus):
+    decoded = []  # type: List[Tuple[Entry, List[commands.ChangeBatchQuantity]]]
+    undecodable = []
+    for entry in entries:
+        try:
+            decoded.append(
+                (entry, event_codec.decode(entry[1], commands.ChangeBatchQuantity))
+            )
+        except Exception:  # pylint: disable=broad-except
+            # retrying can't help, however it failed
+            logger.exception("dropping undecodable entry %s", entry[0])
+            undecodable.append(entry[0])
+    # acked straight away, or they would be reclaimed forever
+    consumer.ack(undecodable)
+    if not decoded:
+        return
+    try:
+        bus.handle(coalesce(change for _, changes in decoded for change in changes))
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("failed to apply %d entries, retrying each", len(decoded))
+    else:
+        consumer.ack([entry_id for (entry_id, _), _ in decoded])
+        return
+    for entry, changes in decoded:
+        try:
+            bus.handle(coalesce(changes))
+        except Exception:  # pylint: disable=broad-except
+            # left pending, to be reclaimed and retried, until dead-lettered
+            logger.exception("failed to apply entry %s", entry[0])
+            consumer.failed(entry)
+        else:
+            consumer.ack([entry[0]])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,137 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
 
-from dataclasses import asdict
-from typing import TYPE_CHECKING, Callable, Dict, List, Type
+import functools
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Type
 
+from allocation import config
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from allocation.service_layer.unit_of_work import ConcurrentModification
+from sqlalchemy import text
 
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
+    from allocation.adapters import notifications, view_cache
 
-    from . import unit_of_work
+    from . import projector, unit_of_work
+
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidSku(Exception):
     pass
 
 
+class ConflictStats:
+    def __init__(self):
+        self.attempts = Counter()  # type: Counter[str]
+        self.conflicts = Counter()  # type: Counter[str]
+        self.exhausted = Counter()  # type: Counter[str]
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: dict(
+                attempts=attempts,
+                conflicts=self.conflicts[name],
+                exhausted=self.exhausted[name],
+                conflict_rate=self.conflicts[name] / attempts,
+            )
+            for name, attempts in self.attempts.items()
+        }
+
+
+conflict_stats = ConflictStats()
+
+
+def retry_on_conflict(handler):
+    """
+    Re-run the handler in a fresh unit of work when its commit loses an
+    optimistic-concurrency race, with jittered exponential backoff.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        return _with_retries(
+            handler.__name__,
+            functools.partial(handler, *args, **kwargs),
+            kwargs.get("uow"),
+        )
+
+    return wrapper
+
+
+def _with_retries(name: str, attempt: Callable, uow, attempts_made=0):
+    """
+    Call attempt() until it doesn't raise ConcurrentModification, counting
+    each call in conflict_stats. attempts_made says how many conflicting
+    attempts the caller has already had.
+    """
+    settings = config.get_conflict_retry_settings()
+    # an asyncio unit of work waits without blocking its event loop
+    sleep = getattr(uow, "sleep", time.sleep)
+    tries = attempts_made
+    while True:
+        if tries:
+            if tries >= settings["max_attempts"]:
+                conflict_stats.exhausted[name] += 1
+                raise ConcurrentModification(f"{name} gave up after {tries} tries")
+            delay = min(
+                settings["max_delay"], settings["base_delay"] * 2 ** (tries - 1)
+            ) * random.uniform(0.5, 1.5)
+            logger.info("conflict in %s, retrying in %.3fs", name, delay)
+            sleep(delay)
+        conflict_stats.attempts[name] += 1
+        try:
+            return attempt()
+        except ConcurrentModification:
+            conflict_stats.conflicts[name] += 1
+            tries += 1
+            if tries == settings["max_attempts"]:
+                conflict_stats.exhausted[name] += 1
+                raise
+
+
+def _committed(name: str, uow: unit_of_work.AbstractUnitOfWork) -> bool:
+    """Commit one SKU's group of a bulk command, counted like a retry."""
+    conflict_stats.attempts[name] += 1
+    try:
+        uow.commit()
+    except ConcurrentModification:
+        conflict_stats.conflicts[name] += 1
+        return False
+    return True
+
+
+def _retry_groups(
+    name: str,
+    uow: unit_of_work.AbstractUnitOfWork,
+    groups: List[Callable],
+    committed: List[model.Product],
+):
+    """
+    Re-apply the groups of a bulk command from the one whose commit
+    conflicted, each in a unit of work of its own, retried like a handler.
+    The products of every committed group are then handed to the last unit
+    of work, so the bus still collects all of their events.
+    """
+    for n, group in enumerate(groups):
+        committed.append(
+            _with_retries(
+                name,
+                functools.partial(group, uow),
+                uow,
+                attempts_made=1 if n == 0 else 0,
+            )
+        )
+    uow.products.seen.update(committed)
+
+
+@retry_on_conflict
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -26,10 +141,11 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
         uow.commit()
 
 
+@retry_on_conflict
 def allocate(
     cmd: commands.Allocate,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -39,17 +155,88 @@ def allocate(
         product = uow.products.get(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
-        product.allocate(line)
+        # the batches' lines aren't loaded, so the domain can't tell by itself
+        if not uow.products.allocated_batchrefs([line]):
+            product.allocate(line)
         uow.commit()
 
 
-def reallocate(
-    event: events.Deallocated,
+def allocate_many(
+    cmd: commands.AllocateMany,
     uow: unit_of_work.AbstractUnitOfWork,
-):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+) -> List[Optional[str]]:
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[int]]
+    for i, line in enumerate(cmd.lines):
+        lines_by_sku[line.sku].append(i)
+    batchrefs = [None] * len(cmd.lines)  # type: List[Optional[str]]
+    lines = [OrderLine(line.orderid, line.sku, line.qty) for line in cmd.lines]
+    skus = list(lines_by_sku)
+    committed = []  # type: List[model.Product]
+    with uow:
+        products = uow.products.get_many(lines_by_sku)
+        for sku in skus:
+            if sku not in products:
+                raise InvalidSku(f"Invalid sku {sku}")
+        allocated = uow.products.allocated_batchrefs(lines)
+        for n, sku in enumerate(skus):
+            product = products[sku]
+            for i in lines_by_sku[sku]:
+                line = lines[i]
+                if line not in allocated:
+                    allocated[line] = product.allocate(line)
+                batchrefs[i] = allocated[line]
+            if not _committed("allocate_many", uow):
+                conflicted = skus[n:]
+                break
+            committed.append(product)
+        else:
+            return batchrefs
+
+    groups = [
+        functools.partial(_allocate_lines, sku, lines_by_sku[sku], lines, batchrefs)
+        for sku in conflicted
+    ]
+    _retry_groups("allocate_many", uow, groups, committed)
+    return batchrefs
+
+
+def _allocate_lines(sku, positions, lines, batchrefs, uow) -> model.Product:
+    with uow:
+        product = uow.products.get(sku=sku)
+        group = [lines[i] for i in positions]
+        allocated = uow.products.allocated_batchrefs(group)
+        for i, line in zip(positions, group):
+            batchrefs[i] = allocated.get(line) or product.allocate(line)
+        uow.commit()
+    return product
+
+
+@retry_on_conflict
+def allocate_order(
+    cmd: commands.AllocateOrder,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> Dict[str, Optional[str]]:
+    """
+    Allocate every line of an order in one transaction, returning the batchref
+    per sku (None where out of stock). Every product's version is checked on
+    commit, so a concurrent change to any of them retries the whole order.
+    """
+    with uow:
+        products = uow.products.get_many(cmd.lines)
+        for sku in cmd.lines:
+            if sku not in products:
+                raise InvalidSku(f"Invalid sku {sku}")
+        lines = [OrderLine(cmd.orderid, sku, qty) for sku, qty in cmd.lines.items()]
+        allocated = uow.products.allocated_batchrefs(lines)
+        batchrefs = {
+            line.sku: allocated.get(line) or products[line.sku].allocate(line)
+            for line in lines
+        }
+        uow.commit()
+    return batchrefs
 
 
+@retry_on_conflict
 def change_batch_quantity(
     cmd: commands.ChangeBatchQuantity,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -60,6 +247,48 @@ def change_batch_quantity(
         uow.commit()
 
 
+def change_batch_quantities(
+    cmd: commands.ChangeBatchQuantities,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    committed = []  # type: List[model.Product]
+    with uow:
+        changes_by_sku = {}  # type: Dict[str, List[commands.ChangeBatchQuantity]]
+        products = {}  # type: Dict[str, model.Product]
+        for change in cmd.changes:
+            product = uow.products.get_by_batchref(batchref=change.ref)
+            if product is None:
+                # checked before the first commit, so one bad ref doesn't
+                # leave the batch half applied
+                logger.warning("skipping change to unknown batch %s", change.ref)
+                continue
+            products[product.sku] = product
+            changes_by_sku.setdefault(product.sku, []).append(change)
+        groups = list(changes_by_sku.items())
+        for n, (sku, changes) in enumerate(groups):
+            product = products[sku]
+            for change in changes:
+                product.change_batch_quantity(ref=change.ref, qty=change.qty)
+            if not _committed("change_batch_quantities", uow):
+                conflicted = [changes for _, changes in groups[n:]]
+                break
+            committed.append(product)
+        else:
+            return
+
+    groups = [functools.partial(_change_quantities, changes) for changes in conflicted]
+    _retry_groups("change_batch_quantities", uow, groups, committed)
+
+
+def _change_quantities(changes, uow) -> model.Product:
+    with uow:
+        product = uow.products.get_by_batchref(batchref=changes[0].ref)
+        for change in changes:
+            product.change_batch_quantity(ref=change.ref, qty=change.qty)
+        uow.commit()
+    return product
+
+
 # pylint: disable=unused-argument
 
 
@@ -67,7 +296,7 @@ def send_out_of_stock_notification(
     event: events.OutOfStock,
     notifications: notifications.AbstractNotifications,
 ):
-    notifications.send(
+    return notifications.send(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
@@ -77,47 +306,123 @@ def publish_allocated_event(
     event: events.Allocated,
     publish: Callable,
 ):
-    publish("line_allocated", event)
+    return publish("line_allocated", event)
 
 
 def add_allocation_to_read_model(
     event: events.Allocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    projector: projector.AllocationsViewProjector,
 ):
-    with uow:
-        uow.session.execute(
-            """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """,
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
-        )
-        uow.commit()
+    projector.add(event)
 
 
 def remove_allocation_from_read_model(
     event: events.Deallocated,
+    projector: projector.AllocationsViewProjector,
+):
+    projector.remove(event)
+
+
+def invalidate_cached_allocations(
+    event: events.Allocated | events.Deallocated,
+    allocations_cache: view_cache.AllocationsCache,
+):
+    allocations_cache.invalidate(event.orderid)
+
+
+def rebuild_allocations_view(
+    cmd: commands.RebuildAllocationsView,
     uow: unit_of_work.SqlAlchemyUnitOfWork,
+    allocations_cache: view_cache.AllocationsCache,
 ):
     with uow:
+        uow.session.execute(text("DELETE FROM allocations_view"))
         uow.session.execute(
-            """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """,
-            dict(orderid=event.orderid, sku=event.sku),
+            text(
+                """
+                INSERT INTO allocations_view (orderid, sku, batchref)
+                SELECT ol.orderid, ol.sku, b.reference
+                FROM allocations AS a
+                JOIN order_lines AS ol ON a.orderline_id = ol.id
+                JOIN batches AS b ON a.batch_id = b.id
+                """
+            )
         )
         uow.commit()
+    allocations_cache.clear()
+
+
+def verify_allocated_quantities(
+    cmd: commands.VerifyAllocatedQuantities,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+) -> Dict[str, Dict[str, int]]:
+    """
+    Recompute batches.allocated_quantity from the allocations table and fix
+    any batch where it has drifted, returning what was stored and the actual
+    quantity per batchref. The fixed products' versions are bumped, so a
+    writer still holding the drifted value loses its commit and retries.
+    """
+    with uow:
+        drifted = uow.session.execute(
+            text(
+                """
+                SELECT b.reference, b.sku, b.allocated_quantity AS stored,
+                       COALESCE(SUM(ol.qty), 0) AS actual
+                FROM batches AS b
+                LEFT JOIN allocations AS a ON a.batch_id = b.id
+                LEFT JOIN order_lines AS ol ON a.orderline_id = ol.id
+                GROUP BY b.id, b.reference, b.sku, b.allocated_quantity
+                HAVING b.allocated_quantity != COALESCE(SUM(ol.qty), 0)
+                """
+            )
+        ).fetchall()
+        if drifted:
+            uow.session.execute(
+                text(
+                    "UPDATE batches SET allocated_quantity = :actual"
+                    " WHERE reference = :reference"
+                ),
+                [dict(reference=row.reference, actual=row.actual) for row in drifted],
+            )
+            uow.session.execute(
+                text(
+                    "UPDATE products SET version_number = version_number + 1"
+                    " WHERE sku = :sku"
+                ),
+                [dict(sku=sku) for sku in {row.sku for row in drifted}],
+            )
+            logger.warning("fixed allocated_quantity of %d batches", len(drifted))
+        uow.commit()
+    return {
+        row.reference: dict(stored=row.stored, actual=row.actual) for row in drifted
+    }
+
 
+# events the outbox relay publishes when bootstrapped with use_outbox=True
+OUTBOX_CHANNELS = {
+    events.Allocated: "line_allocated",
+}  # type: Dict[Type[events.Event], str]
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [
+        publish_allocated_event,
+        add_allocation_to_read_model,
+        invalidate_cached_allocations,
+    ],
+    events.Deallocated: [
+        remove_allocation_from_read_model,
+        invalidate_cached_allocations,
+    ],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.AllocateOrder: allocate_order,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ChangeBatchQuantities: change_batch_quantities,
+    commands.RebuildAllocationsView: rebuild_allocations_view,
+    commands.VerifyAllocatedQuantities: verify_allocated_quantities,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import abc
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, Type
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+
+class AbstractBusInstrumentation(abc.ABC):
+    """
+    Hooks a MessageBus or AsyncMessageBus calls when given an
+    instrumentation. Handlers are
+    wrapped once, when the bus is built, so a bus without one runs the
+    handlers exactly as before.
+    """
+
+    def wrap_handler(self, message_type: Type, handler: Callable) -> Callable:
+        message = message_type.__name__
+        name = getattr(handler, "__name__", repr(handler))
+
+        @functools.wraps(handler)
+        def timed(msg):
+            started = time.perf_counter()
+            try:
+                result = handler(msg)
+            except Exception:
+                self.handler_finished(
+                    message, name, time.perf_counter() - started, True
+                )
+                raise
+            if inspect.isawaitable(result):
+                # an AsyncMessageBus handler: timed until it is done
+                return self._timed_await(result, message, name, started)
+            self.handler_finished(message, name, time.perf_counter() - started, False)
+            return result
+
+        return timed
+
+    async def _timed_await(self, result, message: str, name: str, started: float):
+        try:
+            result = await result
+        except Exception:
+            self.handler_finished(message, name, time.perf_counter() - started, True)
+            raise
+        self.handler_finished(message, name, time.perf_counter() - started, False)
+        return result
+
+    def wrap_handlers(
+        self,
+        event_handlers: Dict[Type, List[Callable]],
+        command_handlers: Dict[Type, Callable],
+    ) -> Tuple[Dict[Type, List[Callable]], Dict[Type, Callable]]:
+        return (
+            {
+                event_type: [self.wrap_handler(event_type, h) for h in hs]
+                for event_type, hs in event_handlers.items()
+            },
+            {
+                command_type: self.wrap_handler(command_type, h)
+                for command_type, h in command_handlers.items()
+            },
+        )
+
+    @abc.abstractmethod
+    def handler_finished(
+        self, message: str, handler: str, seconds: float, failed: bool
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def message_handled(
+        self, message_type: Type, seconds: float, fanout: int, queue_depth: int
+    ):
+        """fanout is how many new events the message queued, queue_depth the
+        queue length afterwards."""
+        raise NotImplementedError
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class BusMetrics(AbstractBusInstrumentation):
+    """
+    Keeps per-message-type and per-handler timing histograms, handler error
+    counts, cascade fan-out and the queue depth high-water mark, for the
+    Flask app's /metrics endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.message_seconds = defaultdict(Histogram)  # type: Dict[str, Histogram]
+        # both keyed by (message type, handler name)
+        self.handler_seconds = defaultdict(Histogram)
+        self.handler_errors = defaultdict(int)
+        fanout_histogram = functools.partial(Histogram, FANOUT_BUCKETS)
+        self.fanout = defaultdict(fanout_histogram)  # type: Dict[str, Histogram]
+        self.queue_depth_max = 0
+
+    def handler_finished(self, message, handler, seconds, failed):
+        with self._lock:
+            self.handler_seconds[message, handler].observe(seconds)
+            if failed:
+                self.handler_errors[message, handler] += 1
+
+    def message_handled(self, message_type, seconds, fanout, queue_depth):
+        message = message_type.__name__
+        with self._lock:
+            self.message_seconds[message].observe(seconds)
+            self.fanout[message].observe(fanout)
+            self.queue_depth_max = max(self.queue_depth_max, queue_depth)
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            lines = []
+            lines += _histogram(
+                "allocation_bus_message_seconds",
+                "Time to handle a message, excluding the events it queued",
+                {(("message", m),): h for m, h in self.message_seconds.items()},
+            )
+            lines += _histogram(
+                "allocation_bus_handler_seconds",
+                "Time spent in each message handler",
+                {
+                    (("message", m), ("handler", name)): h
+                    for (m, name), h in self.handler_seconds.items()
+                },
+            )
+            lines += _histogram(
+                "allocation_bus_cascade_fanout",
+                "Events queued by handling one message",
+                {(("message", m),): h for m, h in self.fanout.items()},
+            )
+            lines += _metric(
+                "allocation_bus_handler_errors_total",
+                "counter",
+                "Exceptions raised by each message handler",
+                {
+                    (("message", m), ("handler", name)): count
+                    for (m, name), count in self.handler_errors.items()
+                },
+            )
+            lines += _metric(
+                "allocation_bus_queue_depth_max",
+                "gauge",
+                "Longest the message queue has been",
+                {(): self.queue_depth_max},
+            )
+            return "\n".join(lines) + "\n"
+
+
+def prometheus_metric(name, kind, help_text, samples) -> str:
+    """Render one metric, with samples keyed by ((label, value), ...) tuples."""
+    return "\n".join(_metric(name, kind, help_text, samples)) + "\n"
+
+
+def _metric(name, kind, help_text, samples) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in samples.items()]
+    return lines
+
+
+def _histogram(name, help_text, histograms) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in histograms.items():
+        for bound, count in histogram.cumulative():
+            lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{{{pairs}}}" if pairs else ""
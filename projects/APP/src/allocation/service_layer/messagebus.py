@@ -1,12 +1,27 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
 
+import asyncio
+import copy
+import inspect
 import logging
-from typing import TYPE_CHECKING, Callable, Dict, List, Type, Union
+import time
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Type,
+    Union,
+)
 
 from allocation.domain import commands, events
 
 if TYPE_CHECKING:
+    from . import instrumentation as bus_instrumentation
     from . import unit_of_work
 
 logger = logging.getLogger(__name__)
@@ -20,21 +35,57 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        flushers: Sequence[Callable] = (),
+        instrumentation: bus_instrumentation.AbstractBusInstrumentation = None,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        # called once the queue is drained, e.g. to write buffered projections
+        self.flushers = flushers
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self.event_handlers, self.command_handlers = instrumentation.wrap_handlers(
+                event_handlers, command_handlers
+            )
 
-    def handle(self, message: Message):
+    def handle(self, message: Message) -> List:
+        results = []
         self.queue = [message]
+        instrumentation = self.instrumentation
         while self.queue:
             message = self.queue.pop(0)
+            if instrumentation is not None:
+                depth, started = len(self.queue), time.perf_counter()
             if isinstance(message, events.Event):
                 self.handle_event(message)
             elif isinstance(message, commands.Command):
-                self.handle_command(message)
+                results.append(self.handle_command(message))
             else:
                 raise Exception(f"{message} was not an Event or Command")
+            if instrumentation is not None:
+                instrumentation.message_handled(
+                    type(message),
+                    time.perf_counter() - started,
+                    len(self.queue) - depth,
+                    len(self.queue),
+                )
+        self.flush()
+        return results
+
+    def flush(self):
+        for flusher in self.flushers:
+            try:
+                flusher()
+            except Exception:
+                logger.exception("Exception flushing %s", flusher)
+
+    def fork(self) -> MessageBus:
+        """
+        A bus with the same handlers and its own queue, for handling a
+        message while this one may be handling another.
+        """
+        return copy.copy(self)
 
     def handle_event(self, event: events.Event):
         for handler in self.event_handlers[type(event)]:
@@ -50,8 +101,126 @@ class MessageBus:
         logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
+            result = handler(command)
+            self.queue.extend(self.uow.collect_new_events())
+            return result
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
+
+
+class AsyncMessageBus:
+    """
+    Runs commands one at a time like MessageBus, but lets event handlers that
+    return awaitables (the async notifications and publish adapters) run
+    concurrently, with at most `event_concurrency[event_type]` (or
+    `default_concurrency`) in flight per event type. Plain handlers still run
+    inline, in order, since they share the unit of work.
+    """
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        event_concurrency: Optional[Dict[Type[events.Event], int]] = None,
+        default_concurrency: int = 10,
+        flushers: Sequence[Callable] = (),
+        instrumentation: bus_instrumentation.AbstractBusInstrumentation = None,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.flushers = flushers
+        # async handlers are timed until they finish, not just until they return
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self.event_handlers, self.command_handlers = instrumentation.wrap_handlers(
+                event_handlers, command_handlers
+            )
+        self.event_concurrency = event_concurrency or {}
+        self.default_concurrency = default_concurrency
+        self._semaphores = {}  # type: Dict[Type[events.Event], asyncio.Semaphore]
+        self._semaphores_loop = None
+
+    async def handle(self, message: Message) -> List:
+        results = []
+        self.queue = [message]
+        pending = set()  # type: Set[asyncio.Task]
+        instrumentation = self.instrumentation
+        while self.queue or pending:
+            while self.queue:
+                message = self.queue.pop(0)
+                if instrumentation is not None:
+                    depth, started = len(self.queue), time.perf_counter()
+                if isinstance(message, events.Event):
+                    pending.update(self.handle_event(message))
+                elif isinstance(message, commands.Command):
+                    results.append(await self.handle_command(message))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+                if instrumentation is not None:
+                    instrumentation.message_handled(
+                        type(message),
+                        time.perf_counter() - started,
+                        len(self.queue) - depth,
+                        len(self.queue),
+                    )
+            if pending:
+                _, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                self.queue.extend(self.uow.collect_new_events())
+        self.flush()
+        return results
+
+    def flush(self):
+        for flusher in self.flushers:
+            try:
+                flusher()
+            except Exception:
+                logger.exception("Exception flushing %s", flusher)
+
+    def handle_event(self, event: events.Event) -> List[asyncio.Task]:
+        tasks = []
+        for handler in self.event_handlers[type(event)]:
+            try:
+                logger.debug("handling event %s with handler %s", event, handler)
+                result = handler(event)
+                if inspect.isawaitable(result):
+                    tasks.append(asyncio.ensure_future(self._await(result, event)))
+                self.queue.extend(self.uow.collect_new_events())
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+                continue
+        return tasks
+
+    async def _await(self, result, event: events.Event):
+        async with self._semaphore(type(event)):
+            try:
+                await result
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+
+    def _semaphore(self, event_type: Type[events.Event]) -> asyncio.Semaphore:
+        # semaphores belong to the event loop they were first used on
+        loop = asyncio.get_running_loop()
+        if self._semaphores_loop is not loop:
+            self._semaphores, self._semaphores_loop = {}, loop
+        if event_type not in self._semaphores:
+            limit = self.event_concurrency.get(event_type, self.default_concurrency)
+            self._semaphores[event_type] = asyncio.Semaphore(limit)
+        return self._semaphores[event_type]
+
+    async def handle_command(self, command: commands.Command):
+        logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handlers[type(command)]
+            result = handler(command)
+            if inspect.isawaitable(result):
+                result = await result
             self.queue.extend(self.uow.collect_new_events())
+            return result
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
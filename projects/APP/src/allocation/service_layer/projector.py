@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import logging
+from itertools import groupby
+from typing import TYPE_CHECKING, List, Tuple
+
+from allocation.domain import events
+from sqlalchemy import text
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+INSERT_ALLOCATION = text(
+    """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+    """
+)
+
+DELETE_ALLOCATION = text(
+    """
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku
+    """
+)
+
+
+class AllocationsViewProjector:
+    """
+    Buffers Allocated/Deallocated events and writes them to allocations_view
+    in one transaction per flush, with one executemany per run of consecutive
+    inserts or deletes (so a deallocation followed by a reallocation of the
+    same line is still applied in order).
+    """
+
+    def __init__(self, uow: unit_of_work.SqlAlchemyUnitOfWork, max_buffer=1000):
+        self.uow = uow
+        self.max_buffer = max_buffer
+        self._buffer = []  # type: List[Tuple[object, dict]]
+
+    def add(self, event: events.Allocated):
+        self._append(
+            INSERT_ALLOCATION,
+            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+        )
+
+    def remove(self, event: events.Deallocated):
+        self._append(DELETE_ALLOCATION, dict(orderid=event.orderid, sku=event.sku))
+
+    def _append(self, statement, params):
+        self._buffer.append((statement, params))
+        if len(self._buffer) >= self.max_buffer:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        # taken before writing, as changes may be added while this one waits
+        # on the database, and put back ahead of them if it fails
+        buffered, self._buffer = self._buffer, []
+        try:
+            with self.uow:
+                for statement, run in groupby(buffered, key=lambda op: op[0]):
+                    self.uow.session.execute(statement, [params for _, params in run])
+                self.uow.commit()
+        except Exception:
+            self._buffer[:0] = buffered
+            raise
+        logger.debug("flushed %d allocations_view changes", len(buffered))
+
+
+class InMemoryAllocationsViewProjector:
+    """The same interface, for an InMemoryUnitOfWork's allocations view."""
+
+    def __init__(self, uow: unit_of_work.InMemoryUnitOfWork):
+        self.uow = uow
+
+    def add(self, event: events.Allocated):
+        self.uow.store.allocations_view[event.orderid][event.sku] = event.batchref
+
+    def remove(self, event: events.Deallocated):
+        self.uow.store.allocations_view[event.orderid].pop(event.sku, None)
+
+    def flush(self):
+        pass
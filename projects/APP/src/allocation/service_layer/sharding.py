@@ -0,0 +1,177 @@
+"""
+SKU-sharded allocation: a pool of worker processes, each owning the SKUs
+that hash to it and keeping those Product aggregates resident, with a router
+that sends every command to its owner.
+"""
+# pylint: disable=broad-except
+from __future__ import annotations
+
+import functools
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Dict, List
+
+from allocation.domain import commands
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+
+def shard_for(sku: str, num_shards: int) -> int:
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(sku.encode()) % num_shards
+
+
+class ShardedMessageBus:
+    """
+    Routes Allocate/CreateBatch/ChangeBatchQuantity commands to the worker
+    that owns their SKU. handle() waits for the result like MessageBus;
+    submit() returns a Future so callers can keep every shard busy. Results
+    arrive once the shard has written them: every `flush_every` commands,
+    or as soon as it runs out of commands to handle.
+    With side_effects=False the workers don't send email or publish to Redis
+    (for benchmarks and tests).
+    """
+
+    def __init__(
+        self, db_uri: str, num_shards: int, flush_every=100, side_effects=True
+    ):
+        self.db_uri = db_uri
+        self.num_shards = num_shards
+        self._engine = create_engine(db_uri)
+        self._batch_skus = {}  # type: Dict[str, str]
+        self._ids = itertools.count()
+        self._futures = {}  # type: Dict[int, Future]
+        self._lock = threading.Lock()
+        ctx = multiprocessing.get_context("spawn")
+        self._results = ctx.Queue()
+        self._inboxes = [ctx.Queue() for _ in range(num_shards)]
+        self._workers = [
+            ctx.Process(
+                target=_worker_main,
+                args=(db_uri, inbox, self._results, flush_every, side_effects),
+                daemon=True,
+            )
+            for inbox in self._inboxes
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _sku_for(self, command: commands.Command) -> str:
+        if isinstance(command, (commands.Allocate, commands.CreateBatch)):
+            if isinstance(command, commands.CreateBatch):
+                self._batch_skus[command.ref] = command.sku
+            return command.sku
+        if isinstance(command, commands.ChangeBatchQuantity):
+            if command.ref not in self._batch_skus:
+                with self._engine.connect() as conn:
+                    sku = conn.execute(
+                        text("SELECT sku FROM batches WHERE reference = :ref"),
+                        dict(ref=command.ref),
+                    ).scalar()
+                self._batch_skus[command.ref] = sku or ""
+            return self._batch_skus[command.ref]
+        raise TypeError(f"{command} can't be routed to a shard")
+
+    def submit(self, command: commands.Command) -> Future:
+        shard = shard_for(self._sku_for(command), self.num_shards)
+        future = Future()  # type: Future
+        with self._lock:
+            message_id = next(self._ids)
+            self._futures[message_id] = future
+        self._inboxes[shard].put((message_id, command))
+        return future
+
+    def handle(self, command: commands.Command) -> List:
+        return self.submit(command).result()
+
+    def _collect(self):
+        while True:
+            item = self._results.get()
+            if item is _STOP:
+                return
+            message_id, ok, payload = item
+            with self._lock:
+                future = self._futures.pop(message_id)
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+    def close(self):
+        """Flush every shard's pending writes and stop the workers."""
+        for inbox in self._inboxes:
+            inbox.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(_STOP)
+        self._collector.join()
+        self._engine.dispose()
+
+
+def _no_side_effect(*args):
+    pass
+
+
+def _report(results, message_id, result, error):
+    if error is None:
+        results.put((message_id, True, result))
+    else:
+        results.put((message_id, False, error))
+
+
+def _flush(uow):
+    try:
+        uow.flush()
+    except Exception:
+        logger.exception("Exception flushing shard")
+
+
+def _worker_main(db_uri, inbox, results, flush_every, side_effects):
+    # pylint: disable=import-outside-toplevel
+    # imported here so the router process never needs mappers of its own
+    from allocation import bootstrap
+    from allocation.adapters.notifications import NullNotifications
+    from allocation.service_layer import unit_of_work
+
+    uow = unit_of_work.WriteBehindUnitOfWork(
+        sessionmaker(bind=create_engine(db_uri)), flush_every=flush_every
+    )
+    options = {}
+    if not side_effects:
+        options = dict(notifications=NullNotifications(), publish=_no_side_effect)
+    bus = bootstrap.bootstrap(start_orm=True, uow=uow, **options)
+    # write projections behind too, instead of after every message
+    uow.before_flush, bus.flushers = list(bus.flushers), []
+    while True:
+        try:
+            item = inbox.get_nowait()
+        except queue.Empty:
+            # idle: write what's pending rather than keep its callers waiting
+            if uow.pending:
+                _flush(uow)
+            item = inbox.get()
+        if item is _STOP:
+            break
+        message_id, command = item
+        try:
+            result = bus.handle(command)
+        except Exception as e:
+            results.put((message_id, False, e))
+        else:
+            # reported once written, as a failed flush loses it
+            uow.when_flushed(functools.partial(_report, results, message_id, result))
+    try:
+        uow.flush()
+    except Exception:
+        logger.exception("Exception flushing shard on shutdown")
@@ -2,12 +2,27 @@
 from __future__ import annotations
 
 import abc
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Set, Type
 
 from allocation import config
-from allocation.adapters import repository
-from sqlalchemy import create_engine
+from allocation.adapters import engine, memory_store, orm, repository
+from allocation.domain import events
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
+from sqlalchemy.util import await_only, greenlet_spawn
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentModification(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -36,24 +51,55 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        # substituting POSTGRES with the in-memory sqlite
-        # config.get_postgres_uri(),
-        "sqlite+pysqlite:///:memory:",
-        echo=True,
-        isolation_level="REPEATABLE READ",
-    )
-)
+@functools.lru_cache(maxsize=None)
+def default_session_factory():
+    """Built on first use, so importing this module doesn't create an engine."""
+    # the engine profile comes from ENGINE_PROFILE, see config.get_engine_profile
+    return sessionmaker(bind=engine.make_engine())
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_session_factory():
+    """The asyncio counterpart of default_session_factory()."""
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    return sessionmaker(bind=engine.make_async_engine(), class_=AsyncSession)
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=None,
+        outbox_channels: Optional[Dict[Type[events.Event], str]] = None,
+        loading: str = "selectin",
+        raise_on_lazy: bool = False,
+        product_cache: Optional[repository.ProductCache] = None,
+    ):
         self.session_factory = session_factory
+        self.loading = loading
+        self.raise_on_lazy = raise_on_lazy
+        self.product_cache = product_cache
+        # events of these types are written to the outbox table on commit,
+        # for the outbox relay to publish on the given channel
+        self.outbox_channels = outbox_channels
 
     def __enter__(self):
+        if self.session_factory is None:
+            self.session_factory = default_session_factory()
         self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if self.product_cache is not None:
+            self.products = repository.CachingSqlAlchemyRepository(
+                self.session,
+                self.product_cache,
+                loading=self.loading,
+                raise_on_lazy=self.raise_on_lazy,
+            )
+        else:
+            self.products = repository.SqlAlchemyRepository(
+                self.session, loading=self.loading, raise_on_lazy=self.raise_on_lazy
+            )
+        # keyed by id() and holding the event, so ids can't be reused meanwhile
+        self._outboxed = {}  # type: Dict[int, events.Event]
         return super().__enter__()
 
     def __exit__(self, *args):
@@ -61,7 +107,300 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        if self.outbox_channels:
+            self._write_outbox()
+        snapshots = []
+        try:
+            if self.product_cache is not None:
+                # taken after the flush, so new rows have their ids, and
+                # before the commit expires everything
+                self.session.flush()
+                snapshots = self.products.snapshots()
+            self.session.commit()
+        except StaleDataError as e:
+            if self.product_cache is not None:
+                # someone else committed a newer version of some of these
+                self.products.invalidate_snapshots()
+            raise ConcurrentModification(str(e)) from e
+        # the committed versions replace whatever the cache held for them
+        for snapshot in snapshots:
+            self.product_cache.put(snapshot)
+
+    def _write_outbox(self):
+        rows = []
+        for product in self.products.seen:
+            for event in product.events:
+                channel = self.outbox_channels.get(type(event))
+                if channel and id(event) not in self._outboxed:
+                    self._outboxed[id(event)] = event
+                    rows.append(
+                        dict(channel=channel, payload=json.dumps(asdict(event)))
+                    )
+        if rows:
+            self.session.execute(orm.outbox.insert(), rows)
 
     def rollback(self):
         self.session.rollback()
+
+
+class WriteBehindUnitOfWork(AbstractUnitOfWork):
+    """
+    A single long-lived session whose Products stay resident between
+    messages. commit() only counts the change; everything is written to the
+    database every `flush_every` commits, or when flush() is called, after
+    running the `before_flush` callbacks (e.g. buffered projections). A
+    caller shouldn't report a command done until when_flushed() says its
+    changes were written, since a failed flush loses every commit since the
+    last one.
+
+    A message that fails without committing has its changes undone by
+    dropping the Products it touched, to be reloaded. If one of them also
+    holds commits that aren't flushed yet, those can't be told apart and
+    are lost with it, as in a failed flush.
+
+    Only safe while this process is the sole writer for the SKUs it loads,
+    as in a SKU-sharded worker.
+    """
+
+    def __init__(self, session_factory, flush_every=100):
+        # no autoflush, so nothing holds a write transaction between flushes
+        self.session = session_factory(
+            expire_on_commit=False, autoflush=False
+        )  # type: Session
+        self.products = repository.ResidentSqlAlchemyRepository(self.session)
+        self.flush_every = flush_every
+        self.before_flush = []  # type: List[Callable]
+        self.pending = 0
+        self._flushing = False
+        self._unflushed_skus = set()  # type: Set[str]
+        self._waiting = []  # type: List[Callable[[Optional[Exception]], None]]
+
+    def __enter__(self):
+        # only the products touched by this message should yield events
+        self.products.seen = set()
+        self._committed = set()
+        return super().__enter__()
+
+    def _commit(self):
+        for product in self.products.seen:
+            self.products.remember(product)
+            self._unflushed_skus.add(product.sku)
+        self._committed.update(self.products.seen)
+        self.pending += 1
+        if self.pending >= self.flush_every and not self._flushing:
+            self.flush()
+
+    def when_flushed(self, callback: Callable[[Optional[Exception]], None]):
+        """
+        Call callback(None) once everything committed so far is written, or
+        callback(error) if it is lost instead.
+        """
+        if self.pending:
+            self._waiting.append(callback)
+        else:
+            callback(None)
+
+    def flush(self):
+        self._flushing = True
+        try:
+            for callback in self.before_flush:
+                callback()
+            self.session.commit()
+        except StaleDataError as e:
+            # someone else wrote our SKUs; drop what we hold and reload
+            error = ConcurrentModification(str(e))
+            self._discard(error)
+            raise error from e
+        finally:
+            self._flushing = False
+        self._flushed(None)
+
+    def rollback(self):
+        uncommitted = self.products.seen - self._committed
+        if not uncommitted:
+            return
+        if any(p.sku in self._unflushed_skus for p in uncommitted):
+            logger.warning(
+                "dropping %d unflushed commits with a failed message", self.pending
+            )
+            self._discard(
+                ConcurrentModification("dropped with a failed message's changes")
+            )
+            return
+        skus = {product.sku for product in uncommitted}
+        for product in uncommitted:
+            self.products.forget(product)
+        # Products, Batches and OrderLines alike, new or loaded
+        for obj in list(self.session):
+            if getattr(obj, "sku", None) in skus:
+                self.session.expunge(obj)
+
+    def _discard(self, error: Exception):
+        self.session.rollback()
+        self.session.expunge_all()
+        self.products.forget_all()
+        self._flushed(error)
+
+    def _flushed(self, error: Optional[Exception]):
+        self.pending = 0
+        self._unflushed_skus.clear()
+        waiting, self._waiting = self._waiting, []
+        for callback in waiting:
+            callback(error)
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    """
+    Products kept in process memory, for running without a database. Each
+    unit of work loads private copies of the Products it touches; commit()
+    stores copies of the changed ones, unless another unit of work has
+    committed them since they were loaded. Nothing is written until then,
+    so a unit of work that isn't committed leaves no trace.
+
+    Command handlers wrapped with journaled() run one at a time. With a
+    directory, each command is journaled before it runs. The store writes a
+    snapshot every snapshot_every commands, and recover() rebuilds the
+    store from the snapshot and the journal. The allocations read model
+    lives in the store too; the SQL maintenance commands
+    (RebuildAllocationsView, VerifyAllocatedQuantities) aren't supported.
+    """
+
+    def __init__(self, store: memory_store.InMemoryStore = None):
+        self.store = store or memory_store.InMemoryStore()
+        self.products = repository.InMemoryRepository(self.store)
+
+    def __enter__(self):
+        self.products = repository.InMemoryRepository(self.store)
+        return super().__enter__()
+
+    def _commit(self):
+        try:
+            self.store.commit(self.products.changes())
+        except memory_store.VersionConflict as e:
+            raise ConcurrentModification(str(e)) from e
+        self.products.committed()
+
+    def rollback(self):
+        # uncommitted copies are simply dropped with the repository
+        pass
+
+    def journaled(self, handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def journaled_handler(cmd):
+            with self.store.lock:
+                self.store.record(cmd)
+                result = handler(cmd)
+            self.store.snapshot_if_due()
+            return result
+
+        return journaled_handler
+
+    def recover(self, command_handlers: Dict[Type, Callable]) -> int:
+        """
+        Load the last snapshot and replay the journaled commands after it
+        with command_handlers, which must not have side effects outside this
+        unit of work. Returns how many commands were replayed.
+        """
+        pending = self.store.load()
+        for cmd in pending:
+            try:
+                command_handlers[type(cmd)](cmd)
+            except Exception:  # pylint: disable=broad-except
+                # it failed the first time too, with the same state
+                logger.debug("replayed %s failed", cmd, exc_info=True)
+        self.store.rebuild_allocations_view()
+        logger.info("replayed %d journaled commands", len(pending))
+        return len(pending)
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    """
+    A SqlAlchemyUnitOfWork for asyncio code, over SQLAlchemy's asyncio
+    extension. The handlers stay synchronous: run() calls one, or a whole
+    MessageBus.handle(), in a greenlet, where each `with uow:` opens an
+    AsyncSession and every query hands the event loop back while it waits
+    for the database.
+
+    One instance serves any number of concurrent tasks. The session and
+    repository are kept per task, in context variables, which SQLAlchemy
+    carries into the greenlet.
+
+    SQLite takes one writer at a time, and makes the others sleep and retry
+    in its busy handler, so on SQLite (unless `serialize` says otherwise)
+    units of work take turns, queueing on the event loop instead.
+    """
+
+    def __init__(
+        self,
+        session_factory=None,
+        loading: str = "selectin",
+        serialize: Optional[bool] = None,
+    ):
+        self.session_factory = session_factory
+        self.loading = loading
+        self.serialize = serialize
+        self._session = contextvars.ContextVar("session", default=None)
+        self._products = contextvars.ContextVar("products", default=None)
+        self._lock = None  # type: Optional[asyncio.Lock]
+        self._lock_loop = None
+
+    async def run(self, fn: Callable, *args):
+        """Await fn(*args), run where this unit of work can be used."""
+        if self.session_factory is None:
+            self.session_factory = default_async_session_factory()
+        return await greenlet_spawn(fn, *args)
+
+    @property
+    def session(self) -> Session:
+        session = self._session.get()
+        if session is None:
+            raise RuntimeError("only usable inside `with uow:` within run()")
+        return session.sync_session
+
+    @property
+    def products(self) -> repository.SqlAlchemyRepository:
+        products = self._products.get()
+        if products is None:
+            raise RuntimeError("only usable inside `with uow:` within run()")
+        return products
+
+    def __enter__(self):
+        session = self.session_factory()
+        if self.serialize is None:
+            self.serialize = session.sync_session.get_bind().dialect.name == "sqlite"
+        if self.serialize:
+            await_only(self._turn().acquire())
+        self._session.set(session)
+        self._products.set(
+            repository.SqlAlchemyRepository(self.session, loading=self.loading)
+        )
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        try:
+            super().__exit__(*args)
+            self.session.close()
+        finally:
+            self._session.set(None)
+            if self.serialize:
+                self._lock.release()
+
+    def _turn(self) -> asyncio.Lock:
+        # a lock belongs to the event loop it was first used on
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    def _commit(self):
+        try:
+            self.session.commit()
+        except StaleDataError as e:
+            raise ConcurrentModification(str(e)) from e
+
+    def rollback(self):
+        self.session.rollback()
+
+    def sleep(self, seconds: float):
+        """Waits without blocking the event loop, e.g. before a retry."""
+        await_only(asyncio.sleep(seconds))
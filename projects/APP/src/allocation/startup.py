@@ -0,0 +1,40 @@
+import logging
+import time
+from typing import List, Tuple
+
+import allocation
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Records how long each phase of startup took. The clock starts when the
+    allocation package was first imported, so the first mark() covers imports.
+    """
+
+    def __init__(self, started: float = None):
+        self.started = allocation.IMPORT_STARTED if started is None else started
+        self._last = self.started
+        self.phases = []  # type: List[Tuple[str, float]]
+
+    def mark(self, phase: str) -> float:
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self.phases.append((phase, elapsed))
+        self._last = now
+        return elapsed
+
+    @property
+    def total(self) -> float:
+        return self._last - self.started
+
+    def report(self) -> str:
+        lines = [
+            f"{phase:<24} {elapsed * 1000:8.1f} ms" for phase, elapsed in self.phases
+        ]
+        lines.append(f"{'total':<24} {self.total * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+    def log(self):
+        logger.info("startup timings:\n%s", self.report())
@@ -1,7 +1,25 @@
+from typing import Optional
+
+from allocation.adapters.view_cache import AllocationsCache
 from allocation.service_layer import unit_of_work
 
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+    orderid: str,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache: Optional[AllocationsCache] = None,
+):
+    if cache is not None:
+        return cache.get_or_load(orderid, lambda: _allocations(orderid, uow))
+    return _allocations(orderid, uow)
+
+
+def _allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    if isinstance(uow, unit_of_work.InMemoryUnitOfWork):
+        return [
+            dict(sku=sku, batchref=batchref)
+            for sku, batchref in uow.store.allocations_for(orderid)
+        ]
     with uow:
         results = uow.session.execute(
             """
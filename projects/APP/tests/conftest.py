@@ -2,6 +2,7 @@
 import shutil
 import subprocess
 import time
+from contextlib import contextmanager
 from pathlib import Path
 
 import pytest
@@ -9,7 +10,7 @@ import redis
 import requests
 from allocation import config
 from allocation.adapters.orm import mapper_registry, start_mappers
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import clear_mappers, sessionmaker
 from tenacity import retry, stop_after_delay
 
@@ -28,6 +29,30 @@ def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
 
+@pytest.fixture
+def assert_num_queries(in_memory_sqlite_db):
+    """
+    Usage: `with assert_num_queries(3): ...` fails unless exactly that many
+    SQL statements are sent to the in-memory database inside the block.
+    """
+
+    @contextmanager
+    def _assert_num_queries(expected):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(in_memory_sqlite_db, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(in_memory_sqlite_db, "before_cursor_execute", record)
+        assert len(statements) == expected, "\n\n".join(statements)
+
+    return _assert_num_queries
+
+
 @pytest.fixture
 def mappers():
     start_mappers()
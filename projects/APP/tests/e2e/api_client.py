@@ -25,6 +25,26 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_bulk(lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(f"{url}/allocate/bulk", json={"lines": lines})
+    if expect_success:
+        assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
+
+
+def get_metrics():
+    url = config.get_api_url()
+    return requests.get(f"{url}/metrics")
+
+
+def post_to_allocate_order(orderid, lines):
+    url = config.get_api_url()
+    r = requests.post(f"{url}/orders/{orderid}/allocate", json={"lines": lines})
+    assert r.status_code == 202
+    return r
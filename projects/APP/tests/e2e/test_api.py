@@ -40,3 +40,57 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("in_memory_sqlite_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocation_returns_a_batchref_per_line():
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    order1, order2 = random_orderid(1), random_orderid(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+
+    r = api_client.post_to_allocate_bulk(
+        [
+            {"orderid": order1, "sku": sku, "qty": 3},
+            {"orderid": order2, "sku": othersku, "qty": 5},
+        ]
+    )
+
+    assert [line["batchref"] for line in r.json()] == [batch, otherbatch]
+
+
+@pytest.mark.usefixtures("in_memory_sqlite_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_endpoint_reports_handler_timings():
+    sku, batch = random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(random_orderid(), sku, 3)
+
+    r = api_client.get_metrics()
+    assert r.ok
+    assert r.headers["Content-Type"].startswith("text/plain")
+    assert (
+        'allocation_bus_handler_seconds_count{message="Allocate",handler="allocate"}'
+        in r.text
+    )
+
+
+@pytest.mark.usefixtures("in_memory_sqlite_db")
+@pytest.mark.usefixtures("restart_api")
+def test_allocating_a_whole_order_returns_a_batchref_per_sku():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+
+    r = api_client.post_to_allocate_order(
+        orderid, [{"sku": sku, "qty": 3}, {"sku": othersku, "qty": 5}]
+    )
+
+    assert r.json() == {
+        "orderid": orderid,
+        "batchrefs": {sku: batch, othersku: otherbatch},
+    }
@@ -0,0 +1,134 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import json
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import engine
+from allocation.adapters.notifications import NullNotifications
+from allocation.adapters.orm import mapper_registry
+from allocation.entrypoints.asgi_app import AllocationApp
+from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def no_publish(*args):
+    pass
+
+
+@pytest.fixture
+def app(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    mapper_registry.metadata.create_all(create_engine(uri))
+    async_engine = engine.make_async_engine("prod-sqlite", uri=uri)
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(
+        sessionmaker(bind=async_engine, class_=AsyncSession)
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=NullNotifications(), publish=no_publish
+    )
+    yield AllocationApp(bus)
+    asyncio.run(async_engine.dispose())
+
+
+async def call(app, method, path, body=None):
+    received = [
+        {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+    ]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path}, receive, send)
+    start, response = sent
+    content = response["body"].decode()
+    if (b"content-type", b"application/json") in start["headers"]:
+        content = json.loads(content)
+    return start["status"], content
+
+
+async def add_batch(app, ref, sku, qty, eta=None):
+    status, _ = await call(
+        app, "POST", "/add_batch", dict(ref=ref, sku=sku, qty=qty, eta=eta)
+    )
+    assert status == 201
+
+
+def test_allocations_are_shown_in_the_view(app):
+    async def scenario():
+        await add_batch(app, "b-later", "LAMP", 100, "2030-01-01")
+        await add_batch(app, "b-stock", "LAMP", 100)
+        status, _ = await call(
+            app, "POST", "/allocate", dict(orderid="o1", sku="LAMP", qty=3)
+        )
+        assert status == 202
+        return await call(app, "GET", "/allocations/o1")
+
+    assert asyncio.run(scenario()) == (200, [{"sku": "LAMP", "batchref": "b-stock"}])
+
+
+def test_unknown_skus_and_orders(app):
+    async def scenario():
+        return (
+            await call(app, "POST", "/allocate", dict(orderid="o1", sku="NOPE", qty=1)),
+            await call(app, "GET", "/allocations/o1"),
+        )
+
+    invalid, missing = asyncio.run(scenario())
+
+    assert invalid == (400, {"message": "Invalid sku NOPE"})
+    assert missing == (404, "not found")
+
+
+def test_concurrent_requests_each_get_a_session(app):
+    async def scenario():
+        await add_batch(app, "b-stock", "LAMP", 100)
+        await add_batch(app, "b-table", "TABLE", 100)
+        responses = await asyncio.gather(
+            *(
+                call(
+                    app,
+                    "POST",
+                    "/allocate",
+                    dict(orderid=f"o{i}", sku="LAMP" if i % 2 else "TABLE", qty=1),
+                )
+                for i in range(20)
+            )
+        )
+        views = await asyncio.gather(
+            *(call(app, "GET", f"/allocations/o{i}") for i in range(20))
+        )
+        return responses, views
+
+    responses, views = asyncio.run(scenario())
+
+    assert {status for status, _ in responses} == {202}
+    assert [body for _, body in views] == [
+        [
+            {
+                "sku": "LAMP" if i % 2 else "TABLE",
+                "batchref": "b-stock" if i % 2 else "b-table",
+            }
+        ]
+        for i in range(20)
+    ]
+
+
+def test_the_session_is_only_there_inside_the_unit_of_work(app):
+    uow = app.uow
+
+    def use_session():
+        with uow:
+            uow.session.execute("SELECT 1")
+        return uow.session
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(uow.run(use_session))
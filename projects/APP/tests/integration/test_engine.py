@@ -0,0 +1,54 @@
+import pytest
+from allocation import config
+from allocation.adapters.engine import make_engine
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+def pragma(engine, name):
+    with engine.connect() as conn:
+        return conn.execute(text(f"PRAGMA {name}")).scalar()
+
+
+def test_prod_sqlite_profile_applies_pragmas_on_connect(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "allocation.db"))
+    engine = make_engine("prod-sqlite")
+
+    assert isinstance(engine.pool, QueuePool)
+    assert not engine.echo
+    assert pragma(engine, "journal_mode") == "wal"
+    assert pragma(engine, "synchronous") == 1  # NORMAL
+    assert pragma(engine, "cache_size") == -64_000
+    engine.dispose()
+
+
+def test_test_profile_shares_one_quiet_in_memory_connection():
+    engine = make_engine("test")
+
+    assert isinstance(engine.pool, StaticPool)
+    assert not engine.echo
+    assert pragma(engine, "synchronous") == 0  # OFF
+
+
+def test_the_default_profile_does_not_echo(monkeypatch):
+    monkeypatch.delenv("ENGINE_PROFILE", raising=False)
+    profile = config.get_engine_profile()
+
+    assert profile["name"] == "memory"
+    assert not profile["echo"]
+    assert config.get_engine_profile("dev")["echo"]
+
+
+def test_profile_is_picked_from_the_environment(monkeypatch):
+    monkeypatch.setenv("ENGINE_PROFILE", "prod-postgres")
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    profile = config.get_engine_profile()
+
+    assert profile["name"] == "prod-postgres"
+    assert profile["pool_size"] == 3
+    assert profile["pool_pre_ping"]
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError, match="Unknown engine profile"):
+        config.get_engine_profile("staging")
@@ -0,0 +1,116 @@
+# pylint: disable=redefined-outer-name
+import json
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.published = []
+        self.fail = fail
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.buffered = []
+
+    def publish(self, channel, message):
+        self.buffered.append((channel, message))
+
+    def execute(self):
+        if self.redis_client.fail:
+            raise ConnectionError("redis went away")
+        self.redis_client.published.extend(self.buffered)
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        use_outbox=True,
+    )
+    yield bus
+    clear_mappers()
+
+
+def outbox_rows(session_factory):
+    return list(session_factory().execute("SELECT channel, payload FROM outbox"))
+
+
+def test_allocated_events_are_written_to_the_outbox(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+
+    [(channel, payload)] = outbox_rows(sqlite_session_factory)
+    assert channel == "line_allocated"
+    assert json.loads(payload) == dict(orderid="o1", sku="sku1", qty=10, batchref="b1")
+
+
+def test_outbox_is_switched_on_by_config(monkeypatch, sqlite_session_factory):
+    monkeypatch.setenv("OUTBOX_ENABLED", "1")
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.Allocate("o1", "sku1", 10))
+    finally:
+        clear_mappers()
+
+    [(channel, _)] = outbox_rows(sqlite_session_factory)
+    assert channel == "line_allocated"
+
+
+def test_outbox_rows_are_written_once_per_event_across_commits(
+    outbox_bus, sqlite_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    outbox_bus.handle(commands.CreateBatch("b2", "sku2", 50, None))
+    outbox_bus.handle(
+        commands.AllocateMany(
+            [commands.Allocate("o1", "sku1", 10), commands.Allocate("o1", "sku2", 10)]
+        )
+    )
+
+    assert len(outbox_rows(sqlite_session_factory)) == 2
+
+
+def test_relay_publishes_in_batches_and_clears_the_outbox(
+    outbox_bus, sqlite_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    for i in range(3):
+        outbox_bus.handle(commands.Allocate(f"o{i}", "sku1", 1))
+    redis_client = FakeRedis()
+
+    assert outbox_relay.relay_batch(sqlite_session_factory, redis_client, 2) == 2
+    assert outbox_relay.relay_batch(sqlite_session_factory, redis_client, 2) == 1
+    assert outbox_relay.relay_batch(sqlite_session_factory, redis_client, 2) == 0
+
+    orderids = [json.loads(payload)["orderid"] for _, payload in redis_client.published]
+    assert orderids == ["o0", "o1", "o2"]
+    assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_relay_keeps_rows_if_publishing_fails(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 1))
+
+    with pytest.raises(ConnectionError):
+        outbox_relay.relay_batch(sqlite_session_factory, FakeRedis(fail=True), 10)
+
+    assert len(outbox_rows(sqlite_session_factory)) == 1
@@ -0,0 +1,201 @@
+import pytest
+from allocation.adapters import repository
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def cache():
+    return repository.ProductCache()
+
+
+def add_product(session_factory, sku="sku1", lines=3):
+    session = session_factory()
+    product = model.Product(
+        sku=sku,
+        batches=[
+            model.Batch("b-stock", sku, 100, eta=None),
+            model.Batch("b-later", sku, 100, eta=model.date(2030, 1, 1)),
+        ],
+    )
+    for i in range(lines):
+        product.allocate(model.OrderLine(f"o{i}", sku, 10))
+    session.add(product)
+    session.commit()
+
+
+def uow_with(session_factory, cache):
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=cache)
+
+
+def allocated_in_db(session, ref):
+    [[allocated]] = session.execute(
+        "SELECT allocated_quantity FROM batches WHERE reference = :ref",
+        dict(ref=ref),
+    )
+    [[lines]] = session.execute(
+        "SELECT COUNT(*) FROM allocations JOIN batches ON batch_id = batches.id"
+        " WHERE reference = :ref",
+        dict(ref=ref),
+    )
+    return allocated, lines
+
+
+def test_second_load_is_restored_after_one_version_query(
+    sqlite_session_factory, cache, assert_num_queries
+):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        # version, product, batches
+        with assert_num_queries(3):
+            uow.products.get("sku1")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        with assert_num_queries(1):
+            product = uow.products.get("sku1")
+            assert product.batches[0].available_quantity in (70, 100)
+
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hit_ratio"] == 0.5
+
+
+def test_changes_to_a_restored_product_are_persisted(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        product = uow.products.get("sku1")
+        assert product.allocate(model.OrderLine("o-new", "sku1", 5)) == "b-stock"
+        uow.commit()
+
+    session = sqlite_session_factory()
+    assert allocated_in_db(session, "b-stock") == (35, 4)
+    [[version]] = session.execute("SELECT version_number FROM products")
+    assert version == 4
+
+
+def test_commit_replaces_the_snapshot(
+    sqlite_session_factory, cache, assert_num_queries
+):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1").allocate(model.OrderLine("o-new", "sku1", 5))
+        uow.commit()
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        with assert_num_queries(1):
+            product = uow.products.get("sku1")
+        assert product.version_number == 4
+        assert product.allocate(model.OrderLine("o-newer", "sku1", 5)) == "b-stock"
+        uow.commit()
+
+    assert allocated_in_db(sqlite_session_factory(), "b-stock") == (40, 5)
+
+
+def test_a_newer_version_in_the_database_is_loaded_again(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+    # another process, with its own cache
+    with uow_with(sqlite_session_factory, repository.ProductCache()) as uow:
+        uow.products.get("sku1").allocate(model.OrderLine("o-new", "sku1", 50))
+        uow.commit()
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        product = uow.products.get("sku1")
+        assert product.batches[0].allocated_quantity == 80
+
+    assert cache.stats()["hits"] == 0
+
+
+def test_lines_are_restored_for_get_by_batchref(
+    sqlite_session_factory, cache, assert_num_queries
+):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get_by_batchref("b-stock")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        with assert_num_queries(1):
+            product = uow.products.get_by_batchref("b-stock")
+        product.change_batch_quantity("b-stock", 15)
+        uow.commit()
+
+    session = sqlite_session_factory()
+    assert allocated_in_db(session, "b-stock") == (10, 1)
+    assert allocated_in_db(session, "b-later") == (20, 2)
+    assert cache.stats()["hits"] == 1
+
+
+def test_a_snapshot_without_lines_does_not_do_for_get_by_batchref(
+    sqlite_session_factory, cache
+):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        [batch] = [
+            b
+            for b in uow.products.get_by_batchref("b-stock").batches
+            if b.reference == "b-stock"
+        ]
+        assert len(batch._allocations) == 3
+
+    assert cache.stats()["hits"] == 0
+
+
+def test_get_many_only_loads_the_products_it_has_no_snapshot_for(
+    sqlite_session_factory, cache, assert_num_queries
+):
+    add_product(sqlite_session_factory, "sku1")
+    add_product(sqlite_session_factory, "sku2")
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        # versions, then product and batches for sku2 only
+        with assert_num_queries(3):
+            products = uow.products.get_many(["sku1", "sku2", "sku3"])
+
+    assert set(products) == {"sku1", "sku2"}
+    assert cache.stats()["hits"] == 1
+
+
+def test_concurrent_writers_of_a_restored_version_conflict(
+    sqlite_session_factory, cache
+):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+
+    uow1, uow2 = uow_with(sqlite_session_factory, cache), uow_with(
+        sqlite_session_factory, cache
+    )
+    with uow1, uow2:
+        uow1.products.get("sku1").allocate(model.OrderLine("o-a", "sku1", 1))
+        uow2.products.get("sku1").allocate(model.OrderLine("o-b", "sku1", 1))
+        uow1.commit()
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            uow2.commit()
+
+    assert allocated_in_db(sqlite_session_factory(), "b-stock") == (31, 4)
+    assert len(cache) == 0
+
+
+def test_get_by_batchref_after_get_loads_the_lines(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory)
+    with uow_with(sqlite_session_factory, cache) as uow:
+        uow.products.get("sku1")
+
+    with uow_with(sqlite_session_factory, cache) as uow:
+        product = uow.products.get("sku1")  # restored without lines
+        assert uow.products.get_by_batchref("b-stock") is product
+        product.change_batch_quantity("b-stock", 15)
+        uow.commit()
+
+    assert allocated_in_db(sqlite_session_factory(), "b-stock") == (10, 1)
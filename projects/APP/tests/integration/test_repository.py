@@ -1,6 +1,7 @@
 import pytest
 from allocation.adapters import repository
-from allocation.domain import model
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
 
 pytestmark = pytest.mark.usefixtures("mappers")
 
@@ -17,3 +18,195 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_hydrated_batches_know_their_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    batch.allocate(model.OrderLine("o1", "sku1", 10))
+    batch.allocate(model.OrderLine("o2", "sku1", 15))
+    session.add(model.Product(sku="sku1", batches=[batch]))
+    session.commit()
+
+    [[persisted]] = session.execute("SELECT allocated_quantity FROM batches")
+    assert persisted == 25
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    [loaded] = repo.get_by_batchref("b1").batches
+    assert loaded.allocated_quantity == 25
+    released = loaded.deallocate_one()
+    assert loaded.available_quantity == 100 - 25 + released.qty
+
+
+def test_allocating_does_not_load_the_batches_lines(
+    sqlite_session_factory, assert_num_queries
+):
+    add_product_with_allocations(sqlite_session_factory, lines=50)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+
+    # product, batches
+    with assert_num_queries(2):
+        product = repo.get("sku1")
+        assert product.allocate(model.OrderLine("o-new", "sku1", 1)) == "b0"
+    session.commit()
+
+    [[allocated]] = session.execute(
+        "SELECT allocated_quantity FROM batches WHERE reference = 'b0'"
+    )
+    [[lines]] = session.execute(
+        "SELECT COUNT(*) FROM allocations JOIN batches ON batch_id = batches.id"
+        " WHERE reference = 'b0'"
+    )
+    assert (allocated, lines) == (51, 51)
+
+
+def add_product_with_allocations(session_factory, sku="sku1", batches=3, lines=4):
+    session = session_factory()
+    product = model.Product(
+        sku=sku,
+        batches=[
+            model.Batch(ref=f"b{i}", sku=sku, qty=100, eta=None) for i in range(batches)
+        ],
+    )
+    for batch in product.batches:
+        for j in range(lines):
+            batch.allocate(model.OrderLine(f"{batch.reference}-o{j}", sku, 1))
+    session.add(product)
+    session.commit()
+
+
+@pytest.mark.parametrize(
+    "loading, expected_queries",
+    [("lazy", 1 + 1), ("selectin", 2), ("joined", 1)],
+)
+def test_loading_strategies_for_allocate(
+    sqlite_session_factory, assert_num_queries, loading, expected_queries
+):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading=loading)
+
+    with assert_num_queries(expected_queries):
+        product = repo.get("sku1")
+        assert product.allocate(model.OrderLine("o-new", "sku1", 1)) == "b0"
+
+
+def test_get_by_batchref_loads_every_line_up_front_for_reallocation(
+    sqlite_session_factory, assert_num_queries
+):
+    add_product_with_allocations(sqlite_session_factory, batches=5)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    # product, batches, lines; the released lines move to b0 without a lazy load
+    with assert_num_queries(3):
+        product = repo.get_by_batchref("b3")
+        product.change_batch_quantity("b3", 2)
+    assert product.batches[0].allocated_quantity == 4 + 2
+
+
+@pytest.mark.parametrize("skus", [1, 5])
+def test_get_many_loads_any_number_of_products_in_two_queries(
+    sqlite_session_factory, assert_num_queries, skus
+):
+    for i in range(skus):
+        add_product_with_allocations(sqlite_session_factory, sku=f"sku{i}")
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    wanted = [f"sku{i}" for i in range(skus)] + ["missing"]
+
+    # products by IN list, then one selectin for batches
+    with assert_num_queries(2):
+        products = repo.get_many(wanted)
+        for product in products.values():
+            product.allocate(model.OrderLine("o-new", product.sku, 1))
+    assert sorted(products) == wanted[:-1]
+    assert repo.seen == set(products.values())
+
+
+def test_resident_get_many_only_loads_unknown_skus(
+    sqlite_session_factory, assert_num_queries
+):
+    for sku in ("sku1", "sku2"):
+        add_product_with_allocations(sqlite_session_factory, sku=sku)
+    repo = repository.ResidentSqlAlchemyRepository(sqlite_session_factory())
+    sku1 = repo.get("sku1")
+
+    with assert_num_queries(3):
+        products = repo.get_many(["sku1", "sku2"])
+    assert products["sku1"] is sku1
+    with assert_num_queries(0):
+        assert repo.get("sku2") is products["sku2"]
+
+
+def test_lazy_loading_with_raise_on_lazy_loads_what_it_plans_to(
+    sqlite_session_factory,
+):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(
+        sqlite_session_factory(), loading="lazy", raise_on_lazy=True
+    )
+
+    product = repo.get("sku1")
+    assert [b.reference for b in product.batches] == ["b0", "b1", "b2"]
+    assert [b._allocations for b in product.batches] == [set()] * 3
+
+    product = repo.get_by_batchref("b1")
+    assert [len(b._allocations) for b in product.batches] == [4] * 3
+
+
+def test_allocated_batchrefs_finds_lines_that_are_not_loaded(sqlite_session_factory):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    repo.get("sku1")
+
+    assert repo.allocated_batchrefs(
+        [
+            model.OrderLine("b1-o2", "sku1", 1),
+            model.OrderLine("b1-o2", "sku1", 2),
+            model.OrderLine("o-new", "sku1", 1),
+        ]
+    ) == {model.OrderLine("b1-o2", "sku1", 1): "b1"}
+
+
+def test_allocating_the_same_line_twice_stores_it_once(sqlite_session_factory):
+    add_product_with_allocations(sqlite_session_factory, lines=0)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    for _ in range(2):
+        handlers.allocate(commands.Allocate("o1", "sku1", 10), uow=uow)
+
+    session = sqlite_session_factory()
+    [[lines]] = session.execute("SELECT COUNT(*) FROM order_lines")
+    [[allocated]] = session.execute(
+        "SELECT allocated_quantity FROM batches WHERE reference = 'b0'"
+    )
+    assert (lines, allocated) == (1, 10)
+
+
+def test_get_by_batchref_loads_the_lines_of_a_product_got_without_them(
+    sqlite_session_factory,
+):
+    add_product_with_allocations(sqlite_session_factory, batches=2)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    product = repo.get("sku1")
+
+    assert repo.get_by_batchref("b0") is product
+    assert [len(b._allocations) for b in product.batches] == [4, 4]
+    product.change_batch_quantity("b0", 2)
+    assert product.batches[1].allocated_quantity == 6
+
+
+def test_the_allocated_quantity_check_skips_batches_loaded_without_lines(
+    sqlite_session_factory, monkeypatch
+):
+    monkeypatch.setattr(model.Batch, "check_allocated_quantity", True)
+    add_product_with_allocations(sqlite_session_factory)
+    session = sqlite_session_factory()
+    session.execute("UPDATE batches SET allocated_quantity = 3 WHERE reference = 'b2'")
+    repo = repository.SqlAlchemyRepository(session)
+
+    product = repo.get("sku1")
+    assert product.allocate(model.OrderLine("o-new", "sku1", 1)) == "b0"
+
+    repo.get_by_batchref("b0")
+    with pytest.raises(model.AllocatedQuantityMismatch):
+        product.batches[2].allocated_quantity  # pylint: disable=pointless-statement
@@ -0,0 +1,46 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.service_layer.sharding import ShardedMessageBus, shard_for
+from sqlalchemy import create_engine
+
+
+@pytest.fixture
+def sharded_bus(tmp_path):
+    db_uri = f"sqlite:///{tmp_path / 'shards.db'}"
+    engine = create_engine(db_uri)
+    mapper_registry.metadata.create_all(engine)
+    bus = ShardedMessageBus(db_uri, num_shards=2, flush_every=1000, side_effects=False)
+    yield bus, engine
+    bus.close()
+
+
+def test_shard_for_is_stable_and_in_range():
+    assert shard_for("RED-CHAIR", 4) == shard_for("RED-CHAIR", 4)
+    assert {shard_for(f"sku-{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_commands_are_handled_by_the_owning_shard_and_written_behind(sharded_bus):
+    bus, engine = sharded_bus
+    skus = [f"sku-{i}" for i in range(6)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-b1", sku, 10, None))
+
+    futures = [bus.submit(commands.Allocate("o1", sku, 4)) for sku in skus]
+    assert [f.result() for f in futures] == [[None]] * len(skus)
+    bus.handle(commands.ChangeBatchQuantity("sku-0-b1", 2))
+
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 1))
+
+    bus.close()
+    with engine.connect() as conn:
+        rows = conn.execute(
+            "SELECT reference, _purchased_quantity FROM batches ORDER BY reference"
+        ).fetchall()
+        [[allocated]] = conn.execute("SELECT count(*) FROM allocations")
+    assert len(rows) == 6
+    assert ("sku-0-b1", 2) in rows
+    assert allocated == 5
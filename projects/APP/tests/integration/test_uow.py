@@ -80,6 +80,57 @@ def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+def test_write_behind_drops_the_changes_of_a_failed_message(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TALL-LAMP", 100, None)
+    insert_batch(session, "batch2", "SHORT-LAMP", 100, None)
+    session.commit()
+    uow = unit_of_work.WriteBehindUnitOfWork(sqlite_session_factory)
+    with uow:
+        uow.products.get("SHORT-LAMP").allocate(model.OrderLine("o1", "SHORT-LAMP", 5))
+        uow.commit()
+
+    with pytest.raises(ValueError):
+        with uow:
+            uow.products.get("TALL-LAMP").allocate(
+                model.OrderLine("o1", "TALL-LAMP", 10)
+            )
+            raise ValueError()
+    with uow:
+        [batch] = uow.products.get("TALL-LAMP").batches
+        assert batch.available_quantity == 100
+    uow.flush()
+
+    assert get_allocated_batch_ref(session, "o1", "SHORT-LAMP") == "batch2"
+    assert list(session.execute("SELECT orderid, sku FROM order_lines")) == [
+        ("o1", "SHORT-LAMP")
+    ]
+
+
+def test_write_behind_reports_commits_lost_to_a_failed_flush(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TALL-LAMP", 100, None)
+    session.commit()
+    uow = unit_of_work.WriteBehindUnitOfWork(sqlite_session_factory)
+    flushed = []
+    with uow:
+        uow.products.get("TALL-LAMP").allocate(model.OrderLine("o1", "TALL-LAMP", 10))
+        uow.commit()
+    uow.when_flushed(flushed.append)
+    assert flushed == []
+
+    # another writer gets there first
+    session.execute("UPDATE products SET version_number = 2")
+    session.commit()
+    with pytest.raises(unit_of_work.ConcurrentModification):
+        uow.flush()
+
+    [error] = flushed
+    assert isinstance(error, unit_of_work.ConcurrentModification)
+    uow.when_flushed(flushed.append)
+    assert flushed[1:] == [None]
+
+
 def try_to_allocate(orderid, sku, exceptions, session_factory):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -93,6 +144,57 @@ def try_to_allocate(orderid, sku, exceptions, session_factory):
         exceptions.append(e)
 
 
+def test_concurrent_modification_is_detected_by_version_number(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "LUMPY-CUSHION", 100, None, product_version=3)
+    session.commit()
+
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow1, uow2:
+        product1 = uow1.products.get(sku="LUMPY-CUSHION")
+        product2 = uow2.products.get(sku="LUMPY-CUSHION")
+        product1.allocate(model.OrderLine("o1", "LUMPY-CUSHION", 10))
+        product2.allocate(model.OrderLine("o2", "LUMPY-CUSHION", 10))
+        uow1.commit()
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            uow2.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='LUMPY-CUSHION'"
+    )
+    assert version == 4
+    assert get_allocated_batch_ref(session, "o1", "LUMPY-CUSHION") == "batch1"
+
+
+def test_an_order_conflicting_on_any_of_its_products_is_not_committed(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "LUMPY-CUSHION", 100, None)
+    insert_batch(session, "batch2", "FLAT-CUSHION", 100, None)
+    session.commit()
+
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow1, uow2:
+        products = uow1.products.get_many(["LUMPY-CUSHION", "FLAT-CUSHION"])
+        for sku, product in products.items():
+            product.allocate(model.OrderLine("order1", sku, 10))
+        uow2.products.get(sku="FLAT-CUSHION").allocate(
+            model.OrderLine("order2", "FLAT-CUSHION", 10)
+        )
+        uow2.commit()
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            uow1.commit()
+
+    assert (
+        list(session.execute("SELECT * FROM order_lines WHERE orderid='order1'")) == []
+    )
+
+
 # we won't bother with any postgres tests
 """
 def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory):
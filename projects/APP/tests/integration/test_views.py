@@ -4,8 +4,10 @@ from unittest import mock
 
 import pytest
 from allocation import bootstrap, views
-from allocation.domain import commands
+from allocation.adapters.view_cache import AllocationsCache, InMemoryLRUStore
+from allocation.domain import commands, events
 from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import AllocationsViewProjector
 from sqlalchemy.orm import clear_mappers
 
 today = date.today()
@@ -48,3 +50,162 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_bulk_allocation_populates_the_view(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
+    sqlite_bus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate("order1", "sku1", 20),
+                commands.Allocate("order1", "sku2", 20),
+            ]
+        )
+    )
+
+    results = views.allocations("order1", sqlite_bus.uow)
+    assert sorted(results, key=lambda r: r["sku"]) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+
+
+def test_allocate_handler_query_count(sqlite_bus, assert_num_queries):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+
+    # product, batches, whether the line is already allocated; version and
+    # allocated_quantity UPDATEs, line and allocation INSERTs; then the
+    # allocations_view INSERT
+    with assert_num_queries(8):
+        sqlite_bus.handle(commands.Allocate("o1", "sku1", 10))
+
+
+def test_bulk_allocation_is_projected_with_one_insert(sqlite_bus, assert_num_queries):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    lines = [commands.Allocate(f"o{i}", "sku1", 1) for i in range(20)]
+
+    # product, batches, lines, which lines are already allocated, version
+    # UPDATE, an INSERT per order line, then one executemany each for
+    # allocations and allocations_view
+    with assert_num_queries(3 + 1 + 1 + 20 + 1 + 1) as statements:
+        sqlite_bus.handle(commands.AllocateMany(lines))
+    inserts = [s for s in statements if "INSERT INTO allocations_view" in s]
+    assert len(inserts) == 1
+
+
+def test_shrinking_a_batch_reallocates_in_the_same_transaction(
+    sqlite_bus, assert_num_queries
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(
+        commands.AllocateMany(
+            [commands.Allocate(f"o{i}", "sku1", 5) for i in range(10)]
+        )
+    )
+
+    # product, batches, lines; version UPDATE and one UPDATE per batch, one
+    # executemany each to move the allocations; one DELETE and one INSERT on
+    # the view
+    with assert_num_queries(3 + 3 + 2 + 2) as statements:
+        sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 0))
+    assert len([s for s in statements if "FROM products" in s]) == 1
+    assert views.allocations("o7", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_a_failed_flush_keeps_its_changes_for_the_next(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    projector = AllocationsViewProjector(uow)
+    projector.add(events.Allocated("o1", "sku1", 10, "b1"))
+
+    with mock.patch.object(uow, "commit", side_effect=ConnectionError):
+        with pytest.raises(ConnectionError):
+            projector.flush()
+    projector.add(events.Allocated("o1", "sku2", 10, "b2"))
+    projector.flush()
+
+    assert views.allocations("o1", uow) == [
+        {"sku": "sku1", "batchref": "b1"},
+        {"sku": "sku2", "batchref": "b2"},
+    ]
+
+
+def test_rebuild_allocations_view_fixes_drift(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 10))
+    sqlite_bus.handle(commands.Allocate("o2", "sku1", 10))
+    with sqlite_bus.uow:
+        sqlite_bus.uow.session.execute(
+            "DELETE FROM allocations_view WHERE orderid = 'o1'"
+        )
+        sqlite_bus.uow.session.execute(
+            "INSERT INTO allocations_view VALUES ('stale', 'sku1', 'b1')"
+        )
+        sqlite_bus.uow.commit()
+
+    sqlite_bus.handle(commands.RebuildAllocationsView())
+
+    assert views.allocations("o1", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    assert views.allocations("o2", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    assert views.allocations("stale", sqlite_bus.uow) == []
+
+
+def test_verify_allocated_quantities_fixes_drift(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku2", 50, None))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 10))
+    sqlite_bus.handle(commands.Allocate("o1", "sku2", 5))
+    with sqlite_bus.uow:
+        sqlite_bus.uow.session.execute(
+            "UPDATE batches SET allocated_quantity = 40 WHERE reference = 'b1'"
+        )
+        sqlite_bus.uow.commit()
+
+    [fixed] = sqlite_bus.handle(commands.VerifyAllocatedQuantities())
+
+    assert fixed == {"b1": {"stored": 40, "actual": 10}}
+    with sqlite_bus.uow:
+        product = sqlite_bus.uow.products.get("sku1")
+        assert product.batches[0].available_quantity == 40
+        assert product.version_number == 3
+    assert sqlite_bus.handle(commands.VerifyAllocatedQuantities()) == [{}]
+
+
+def test_cached_allocations_are_invalidated_by_events(sqlite_session_factory):
+    cache = AllocationsCache(InMemoryLRUStore())
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        allocations_cache=cache,
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+        assert views.allocations("o1", bus.uow, cache) == []
+
+        bus.handle(commands.Allocate("o1", "sku1", 40))
+        assert views.allocations("o1", bus.uow, cache) == [
+            {"sku": "sku1", "batchref": "b1"}
+        ]
+        assert views.allocations("o1", bus.uow, cache) == [
+            {"sku": "sku1", "batchref": "b1"}
+        ]
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+        assert views.allocations("o1", bus.uow, cache) == [
+            {"sku": "sku1", "batchref": "b2"}
+        ]
+        assert cache.hits == 1
+        assert cache.misses == 3
+    finally:
+        clear_mappers()
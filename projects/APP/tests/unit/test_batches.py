@@ -1,6 +1,7 @@
 from datetime import date
 
-from allocation.domain.model import Batch, OrderLine
+import pytest
+from allocation.domain.model import AllocatedQuantityMismatch, Batch, OrderLine
 
 
 def test_allocating_to_a_batch_reduces_the_available_quantity():
@@ -45,3 +46,65 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocate_one_restores_the_available_quantity():
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_is_recomputed_after_reset():
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch._allocations.add(line)
+    batch._allocated_quantity = None
+    assert batch.allocated_quantity == 2
+
+
+def test_debug_mode_detects_drift_in_the_running_total(monkeypatch):
+    monkeypatch.setattr(Batch, "check_allocated_quantity", True)
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch.allocate(line)
+    assert batch.allocated_quantity == 2
+
+    batch._allocations.discard(line)
+    with pytest.raises(AllocatedQuantityMismatch):
+        batch.allocated_quantity  # pylint: disable=pointless-statement
+
+
+def test_release_excess_frees_the_fewest_lines_that_cover_the_deficit():
+    batch = Batch("batch-001", "TALL-SHELF", 100, eta=None)
+    small, medium, large = (
+        OrderLine("o1", "TALL-SHELF", 5),
+        OrderLine("o2", "TALL-SHELF", 30),
+        OrderLine("o3", "TALL-SHELF", 60),
+    )
+    for line in (small, medium, large):
+        batch.allocate(line)
+
+    batch._purchased_quantity = 70
+    assert batch.release_excess() == [medium]
+    assert batch.available_quantity == 5
+
+    batch._purchased_quantity = 0
+    assert sorted(line.qty for line in batch.release_excess()) == [5, 60]
+    assert batch.available_quantity == 0
+
+
+def test_release_excess_releases_every_line_when_they_cannot_cover_the_deficit():
+    batch = Batch("batch-001", "TALL-SHELF", 100, eta=None)
+    lines = [OrderLine("o1", "TALL-SHELF", 5), OrderLine("o2", "TALL-SHELF", 30)]
+    for line in lines:
+        batch.allocate(line)
+
+    batch._purchased_quantity = -10
+    assert sorted(batch.release_excess(), key=lambda line: line.qty) == lines
+    assert batch.available_quantity == -10
+
+
+def test_release_excess_is_a_no_op_when_not_over_allocated():
+    batch, line = make_batch_and_line("TALL-SHELF", 20, 2)
+    batch.allocate(line)
+    assert batch.release_excess() == []
+    assert batch.available_quantity == 18
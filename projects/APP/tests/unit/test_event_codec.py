@@ -0,0 +1,136 @@
+import json
+from dataclasses import asdict
+from datetime import date
+
+import pytest
+from allocation.adapters import event_codec, redis_eventpublisher
+from allocation.adapters.event_codec import BinaryCodec, CodecError, JsonCodec
+from allocation.domain import commands, events
+
+MESSAGES = [
+    events.Allocated("order1", "RED-CHAIR", 10, "batch1"),
+    events.Deallocated("order2", "BLUE-LAMP", 0),
+    events.OutOfStock("TASTELESS-TABLE"),
+    commands.CreateBatch("batch2", "SMALL-TABLE", 100, date(2026, 10, 18)),
+    commands.CreateBatch("batch3", "SMALL-TABLE", 100, None),
+    commands.ChangeBatchQuantity("batch1", -3),
+    events.Allocated("ördér-ünicode", "SKU", 2**40, "b" * 300),
+]
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_binary_round_trip(message):
+    codec = BinaryCodec()
+
+    assert codec.decode(codec.encode(message)) == [message]
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_json_round_trip(message):
+    codec = JsonCodec()
+
+    assert codec.decode(codec.encode(message), type(message)) == [message]
+
+
+def test_binary_frame_holds_several_messages_in_order():
+    codec = BinaryCodec()
+
+    frame = codec.encode_frame(MESSAGES)
+
+    assert codec.decode(frame) == MESSAGES
+
+
+def test_binary_is_smaller_than_json():
+    event = events.Allocated("order1", "RED-CHAIR", 10, "batch1")
+
+    assert len(BinaryCodec().encode(event)) < len(json.dumps(asdict(event))) / 2
+
+
+def test_json_codec_keeps_the_existing_wire_format():
+    event = events.Allocated("order1", "RED-CHAIR", 10, "batch1")
+
+    assert json.loads(JsonCodec().encode(event)) == asdict(event)
+
+
+def test_json_uses_the_external_name_for_batch_changes():
+    codec = JsonCodec()
+    change = commands.ChangeBatchQuantity("batch1", 5)
+
+    data = codec.encode(change)
+
+    assert json.loads(data) == {"batchref": "batch1", "qty": 5}
+    assert codec.decode(data, commands.ChangeBatchQuantity) == [change]
+
+
+def test_decode_detects_the_format():
+    changes = [
+        commands.ChangeBatchQuantity("batch1", 5),
+        commands.ChangeBatchQuantity("batch2", 7),
+    ]
+    for codec in (JsonCodec(), BinaryCodec()):
+        frame = codec.encode_frame(changes)
+        assert event_codec.decode(frame, commands.ChangeBatchQuantity) == changes
+
+
+def test_truncated_binary_frame_is_a_codec_error():
+    frame = BinaryCodec().encode(events.Allocated("order1", "RED-CHAIR", 10, "b1"))
+
+    with pytest.raises(CodecError):
+        BinaryCodec().decode(frame[:-3])
+
+
+def test_unexpected_message_type_is_a_codec_error():
+    frame = BinaryCodec().encode(events.OutOfStock("RED-CHAIR"))
+
+    with pytest.raises(CodecError):
+        event_codec.decode(frame, commands.ChangeBatchQuantity)
+
+
+def test_type_ids_cannot_be_reused():
+    registry = event_codec.SchemaRegistry()
+    registry.register(events.Allocated, 1)
+
+    with pytest.raises(ValueError):
+        registry.register(events.Deallocated, 1)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, data):
+        self.published.append((channel, data))
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+
+def test_framing_publisher_packs_events_per_channel():
+    client = FakeRedis()
+    publisher = redis_eventpublisher.FramingPublisher(
+        client, BinaryCodec(), frame_size=2
+    )
+    allocated = [events.Allocated(f"o{i}", "sku", 1, "b1") for i in range(3)]
+
+    for event in allocated:
+        publisher.publish("line_allocated", event)
+    publisher.publish("out_of_stock", events.OutOfStock("sku"))
+    assert len(client.published) == 1
+    publisher.flush()
+
+    frames = {}
+    for channel, data in client.published:
+        frames.setdefault(channel, []).append(event_codec.decode(data))
+    assert frames == {
+        "line_allocated": [allocated[:2], allocated[2:]],
+        "out_of_stock": [[events.OutOfStock("sku")]],
+    }
+
+
+@pytest.mark.parametrize("data", [b"{not json", b"\xff\xfe", b'{"batchref": "b1"}'])
+def test_malformed_json_is_a_codec_error(data):
+    with pytest.raises(CodecError):
+        JsonCodec().decode(data, commands.ChangeBatchQuantity)
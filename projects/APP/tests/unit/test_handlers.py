@@ -1,6 +1,7 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
 
+import asyncio
 from collections import defaultdict
 from datetime import date
 from typing import Dict, List
@@ -8,8 +9,9 @@ from typing import Dict, List
 import pytest
 from allocation import bootstrap
 from allocation.adapters import notifications, repository
-from allocation.domain import commands
+from allocation.domain import commands, events
 from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer.instrumentation import BusMetrics
 
 
 class FakeRepository(repository.AbstractRepository):
@@ -50,6 +52,26 @@ class FakeNotifications(notifications.AbstractNotifications):
         self.sent[destination].append(message)
 
 
+class FakeAsyncNotifications(notifications.AbstractNotifications):
+    def __init__(self, delay=0.01, fail_for=()):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+        self.delay = delay
+        self.fail_for = fail_for
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send(self, destination, message):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if any(sku in message for sku in self.fail_for):
+                raise ConnectionError("smtp went away")
+            self.sent[destination].append(message)
+        finally:
+            self.in_flight -= 1
+
+
 def bootstrap_test_app():
     return bootstrap.bootstrap(
         start_orm=False,
@@ -109,6 +131,226 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_allocates_lines_across_skus_and_returns_batchrefs(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SHINY-SOFA", 10, None))
+        bus.handle(commands.CreateBatch("b2", "SHINY-SOFA", 100, date.today()))
+        bus.handle(commands.CreateBatch("b3", "DULL-SOFA", 100, None))
+
+        [batchrefs] = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "SHINY-SOFA", 10),
+                    commands.Allocate("o1", "DULL-SOFA", 5),
+                    commands.Allocate("o2", "SHINY-SOFA", 10),
+                ]
+            )
+        )
+
+        assert batchrefs == ["b1", "b3", "b2"]
+        assert bus.uow.committed
+
+    def test_returns_none_for_lines_that_are_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "SCARCE-STOOL", 10, None))
+
+        [batchrefs] = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "SCARCE-STOOL", 8),
+                    commands.Allocate("o2", "SCARCE-STOOL", 8),
+                ]
+            )
+        )
+
+        assert batchrefs == ["b1", None]
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for SCARCE-STOOL"]
+
+    def test_errors_for_invalid_sku_before_allocating_anything(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "REAL-SKU", 100, None))
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(
+                commands.AllocateMany(
+                    [
+                        commands.Allocate("o1", "REAL-SKU", 10),
+                        commands.Allocate("o1", "NONEXISTENTSKU", 10),
+                    ]
+                )
+            )
+        [batch] = bus.uow.products.get("REAL-SKU").batches
+        assert batch.available_quantity == 100
+
+
+class TestAllocateOrder:
+    def test_allocates_every_line_in_one_commit(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TALL-LAMP", 10, None))
+        bus.handle(commands.CreateBatch("b2", "SHORT-LAMP", 10, None))
+        bus.uow.committed = False
+
+        [batchrefs] = bus.handle(
+            commands.AllocateOrder("o1", {"TALL-LAMP": 5, "SHORT-LAMP": 20})
+        )
+
+        assert batchrefs == {"TALL-LAMP": "b1", "SHORT-LAMP": None}
+        assert bus.uow.committed
+
+    def test_errors_for_invalid_sku_before_allocating_anything(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "REAL-SKU", 100, None))
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(
+                commands.AllocateOrder("o1", {"REAL-SKU": 10, "NONEXISTENTSKU": 10})
+            )
+        [batch] = bus.uow.products.get("REAL-SKU").batches
+        assert batch.available_quantity == 100
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise unit_of_work.ConcurrentModification("version mismatch")
+        super()._commit()
+
+
+class TestRetryOnConflict:
+    @staticmethod
+    def bootstrap_conflicting_app(conflicts):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=ConflictingUnitOfWork(conflicts),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        )
+
+    def test_retries_until_the_commit_succeeds(self, monkeypatch):
+        monkeypatch.setattr(handlers.time, "sleep", lambda _: None)
+        monkeypatch.setattr(handlers, "conflict_stats", handlers.ConflictStats())
+        bus = self.bootstrap_conflicting_app(conflicts=2)
+
+        bus.handle(commands.CreateBatch("b1", "CONTESTED-CHAIR", 100, None))
+
+        assert bus.uow.committed
+        assert handlers.conflict_stats.snapshot()["add_batch"] == dict(
+            attempts=3, conflicts=2, exhausted=0, conflict_rate=2 / 3
+        )
+
+    def test_gives_up_after_the_configured_attempts(self, monkeypatch):
+        monkeypatch.setattr(handlers.time, "sleep", lambda _: None)
+        monkeypatch.setattr(handlers, "conflict_stats", handlers.ConflictStats())
+        monkeypatch.setenv("CONFLICT_RETRY_ATTEMPTS", "3")
+        bus = self.bootstrap_conflicting_app(conflicts=10)
+
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            bus.handle(commands.CreateBatch("b1", "CONTESTED-CHAIR", 100, None))
+        assert handlers.conflict_stats.exhausted["add_batch"] == 1
+        assert bus.uow.conflicts == 7
+
+
+class ConflictingInMemoryUnitOfWork(unit_of_work.InMemoryUnitOfWork):
+    """Loses the race on the given commits, counted from 1."""
+
+    def __init__(self, conflict_on):
+        super().__init__()
+        self.conflict_on = conflict_on
+        self.commits = 0
+
+    def _commit(self):
+        self.commits += 1
+        if self.commits in self.conflict_on:
+            raise unit_of_work.ConcurrentModification("version mismatch")
+        super()._commit()
+
+
+class TestBulkRetryOnConflict:
+    @staticmethod
+    def bootstrap_app(published):
+        uow = ConflictingInMemoryUnitOfWork(conflict_on=())
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+        )
+        for sku in ("LAMP", "RUG"):
+            bus.handle(commands.CreateBatch(f"{sku}-now", sku, 10, None))
+            bus.handle(commands.CreateBatch(f"{sku}-later", sku, 10, date.today()))
+        published.clear()
+        return bus, uow
+
+    def test_allocate_many_retries_the_groups_from_the_conflict(self, monkeypatch):
+        monkeypatch.setattr(handlers.time, "sleep", lambda _: None)
+        monkeypatch.setattr(handlers, "conflict_stats", handlers.ConflictStats())
+        published = []
+        bus, uow = self.bootstrap_app(published)
+        uow.conflict_on = {uow.commits + 2}
+
+        [batchrefs] = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "LAMP", 2),
+                    commands.Allocate("o1", "RUG", 3),
+                ]
+            )
+        )
+
+        assert batchrefs == ["LAMP-now", "RUG-now"]
+        assert handlers.conflict_stats.snapshot()["allocate_many"] == dict(
+            attempts=3, conflicts=1, exhausted=0, conflict_rate=1 / 3
+        )
+        # the group committed before the conflict still has its event published
+        assert sorted(event.sku for event in published) == ["LAMP", "RUG"]
+
+    def test_change_batch_quantities_retries_the_groups_from_the_conflict(
+        self, monkeypatch
+    ):
+        monkeypatch.setattr(handlers.time, "sleep", lambda _: None)
+        monkeypatch.setattr(handlers, "conflict_stats", handlers.ConflictStats())
+        published = []
+        bus, uow = self.bootstrap_app(published)
+        bus.handle(commands.Allocate("o1", "LAMP", 8))
+        bus.handle(commands.Allocate("o1", "RUG", 8))
+        published.clear()
+        uow.conflict_on = {uow.commits + 1, uow.commits + 2}
+
+        bus.handle(
+            commands.ChangeBatchQuantities(
+                [
+                    commands.ChangeBatchQuantity("LAMP-now", 5),
+                    commands.ChangeBatchQuantity("RUG-now", 5),
+                ]
+            )
+        )
+
+        with uow:
+            for sku in ("LAMP", "RUG"):
+                now, later = uow.products.get(sku).batches
+                assert (now.available_quantity, later.available_quantity) == (5, 2)
+        assert handlers.conflict_stats.snapshot()["change_batch_quantities"] == dict(
+            attempts=4, conflicts=2, exhausted=0, conflict_rate=2 / 4
+        )
+        # both lines were moved to the later batches
+        assert sorted(event.batchref for event in published) == [
+            "LAMP-later",
+            "RUG-later",
+        ]
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -139,3 +381,233 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestChangeBatchQuantities:
+    def test_applies_every_change_and_reallocates(self):
+        bus = bootstrap_test_app()
+        history = [
+            commands.CreateBatch("batch1", "STURDY-TABLE", 50, None),
+            commands.CreateBatch("batch2", "STURDY-TABLE", 50, date.today()),
+            commands.CreateBatch("batch3", "WOBBLY-TABLE", 50, None),
+            commands.Allocate("order1", "STURDY-TABLE", 20),
+        ]
+        for msg in history:
+            bus.handle(msg)
+
+        bus.handle(
+            commands.ChangeBatchQuantities(
+                [
+                    commands.ChangeBatchQuantity("batch1", 10),
+                    commands.ChangeBatchQuantity("batch3", 40),
+                ]
+            )
+        )
+
+        batch1, batch2 = bus.uow.products.get(sku="STURDY-TABLE").batches
+        [batch3] = bus.uow.products.get(sku="WOBBLY-TABLE").batches
+        assert batch1.available_quantity == 10
+        assert batch2.available_quantity == 30
+        assert batch3.available_quantity == 40
+
+    def test_skips_unknown_batches(self, caplog):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "STURDY-TABLE", 50, None))
+
+        bus.handle(
+            commands.ChangeBatchQuantities(
+                [
+                    commands.ChangeBatchQuantity("batch1", 10),
+                    commands.ChangeBatchQuantity("nonexistent", 40),
+                ]
+            )
+        )
+
+        [batch1] = bus.uow.products.get(sku="STURDY-TABLE").batches
+        assert batch1.available_quantity == 10
+        assert "skipping change to unknown batch nonexistent" in caplog.text
+
+
+class TestAsyncMessageBus:
+    @staticmethod
+    def bootstrap_async_app(fake_notifs, **kwargs):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+            use_async=True,
+            **kwargs,
+        )
+
+    def test_handles_commands_and_returns_results(self):
+        bus = self.bootstrap_async_app(FakeAsyncNotifications())
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "ASYNC-LAMP", 100, None)))
+        [batchrefs] = asyncio.run(
+            bus.handle(
+                commands.AllocateMany([commands.Allocate("o1", "ASYNC-LAMP", 10)])
+            )
+        )
+        assert batchrefs == ["b1"]
+        assert bus.uow.committed
+
+    def test_runs_async_event_handlers_concurrently_up_to_the_limit(self):
+        fake_notifs = FakeAsyncNotifications()
+        bus = self.bootstrap_async_app(
+            fake_notifs, event_concurrency={events.OutOfStock: 3}
+        )
+        skus = [f"SCARCE-{i}" for i in range(10)]
+        for sku in skus:
+            asyncio.run(bus.handle(commands.CreateBatch(f"b-{sku}", sku, 1, None)))
+
+        asyncio.run(
+            bus.handle(
+                commands.AllocateMany([commands.Allocate("o1", sku, 2) for sku in skus])
+            )
+        )
+
+        assert len(fake_notifs.sent["stock@made.com"]) == 10
+        assert fake_notifs.max_in_flight == 3
+
+    def test_limits_hold_across_event_loops(self):
+        fake_notifs = FakeAsyncNotifications()
+        bus = self.bootstrap_async_app(
+            fake_notifs, event_concurrency={events.OutOfStock: 1}
+        )
+        skus = [f"SCARCE-{i}" for i in range(3)]
+        for sku in skus:
+            asyncio.run(bus.handle(commands.CreateBatch(f"b-{sku}", sku, 1, None)))
+
+        for orderid in ("o1", "o2"):
+            asyncio.run(
+                bus.handle(
+                    commands.AllocateMany(
+                        [commands.Allocate(orderid, sku, 2) for sku in skus]
+                    )
+                )
+            )
+
+        assert len(fake_notifs.sent["stock@made.com"]) == 6
+        assert fake_notifs.max_in_flight == 1
+
+    def test_command_errors_propagate(self):
+        bus = self.bootstrap_async_app(FakeAsyncNotifications())
+        with pytest.raises(handlers.InvalidSku):
+            asyncio.run(bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10)))
+
+    def test_event_handler_errors_are_logged_not_raised(self, caplog):
+        fake_notifs = FakeAsyncNotifications(fail_for=["FLAKY-SKU"])
+        bus = self.bootstrap_async_app(fake_notifs)
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "FLAKY-SKU", 1, None)))
+        asyncio.run(bus.handle(commands.CreateBatch("b2", "STEADY-SKU", 1, None)))
+
+        asyncio.run(
+            bus.handle(
+                commands.AllocateMany(
+                    [
+                        commands.Allocate("o1", "FLAKY-SKU", 2),
+                        commands.Allocate("o1", "STEADY-SKU", 2),
+                    ]
+                )
+            )
+        )
+
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for STEADY-SKU"]
+        assert "Exception handling event OutOfStock(sku='FLAKY-SKU')" in caplog.text
+
+
+class TestBusInstrumentation:
+    @staticmethod
+    def bootstrap_instrumented_app(publish=lambda *args: None):
+        metrics = BusMetrics()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=publish,
+            instrumentation=metrics,
+        )
+        return bus, metrics
+
+    def test_times_each_handler_by_message_type(self):
+        bus, metrics = self.bootstrap_instrumented_app()
+        bus.handle(commands.CreateBatch("b1", "TIMED-LAMP", 100, None))
+        bus.handle(commands.Allocate("o1", "TIMED-LAMP", 10))
+
+        assert metrics.handler_seconds["Allocate", "allocate"].count == 1
+        assert (
+            metrics.handler_seconds["Allocated", "publish_allocated_event"].count == 1
+        )
+        assert metrics.message_seconds["Allocated"].count == 1
+
+    def test_records_cascade_fanout_and_queue_depth(self):
+        bus, metrics = self.bootstrap_instrumented_app()
+        for msg in [
+            commands.CreateBatch("batch1", "CASCADING-TABLE", 50, None),
+            commands.CreateBatch("batch2", "CASCADING-TABLE", 50, date.today()),
+            commands.Allocate("order1", "CASCADING-TABLE", 20),
+            commands.Allocate("order2", "CASCADING-TABLE", 20),
+        ]:
+            bus.handle(msg)
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        fanout = metrics.fanout["ChangeBatchQuantity"]
+        # both lines deallocated and reallocated to batch2 in the same command
+        assert (fanout.count, fanout.sum) == (1, 4)
+        assert metrics.queue_depth_max == 4
+
+    def test_counts_handler_errors(self):
+        def publish(*args):
+            raise ConnectionError("redis went away")
+
+        bus, metrics = self.bootstrap_instrumented_app(publish=publish)
+        bus.handle(commands.CreateBatch("b1", "FLAKY-LAMP", 100, None))
+        bus.handle(commands.Allocate("o1", "FLAKY-LAMP", 10))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o2", "NONEXISTENTSKU", 10))
+
+        assert metrics.handler_errors == {
+            ("Allocated", "publish_allocated_event"): 1,
+            ("Allocate", "allocate"): 1,
+        }
+
+    def test_renders_prometheus_text(self):
+        bus, metrics = self.bootstrap_instrumented_app()
+        bus.handle(commands.CreateBatch("b1", "EXPORTED-LAMP", 100, None))
+
+        text = metrics.to_prometheus()
+
+        assert "# TYPE allocation_bus_handler_seconds histogram" in text
+        assert (
+            'allocation_bus_handler_seconds_bucket{message="CreateBatch",'
+            'handler="add_batch",le="+Inf"} 1' in text
+        )
+        assert "allocation_bus_queue_depth_max 0" in text
+
+    def test_times_async_handlers_until_they_finish(self):
+        metrics = BusMetrics()
+        bus = TestAsyncMessageBus.bootstrap_async_app(
+            FakeAsyncNotifications(delay=0.01, fail_for=["FLAKY-LAMP"]),
+            instrumentation=metrics,
+        )
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "FLAKY-LAMP", 1, None)))
+        asyncio.run(bus.handle(commands.CreateBatch("b2", "ASYNC-LAMP", 1, None)))
+        for sku in ("FLAKY-LAMP", "ASYNC-LAMP"):
+            asyncio.run(bus.handle(commands.Allocate("o1", sku, 2)))
+
+        notifying = metrics.handler_seconds[
+            "OutOfStock", "send_out_of_stock_notification"
+        ]
+        assert notifying.count == 2
+        assert notifying.sum >= 0.02
+        assert metrics.handler_errors == {
+            ("OutOfStock", "send_out_of_stock_notification"): 1
+        }
+        assert metrics.message_seconds["Allocate"].count == 2
+        assert metrics.fanout["Allocate"].sum == 2
+
+    def test_handlers_are_left_unwrapped_without_instrumentation(self):
+        bus = bootstrap_test_app()
+        assert bus.instrumentation is None
+        assert bus.command_handlers[commands.Allocate].__name__ == "allocate"
@@ -0,0 +1,141 @@
+from datetime import date
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import memory_store
+from allocation.adapters.notifications import NullNotifications
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+
+def no_publish(*args):
+    pass
+
+
+def in_memory_bus(store=None):
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=NullNotifications(),
+        publish=no_publish,
+    )
+
+
+def add_stock(bus):
+    bus.handle(commands.CreateBatch("b-stock", "LAMP", 20, None))
+    bus.handle(commands.CreateBatch("b-later", "LAMP", 20, date(2030, 1, 1)))
+    bus.handle(commands.CreateBatch("b-table", "TABLE", 10, None))
+
+
+def test_allocations_show_up_in_the_view():
+    bus = in_memory_bus()
+    add_stock(bus)
+
+    bus.handle(commands.Allocate("o1", "LAMP", 15))
+    bus.handle(commands.Allocate("o1", "TABLE", 2))
+
+    assert sorted(views.allocations("o1", bus.uow), key=lambda r: r["sku"]) == [
+        {"sku": "LAMP", "batchref": "b-stock"},
+        {"sku": "TABLE", "batchref": "b-table"},
+    ]
+
+
+def test_change_batch_quantity_finds_the_product_by_batchref():
+    bus = in_memory_bus()
+    add_stock(bus)
+    bus.handle(commands.Allocate("o1", "LAMP", 15))
+
+    bus.handle(commands.ChangeBatchQuantity("b-stock", 10))
+
+    assert views.allocations("o1", bus.uow) == [{"sku": "LAMP", "batchref": "b-later"}]
+
+
+def test_uncommitted_changes_are_not_stored():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    with uow:
+        uow.products.add(model.Product("LAMP", [model.Batch("b1", "LAMP", 20, None)]))
+        uow.commit()
+
+    with uow:
+        uow.products.get("LAMP").allocate(model.OrderLine("o1", "LAMP", 5))
+
+    with uow:
+        assert uow.products.get("LAMP").batches[0].available_quantity == 20
+
+
+def test_committing_a_product_changed_since_it_was_loaded_conflicts():
+    store = memory_store.InMemoryStore()
+    uow1, uow2 = (
+        unit_of_work.InMemoryUnitOfWork(store),
+        unit_of_work.InMemoryUnitOfWork(store),
+    )
+    with uow1:
+        uow1.products.add(model.Product("LAMP", [model.Batch("b1", "LAMP", 20, None)]))
+        uow1.commit()
+
+    with uow1, uow2:
+        uow1.products.get("LAMP").allocate(model.OrderLine("o1", "LAMP", 5))
+        uow2.products.get("LAMP").allocate(model.OrderLine("o2", "LAMP", 5))
+        uow1.commit()
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            uow2.commit()
+
+    assert store.products["LAMP"].batches[0].available_quantity == 15
+
+
+def test_only_the_batches_a_unit_of_work_writes_to_get_their_lines_copied():
+    bus = in_memory_bus()
+    add_stock(bus)
+    bus.handle(commands.Allocate("o1", "LAMP", 15))
+    stock, later = bus.uow.store.products["LAMP"].batches
+    before = (stock._allocations, later._allocations)
+
+    bus.handle(commands.Allocate("o2", "LAMP", 10))
+
+    stock_after, later_after = bus.uow.store.products["LAMP"].batches
+    assert stock_after._allocations is before[0]
+    assert later_after._allocations is not before[1]
+    assert before[1] == frozenset()  # the committed lines weren't written to
+    assert later_after._allocations == {model.OrderLine("o2", "LAMP", 10)}
+
+
+def test_state_is_recovered_from_the_snapshot_and_journal(tmp_path):
+    bus = in_memory_bus(memory_store.InMemoryStore(str(tmp_path), snapshot_every=3))
+    add_stock(bus)  # three commands, so a snapshot
+    bus.handle(commands.Allocate("o1", "LAMP", 15))
+    bus.handle(commands.Allocate("o2", "LAMP", 10))
+    with pytest.raises(handlers.InvalidSku):  # and again when replayed
+        bus.handle(commands.Allocate("o3", "NO-SUCH-SKU", 1))
+    bus.uow.store.close()
+
+    recovered = in_memory_bus(memory_store.InMemoryStore(str(tmp_path)))
+
+    products = recovered.uow.store.products
+    assert sorted(products) == ["LAMP", "TABLE"]
+    assert [b.available_quantity for b in products["LAMP"].batches] == [5, 10]
+    assert (
+        products["LAMP"].version_number == bus.uow.store.products["LAMP"].version_number
+    )
+    assert views.allocations("o2", recovered.uow) == [
+        {"sku": "LAMP", "batchref": "b-later"}
+    ]
+    # and it carries on journaling after the replayed commands
+    recovered.handle(commands.Allocate("o4", "TABLE", 1))
+    recovered.uow.store.close()
+    again = in_memory_bus(memory_store.InMemoryStore(str(tmp_path)))
+    assert again.uow.store.products["TABLE"].batches[0].available_quantity == 9
+
+
+def test_a_torn_journal_record_is_dropped(tmp_path):
+    bus = in_memory_bus(memory_store.InMemoryStore(str(tmp_path)))
+    add_stock(bus)
+    bus.uow.store.close()
+    with open(tmp_path / memory_store.JOURNAL_FILE, "ab") as f:
+        f.write(b"\x00\x00\x01\x00half a record")
+
+    recovered = in_memory_bus(memory_store.InMemoryStore(str(tmp_path)))
+
+    assert sorted(recovered.uow.store.products) == ["LAMP", "TABLE"]
+    journal = (tmp_path / memory_store.JOURNAL_FILE).read_bytes()
+    assert not journal.endswith(b"half a record")
@@ -0,0 +1,147 @@
+import smtplib
+from unittest import mock
+
+import pytest
+from allocation.adapters.notifications import (
+    DigestingEmailNotifications,
+    EmailNotifications,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def smtp():
+    with mock.patch("smtplib.SMTP") as smtp:
+        yield smtp
+
+
+def sent_messages(smtp):
+    return [call.kwargs["msg"] for call in smtp.return_value.sendmail.call_args_list]
+
+
+def test_email_notifications_reuse_one_connection(smtp):
+    email = EmailNotifications("mailhost", 25)
+    email.send("stock@made.com", "one")
+    email.send("stock@made.com", "two")
+
+    smtp.assert_called_once_with("mailhost", port=25)
+    assert smtp.return_value.sendmail.call_count == 2
+
+
+def test_email_notifications_reconnect_when_the_server_hangs_up(smtp):
+    email = EmailNotifications("mailhost", 25)
+    smtp.return_value.sendmail.side_effect = [
+        None,
+        smtplib.SMTPServerDisconnected(),
+        None,
+    ]
+
+    email.send("stock@made.com", "one")
+    email.send("stock@made.com", "two")
+
+    assert smtp.call_count == 2
+    assert sent_messages(smtp)[-1].endswith("two")
+
+
+def test_digest_deduplicates_messages_within_the_window(smtp):
+    clock = FakeClock()
+    email = DigestingEmailNotifications("mailhost", 25, window=60, clock=clock)
+    for _ in range(5):
+        email.send("stock@made.com", "Out of stock for LAMP")
+    email.send("stock@made.com", "Out of stock for RUG")
+    smtp.return_value.sendmail.assert_not_called()
+
+    clock.now = 60
+    email.flush_if_due()
+
+    assert sent_messages(smtp) == [
+        "Subject: allocation service notification\n"
+        "Out of stock for LAMP (5 times)\n"
+        "Out of stock for RUG"
+    ]
+
+
+def test_a_send_after_the_window_sends_the_digest(smtp):
+    clock = FakeClock()
+    email = DigestingEmailNotifications("mailhost", 25, window=60, clock=clock)
+    email.send("stock@made.com", "Out of stock for LAMP")
+    clock.now = 61
+    email.send("stock@made.com", "Out of stock for LAMP")
+
+    assert sent_messages(smtp)[0].endswith("Out of stock for LAMP (2 times)")
+
+
+def test_digest_has_one_summary_per_destination(smtp):
+    email = DigestingEmailNotifications("mailhost", 25, clock=FakeClock())
+    email.send("stock@made.com", "Out of stock for LAMP")
+    email.send("buyers@made.com", "Out of stock for LAMP")
+    email.flush()
+
+    destinations = [
+        call.kwargs["to_addrs"] for call in smtp.return_value.sendmail.call_args_list
+    ]
+    assert destinations == [["stock@made.com"], ["buyers@made.com"]]
+
+
+def test_digest_close_sends_what_is_pending_and_quits(smtp):
+    email = DigestingEmailNotifications("mailhost", 25, clock=FakeClock())
+    email.send("stock@made.com", "Out of stock for LAMP")
+    email.close()
+
+    assert len(sent_messages(smtp)) == 1
+    smtp.return_value.quit.assert_called_once()
+
+
+def test_digest_with_nothing_pending_makes_no_connection(smtp):
+    email = DigestingEmailNotifications("mailhost", 25, clock=FakeClock())
+    email.flush_if_due()
+    email.close()
+
+    smtp.assert_not_called()
+
+
+def test_digest_is_sent_by_a_timer_when_nothing_else_happens(smtp):
+    email = DigestingEmailNotifications("mailhost", 25, window=0.01)
+    email.send("stock@made.com", "Out of stock for LAMP")
+
+    email._timer.join(timeout=5)
+
+    assert sent_messages(smtp) == [
+        "Subject: allocation service notification\nOut of stock for LAMP"
+    ]
+
+
+def test_digest_that_fails_to_send_is_kept_for_the_next_window(smtp):
+    clock = FakeClock()
+    email = DigestingEmailNotifications("mailhost", 25, window=60, clock=clock)
+    email.send("stock@made.com", "Out of stock for LAMP")
+    smtp.return_value.sendmail.side_effect = [ConnectionError(), ConnectionError()]
+    with pytest.raises(ConnectionError):
+        email.flush()
+
+    smtp.return_value.sendmail.side_effect = None
+    email.send("stock@made.com", "Out of stock for LAMP")
+    email.flush_if_due()
+    assert sent_messages(smtp)[2:] == []
+    clock.now = 60
+    email.flush_if_due()
+
+    assert sent_messages(smtp)[2:] == [
+        "Subject: allocation service notification\n" "Out of stock for LAMP (2 times)"
+    ]
+
+
+def test_digest_is_closed_at_exit_once(smtp):
+    email = DigestingEmailNotifications("mailhost", 25, clock=FakeClock())
+    with mock.patch("atexit.register") as register:
+        email.close_at_exit()
+        email.close_at_exit()
+
+    register.assert_called_once_with(email.close)
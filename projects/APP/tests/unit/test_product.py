@@ -72,3 +72,82 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_skips_batches_without_enough_stock_in_eta_order():
+    full = Batch("full-batch", "WOBBLY-STOOL", 5, eta=None)
+    early = Batch("early-batch", "WOBBLY-STOOL", 100, eta=today)
+    late = Batch("late-batch", "WOBBLY-STOOL", 100, eta=later)
+    product = Product(sku="WOBBLY-STOOL", batches=[late, full, early])
+
+    assert product.allocate(OrderLine("o1", "WOBBLY-STOOL", 10)) == "early-batch"
+    assert product.allocate(OrderLine("o2", "WOBBLY-STOOL", 5)) == "full-batch"
+    assert product.allocate(OrderLine("o3", "WOBBLY-STOOL", 95)) == "late-batch"
+
+
+def test_batches_added_after_allocating_keep_eta_order():
+    product = Product(
+        sku="FLUFFY-RUG", batches=[Batch("late", "FLUFFY-RUG", 100, eta=later)]
+    )
+    product.allocate(OrderLine("o1", "FLUFFY-RUG", 10))
+
+    product.add_batch(Batch("tomorrow", "FLUFFY-RUG", 100, eta=tomorrow))
+    assert product.allocate(OrderLine("o2", "FLUFFY-RUG", 10)) == "tomorrow"
+
+    product.add_batch(Batch("in-stock", "FLUFFY-RUG", 5, eta=None))
+    assert product.allocate(OrderLine("o3", "FLUFFY-RUG", 5)) == "in-stock"
+    assert product.allocate(OrderLine("o4", "FLUFFY-RUG", 5)) == "tomorrow"
+
+
+def test_shrinking_a_batch_is_seen_by_later_allocations():
+    batch1 = Batch("batch1", "CREAKY-BENCH", 20, eta=None)
+    batch2 = Batch("batch2", "CREAKY-BENCH", 20, eta=tomorrow)
+    product = Product(sku="CREAKY-BENCH", batches=[batch1, batch2])
+    product.allocate(OrderLine("o1", "CREAKY-BENCH", 5))
+
+    product.change_batch_quantity("batch1", 5)
+    assert product.allocate(OrderLine("o2", "CREAKY-BENCH", 5)) == "batch2"
+
+
+def test_change_batch_quantity_emits_a_deallocated_event_per_released_line():
+    batch = Batch("batch1", "HEAVY-CHEST", 100, eta=None)
+    product = Product(sku="HEAVY-CHEST", batches=[batch])
+    for orderid, qty in [("o1", 10), ("o2", 20), ("o3", 40)]:
+        product.allocate(OrderLine(orderid, "HEAVY-CHEST", qty))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 45)
+
+    assert batch.available_quantity == 15
+    assert product.events == [
+        events.Deallocated("o3", "HEAVY-CHEST", 40),
+        events.OutOfStock("HEAVY-CHEST"),
+    ]
+
+
+def test_change_batch_quantity_reallocates_released_lines_to_other_batches():
+    in_stock = Batch("in-stock", "HEAVY-CHEST", 100, eta=None)
+    shipment = Batch("shipment", "HEAVY-CHEST", 30, eta=tomorrow)
+    product = Product(sku="HEAVY-CHEST", batches=[in_stock, shipment])
+    for orderid, qty in [("o1", 10), ("o2", 20), ("o3", 40)]:
+        product.allocate(OrderLine(orderid, "HEAVY-CHEST", qty))
+    product.events.clear()
+
+    product.change_batch_quantity("in-stock", 20)
+
+    assert product.events == [
+        events.Deallocated("o3", "HEAVY-CHEST", 40),
+        events.Deallocated("o1", "HEAVY-CHEST", 10),
+        events.OutOfStock("HEAVY-CHEST"),
+        events.Allocated("o1", "HEAVY-CHEST", 10, "shipment"),
+    ]
+    assert in_stock.available_quantity == 0
+    assert shipment.available_quantity == 20
+
+
+def test_adding_and_changing_batches_increments_version_number():
+    product = Product(sku="SCANDI-PEN", batches=[], version_number=7)
+    product.add_batch(Batch("b1", "SCANDI-PEN", 100, eta=None))
+    assert product.version_number == 8
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 9
@@ -0,0 +1,161 @@
+import json
+
+import pytest
+from allocation.adapters import event_codec
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def get_message(self, timeout=0.0):
+        if self.messages:
+            return self.messages.pop(0)
+        return None
+
+
+class FakeBus:
+    def __init__(self):
+        self.handled = []
+
+    def handle(self, message):
+        self.handled.append(message)
+
+
+def change_message(batchref, qty):
+    return {"data": json.dumps({"batchref": batchref, "qty": qty})}
+
+
+def test_collect_batch_stops_at_max_size():
+    pubsub = FakePubSub([change_message(f"b{i}", i) for i in range(5)])
+
+    received = redis_eventconsumer.collect_batch(pubsub, max_size=3, max_wait=10)
+
+    assert len(received) == 3
+    assert len(pubsub.messages) == 2
+
+
+def test_collect_batch_stops_after_the_time_window():
+    pubsub = FakePubSub([change_message("b1", 1)])
+
+    received = redis_eventconsumer.collect_batch(pubsub, max_size=10, max_wait=0.01)
+
+    assert len(received) == 1
+
+
+def test_updates_to_the_same_batch_are_coalesced_last_write_wins():
+    bus = FakeBus()
+    pubsub = FakePubSub(
+        [
+            change_message("b1", 10),
+            change_message("b2", 20),
+            change_message("b1", 5),
+        ]
+    )
+    received = redis_eventconsumer.collect_batch(pubsub, max_size=10, max_wait=0.01)
+
+    metrics = redis_eventconsumer.handle_change_batch_quantities(received, bus)
+
+    assert bus.handled == [
+        commands.ChangeBatchQuantities(
+            [
+                commands.ChangeBatchQuantity("b1", 5),
+                commands.ChangeBatchQuantity("b2", 20),
+            ]
+        )
+    ]
+    assert metrics.messages_in == 3
+    assert metrics.commands_executed == 2
+    assert metrics.lag >= 0
+
+
+def test_binary_frames_are_unpacked_and_coalesced():
+    bus = FakeBus()
+    frame = event_codec.BinaryCodec().encode_frame(
+        [commands.ChangeBatchQuantity("b1", 10), commands.ChangeBatchQuantity("b2", 20)]
+    )
+    pubsub = FakePubSub([{"data": frame}, change_message("b1", 5)])
+    received = redis_eventconsumer.collect_batch(pubsub, max_size=10, max_wait=0.01)
+
+    metrics = redis_eventconsumer.handle_change_batch_quantities(received, bus)
+
+    assert bus.handled == [
+        commands.ChangeBatchQuantities(
+            [
+                commands.ChangeBatchQuantity("b1", 5),
+                commands.ChangeBatchQuantity("b2", 20),
+            ]
+        )
+    ]
+    assert metrics.messages_in == 2
+
+
+def test_undecodable_messages_are_dropped_and_the_rest_applied(caplog):
+    bus = FakeBus()
+    pubsub = FakePubSub(
+        [
+            change_message("b1", 10),
+            {"data": json.dumps({"batchref": "b2"})},
+            {"data": b"{not json"},
+            change_message("b3", 30),
+        ]
+    )
+    received = redis_eventconsumer.collect_batch(pubsub, max_size=10, max_wait=0.01)
+
+    metrics = redis_eventconsumer.handle_change_batch_quantities(received, bus)
+
+    assert bus.handled == [
+        commands.ChangeBatchQuantities(
+            [
+                commands.ChangeBatchQuantity("b1", 10),
+                commands.ChangeBatchQuantity("b3", 30),
+            ]
+        )
+    ]
+    assert metrics.messages_in == 4
+    assert metrics.commands_executed == 2
+    assert caplog.text.count("dropping undecodable message") == 2
+
+
+class StopConsuming(Exception):
+    pass
+
+
+def test_main_logs_a_failed_batch_and_carries_on(monkeypatch, caplog):
+    class FailingOnceBus(FakeBus):
+        def handle(self, message):
+            if not self.handled:
+                self.handled.append(None)
+                raise ConnectionError("database went away")
+            super().handle(message)
+
+    class FakeRedis:
+        def __init__(self, **kwargs):
+            pass
+
+        def pubsub(self, **kwargs):
+            pubsub = FakePubSub([])
+            pubsub.subscribe = lambda *channels: None
+            return pubsub
+
+    batches = [[(0.0, change_message("b1", 1))], [(0.0, change_message("b2", 2))]]
+
+    def collect_batch(pubsub, **settings):
+        if not batches:
+            raise StopConsuming
+        return batches.pop(0)
+
+    bus = FailingOnceBus()
+    monkeypatch.setattr(redis_eventconsumer.bootstrap, "bootstrap", lambda **_: bus)
+    monkeypatch.setattr(redis_eventconsumer.redis, "Redis", FakeRedis)
+    monkeypatch.setattr(redis_eventconsumer, "collect_batch", collect_batch)
+
+    with pytest.raises(StopConsuming):
+        redis_eventconsumer.main()
+
+    assert bus.handled[1:] == [
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b2", 2)])
+    ]
+    assert "failed to apply a batch of 1 messages" in caplog.text
@@ -0,0 +1,341 @@
+import threading
+import time
+
+import pytest
+import redis
+from allocation.adapters import event_codec, redis_streams
+from allocation.adapters.redis_streams import StreamConsumer
+from allocation.domain import commands, events
+from allocation.entrypoints import redis_stream_consumer
+
+
+def _id_key(entry_id):
+    ms, seq = entry_id.split(b"-")
+    return int(ms), int(seq)
+
+
+class FakeStreamsRedis:
+    """
+    The stream commands the transport uses, with Redis' semantics for
+    consumer groups: entries are delivered to one consumer per group and
+    stay pending until acked or claimed by another consumer.
+    """
+
+    def __init__(self):
+        self.streams = {}  # stream -> [(id, fields)]
+        self.groups = {}  # (stream, group) -> {"last": id, "pending": {...}}
+        self._seq = 0
+
+    def xadd(self, stream, fields, maxlen=None, approximate=True):
+        self._seq += 1
+        entry_id = f"{self._seq}-0".encode()
+        entries = self.streams.setdefault(stream, [])
+        entries.append((entry_id, {k.encode(): v for k, v in fields.items()}))
+        if maxlen is not None:
+            del entries[: max(0, len(entries) - maxlen)]
+        return entry_id
+
+    def xgroup_create(self, stream, group, id="$", mkstream=False):
+        if stream not in self.streams:
+            if not mkstream:
+                raise redis.ResponseError("ERR The XGROUP subcommand requires the key")
+            self.streams[stream] = []
+        if (stream, group) in self.groups:
+            raise redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.groups[stream, group] = {"last": b"0-0", "pending": {}}
+
+    def _group(self, stream, group):
+        try:
+            return self.groups[stream, group]
+        except KeyError:
+            raise redis.ResponseError("NOGROUP No such consumer group") from None
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None):
+        ((stream, start),) = streams.items()
+        assert start == ">"
+        state = self._group(stream, groupname)
+        new = [
+            (entry_id, fields)
+            for entry_id, fields in self.streams[stream]
+            if _id_key(entry_id) > _id_key(state["last"])
+        ][:count]
+        if not new:
+            return []
+        for entry_id, _ in new:
+            state["pending"][entry_id] = [consumername, time.monotonic(), 1]
+        state["last"] = new[-1][0]
+        return [[stream.encode(), new]]
+
+    def xack(self, name, groupname, *ids):
+        pending = self._group(name, groupname)["pending"]
+        return sum(1 for entry_id in ids if pending.pop(entry_id, None))
+
+    def xautoclaim(
+        self, name, groupname, consumername, min_idle_time, start_id="0-0", count=None
+    ):
+        state = self._group(name, groupname)
+        entries = dict(self.streams[name])
+        now = time.monotonic()
+        claimed, deleted = [], []
+        for entry_id in sorted(state["pending"], key=_id_key):
+            consumer, delivered, times = state["pending"][entry_id]
+            if (now - delivered) * 1000 < min_idle_time:
+                continue
+            if entry_id not in entries:
+                del state["pending"][entry_id]
+                deleted.append(entry_id)
+                continue
+            state["pending"][entry_id] = [consumername, now, times + 1]
+            claimed.append((entry_id, entries[entry_id]))
+            if len(claimed) == count:
+                break
+        return [b"0-0", claimed, deleted]
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        # pylint: disable=redefined-builtin
+        now = time.monotonic()
+        return [
+            dict(
+                message_id=entry_id,
+                consumer=consumer.encode(),
+                time_since_delivered=int((now - delivered) * 1000),
+                times_delivered=times,
+            )
+            for entry_id, (consumer, delivered, times) in sorted(
+                self._group(name, groupname)["pending"].items(),
+                key=lambda item: _id_key(item[0]),
+            )
+            if _id_key(min) <= _id_key(entry_id) <= _id_key(max)
+            and consumername in (None, consumer)
+        ][:count]
+
+    def pending_for(self, stream, group):
+        return {
+            entry_id: consumer
+            for entry_id, (consumer, _, _) in self._group(stream, group)[
+                "pending"
+            ].items()
+        }
+
+
+class FakeBus:
+    def __init__(self, fail=False, fail_for=()):
+        self.handled = []
+        self.fail = fail
+        self.fail_for = fail_for
+
+    def handle(self, message):
+        if self.fail:
+            raise ConnectionError("database went away")
+        if any(change.ref in self.fail_for for change in message.changes):
+            raise ValueError("bad change")
+        self.handled.append(message)
+
+
+@pytest.fixture
+def client():
+    return FakeStreamsRedis()
+
+
+def consumer(client, name, claim_idle=30.0, count=100, max_deliveries=5):
+    c = StreamConsumer(
+        client,
+        "change_batch_quantity",
+        "allocation",
+        name,
+        count,
+        claim_idle,
+        max_deliveries,
+    )
+    c.ensure_group()
+    return c
+
+
+def add_change(client, ref, qty, codec=event_codec.JsonCodec()):
+    redis_streams.add(
+        client,
+        "change_batch_quantity",
+        codec.encode(commands.ChangeBatchQuantity(ref, qty)),
+        maxlen=1000,
+    )
+
+
+def test_ensure_group_can_be_called_by_every_consumer(client):
+    consumer(client, "a")
+    consumer(client, "b")
+
+    assert list(client.groups) == [("change_batch_quantity", "allocation")]
+
+
+def test_consumers_in_a_group_share_the_entries(client):
+    a, b = consumer(client, "a", count=2), consumer(client, "b", count=2)
+    for i in range(3):
+        add_change(client, f"b{i}", i)
+
+    seen_by_a, seen_by_b = a.read(), b.read()
+
+    assert len(seen_by_a) == 2
+    assert len(seen_by_b) == 1
+    assert not {i for i, _ in seen_by_a} & {i for i, _ in seen_by_b}
+    assert b.read() == []
+
+
+def test_entries_stay_pending_until_acked(client):
+    a = consumer(client, "a")
+    add_change(client, "b1", 1)
+    add_change(client, "b2", 2)
+
+    entries = a.read()
+    a.ack([entries[0][0]])
+
+    assert client.pending_for("change_batch_quantity", "allocation") == {
+        entries[1][0]: "a"
+    }
+
+
+def test_stale_pending_entries_are_reclaimed_by_another_consumer(client):
+    dead = consumer(client, "dead")
+    add_change(client, "b1", 1)
+    entries = dead.read()
+
+    assert consumer(client, "patient", claim_idle=30).reclaim() == []
+    reclaimed = consumer(client, "rescuer", claim_idle=0).reclaim()
+
+    assert reclaimed == entries
+    assert client.pending_for("change_batch_quantity", "allocation") == {
+        entries[0][0]: "rescuer"
+    }
+
+
+def test_worker_coalesces_and_acks_what_it_applied(client):
+    worker = redis_stream_consumer.Worker(consumer(client, "a"), FakeBus(), block=0)
+    add_change(client, "b1", 10)
+    add_change(client, "b2", 20, codec=event_codec.BinaryCodec())
+    add_change(client, "b1", 5)
+
+    assert worker.poll() == 3
+
+    assert worker.bus.handled == [
+        commands.ChangeBatchQuantities(
+            [
+                commands.ChangeBatchQuantity("b1", 5),
+                commands.ChangeBatchQuantity("b2", 20),
+            ]
+        )
+    ]
+    assert client.pending_for("change_batch_quantity", "allocation") == {}
+
+
+def test_failed_batches_are_left_pending_and_retried(client):
+    worker = redis_stream_consumer.Worker(
+        consumer(client, "a", claim_idle=0), FakeBus(fail=True), block=0
+    )
+    add_change(client, "b1", 10)
+
+    worker.poll()
+    assert len(client.pending_for("change_batch_quantity", "allocation")) == 1
+
+    worker.bus.fail = False
+    assert worker.poll() == 1  # reclaimed, not read again
+    assert worker.bus.handled == [
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b1", 10)])
+    ]
+    assert client.pending_for("change_batch_quantity", "allocation") == {}
+
+
+def test_a_failed_batch_is_retried_entry_by_entry(client):
+    worker = redis_stream_consumer.Worker(
+        consumer(client, "a"), FakeBus(fail_for=["bad"]), block=0
+    )
+    add_change(client, "b1", 10)
+    add_change(client, "bad", 20)
+    add_change(client, "b2", 30)
+
+    assert worker.poll() == 3
+
+    assert worker.bus.handled == [
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b1", 10)]),
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b2", 30)]),
+    ]
+    assert list(client.pending_for("change_batch_quantity", "allocation")) == [b"2-0"]
+
+
+def test_entries_that_keep_failing_are_dead_lettered(client):
+    worker = redis_stream_consumer.Worker(
+        consumer(client, "a", claim_idle=0, max_deliveries=2),
+        FakeBus(fail_for=["bad"]),
+        block=0,
+    )
+    add_change(client, "bad", 20)
+
+    worker.poll()
+    assert worker.consumer.deliveries(b"1-0") == 1
+    assert client.pending_for("change_batch_quantity", "allocation") == {b"1-0": "a"}
+    worker.poll()
+
+    assert client.pending_for("change_batch_quantity", "allocation") == {}
+    [(_, fields)] = client.streams["change_batch_quantity:dead"]
+    assert fields[b"id"] == b"1-0"
+    assert event_codec.decode(fields[b"data"], commands.ChangeBatchQuantity) == [
+        commands.ChangeBatchQuantity("bad", 20)
+    ]
+
+
+def test_undecodable_entries_are_dropped(client):
+    worker = redis_stream_consumer.Worker(consumer(client, "a"), FakeBus(), block=0)
+    client.xadd("change_batch_quantity", {"data": b"\xa7\x01\x01\x7f"})
+    add_change(client, "b1", 10)
+
+    worker.poll()
+
+    assert worker.bus.handled == [
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b1", 10)])
+    ]
+    assert client.pending_for("change_batch_quantity", "allocation") == {}
+
+
+def test_non_json_entries_are_dropped(client):
+    worker = redis_stream_consumer.Worker(consumer(client, "a"), FakeBus(), block=0)
+    client.xadd("change_batch_quantity", {"data": b"{not json"})
+    client.xadd("change_batch_quantity", {"data": b"\xff\xfe"})
+    add_change(client, "b1", 10)
+
+    worker.poll()
+
+    assert worker.bus.handled == [
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("b1", 10)])
+    ]
+    assert client.pending_for("change_batch_quantity", "allocation") == {}
+
+
+def test_the_worker_survives_a_failed_poll(client, caplog):
+    stop = threading.Event()
+    worker = redis_stream_consumer.Worker(consumer(client, "a"), FakeBus(), block=0)
+    polls = []
+
+    def poll():
+        polls.append(1)
+        if len(polls) == 1:
+            raise RuntimeError("something unexpected")
+        stop.set()
+
+    worker.poll = poll
+    worker.run(stop)
+
+    assert len(polls) == 2
+    assert "a failed to poll" in caplog.text
+
+
+def test_stream_publisher_adds_encoded_events(client):
+    publisher = redis_streams.StreamPublisher(
+        client, event_codec.BinaryCodec(), maxlen=2
+    )
+    allocated = [events.Allocated(f"o{i}", "sku", 1, "b1") for i in range(3)]
+
+    for event in allocated:
+        publisher.publish("line_allocated", event)
+
+    assert [
+        event_codec.decode(fields[b"data"])[0]
+        for _, fields in client.streams["line_allocated"]
+    ] == allocated[1:]
@@ -0,0 +1,67 @@
+from unittest import mock
+
+from allocation import bootstrap
+from allocation.adapters import notifications, redis_eventpublisher
+from allocation.domain import events
+from allocation.service_layer import unit_of_work
+from allocation.startup import StartupTimer
+
+
+def test_bootstrap_does_not_touch_smtp_redis_or_the_database():
+    with mock.patch("smtplib.SMTP", side_effect=ConnectionRefusedError), mock.patch(
+        "redis.Redis", side_effect=ConnectionRefusedError
+    ), mock.patch("allocation.adapters.engine.create_engine") as engine:
+        bus = bootstrap.bootstrap(start_orm=False)
+
+    assert bus.uow.session_factory is None
+    engine.assert_not_called()
+
+
+def test_email_notifications_connect_on_first_send_only():
+    with mock.patch("smtplib.SMTP") as smtp:
+        email = notifications.EmailNotifications("mailhost", 25)
+        smtp.assert_not_called()
+
+        email.send("a@example.com", "one")
+        email.send("b@example.com", "two")
+
+    smtp.assert_called_once_with("mailhost", port=25)
+    assert smtp.return_value.sendmail.call_count == 2
+
+
+def test_redis_client_is_created_once_on_first_publish():
+    event = events.Allocated("o1", "sku1", 10, "b1")
+    redis_eventpublisher.get_client.cache_clear()
+    redis_eventpublisher.get_publisher.cache_clear()
+    try:
+        with mock.patch("redis.Redis") as client:
+            redis_eventpublisher.publish("line_allocated", event)
+            redis_eventpublisher.publish("line_allocated", event)
+    finally:
+        redis_eventpublisher.get_client.cache_clear()
+        redis_eventpublisher.get_publisher.cache_clear()
+
+    client.assert_called_once()
+    assert client.return_value.publish.call_count == 2
+
+
+def test_startup_timer_reports_each_phase_and_the_total():
+    with mock.patch("time.perf_counter", side_effect=[1.5, 1.75]):
+        timer = StartupTimer(started=1.0)
+        timer.mark("import")
+        timer.mark("bootstrap.orm")
+
+    assert timer.phases == [("import", 0.5), ("bootstrap.orm", 0.25)]
+    assert timer.total == 0.75
+    assert timer.report().splitlines()[-1].split() == ["total", "750.0", "ms"]
+
+
+def test_default_session_factory_is_built_once():
+    unit_of_work.default_session_factory.cache_clear()
+    try:
+        assert (
+            unit_of_work.default_session_factory()
+            is unit_of_work.default_session_factory()
+        )
+    finally:
+        unit_of_work.default_session_factory.cache_clear()
@@ -0,0 +1,74 @@
+from unittest import mock
+
+from allocation.adapters.view_cache import AllocationsCache, InMemoryLRUStore
+
+
+def test_lru_store_evicts_the_least_recently_used_entry():
+    store = InMemoryLRUStore(max_size=2)
+    store.set("o1", [1])
+    store.set("o2", [2])
+    store.get("o1")
+    store.set("o3", [3])
+
+    assert store.get("o1") == [1]
+    assert store.get("o2") is None
+    assert store.get("o3") == [3]
+
+
+def test_lru_store_expires_entries_after_the_ttl():
+    store = InMemoryLRUStore(ttl=10)
+    with mock.patch("time.monotonic", return_value=100.0):
+        store.set("o1", [1])
+    with mock.patch("time.monotonic", return_value=105.0):
+        assert store.get("o1") == [1]
+    with mock.patch("time.monotonic", return_value=111.0):
+        assert store.get("o1") is None
+
+
+def test_read_through_counts_hits_and_misses():
+    cache = AllocationsCache(InMemoryLRUStore())
+    load = mock.Mock(return_value=[{"sku": "sku1", "batchref": "b1"}])
+
+    cache.get_or_load("o1", load)
+    cache.get_or_load("o1", load)
+    cache.get_or_load("o1", load)
+
+    assert load.call_count == 1
+    assert cache.stats() == dict(hits=2, misses=1, invalidations=0, hit_ratio=2 / 3)
+
+
+def test_invalidated_orders_are_dropped_again_on_flush():
+    cache = AllocationsCache(InMemoryLRUStore())
+    cache.invalidate("o1")
+    # a read between the event and the read model flush caches stale rows
+    cache.get_or_load("o1", lambda: ["stale"])
+
+    cache.flush()
+
+    assert cache.get_or_load("o1", lambda: ["fresh"]) == ["fresh"]
+
+
+def test_a_load_overtaken_by_an_invalidation_is_not_stored():
+    cache = AllocationsCache(InMemoryLRUStore())
+
+    def load_then_invalidate():
+        cache.invalidate("o1")  # the order changes while the view is read
+        return ["stale"]
+
+    assert cache.get_or_load("o1", load_then_invalidate) == ["stale"]
+
+    assert cache.get_or_load("o1", lambda: ["fresh"]) == ["fresh"]
+    assert cache.get_or_load("o1", lambda: ["later"]) == ["fresh"]
+
+
+def test_a_load_overtaken_by_a_flush_is_not_stored():
+    cache = AllocationsCache(InMemoryLRUStore())
+    cache.invalidate("o1")
+
+    def load_then_flush():
+        cache.flush()
+        return ["stale"]
+
+    cache.get_or_load("o1", load_then_flush)
+
+    assert cache.get_or_load("o1", lambda: ["fresh"]) == ["fresh"]
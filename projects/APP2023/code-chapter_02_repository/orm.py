@@ -1,4 +1,5 @@
 from sqlalchemy import Table, MetaData, Column, Integer, String, Date, ForeignKey
+from sqlalchemy import event
 from sqlalchemy.orm import registry, relationship
 
 import model
@@ -50,3 +51,12 @@ def start_mappers():
             )
         },
     )
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "refresh")
+@event.listens_for(model.Batch, "expire")
+def reset_allocated_quantity(batch, *_):
+    # _allocations is hydrated behind the model's back; recompute on next read
+    if batch is not None:
+        batch._allocated_quantity = None
@@ -38,6 +38,8 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        # running total of _allocations; None means "recompute on next read"
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -58,16 +60,22 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity += line.qty
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
             self._allocations.remove(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity -= line.qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int: